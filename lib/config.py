@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/16 15:40:26
+#   Desc    :   运行时重新加载配置
+#
+import imp
+import signal
+import logging
+
+from .routing import parse_bridges
+from .log import get_logger, set_levels
+from .spool import DROP_OLDEST, DROP_NEWEST
+
+# 修改后需要重启才能生效的配置
+RESTART_KEYS = ("QQ", "QQ_PWD", "XMPP_ACCOUNT", "XMPP_PASSWD",
+                "XMPP_SERVER", "XMPP_PORT", "WEBQQ_SERVER",
+                "HTTPD_HOST", "HTTPD_PORT", "CONTROL_ADDRESS",
+                "METRICS_ADDRESS", "TRACE_PATH", "IMAGE_STORE_PATH",
+                "MUC_NICK", "LOG_FILE", "LOG_FORMAT", "LOG_THREADED",
+                "LOG_QUEUE_SIZE", "LOG_RATE_INTERVAL", "LOG_RATE_BURST",
+                "XMPP_RECONNECT_MIN", "XMPP_RECONNECT_MAX", "SPOOL_PATH",
+                "STARTUP_TIMELINE_PATH", "LOOP_METRICS",
+                "LOOP_METRICS_INTERVAL", "MEMORY_TRACEMALLOC_FRAMES")
+
+# 重新加载时直接生效的配置, 见 `ConfigReloader.apply`
+LIVE_KEYS = ("BRIDGES", "MUC_ROOMS", "CONN_ALERT_PER_ENDPOINT",
+             "CONN_ALERT_TOTAL", "CONN_ALERT_UNTRACKED", "LOG_LEVEL",
+             "LOG_LEVELS", "QQ_SEND_INTERVAL", "QQ_SEND_QUEUE_SIZE",
+             "QQ_POLL_TIMEOUT", "QQ_POLL_MAX_DELAY", "QQ_MEMBER_CONCURRENCY",
+             "FLOOD_RATE", "FLOOD_BURST", "FLOOD_DEGRADED_BURST",
+             "XMPP_OUTPUT_HIGH", "XMPP_OUTPUT_LOW", "QQ_SEND_HIGH",
+             "QQ_SEND_LOW", "SPOOL_MAX_BYTES", "SPOOL_MAX_AGE",
+             "SPOOL_POLICY", "DNS_TTL", "IMAGE_BASE_URL", "IMAGE_STORE_QUOTA",
+             "TRACE_SAMPLE_RATE", "TRACE_SLOW", "PROFILE_DIR",
+             "PROFILE_INTERVAL", "PROFILE_MAX_SECONDS",
+             "MEMORY_CHECK_INTERVAL", "MEMORY_GROWTH_FACTOR",
+             "MEMORY_GROWTH_MIN", "MEMORY_RSS_LIMIT", "MEMORY_REPORT_INTERVAL",
+             "XMPP_BATCH_BYTES", "XMPP_BATCH_DELAY", "XMPP_SM_ACK_EVERY",
+             "XMPP_SM_MAX_UNACKED")
+
+
+def _number(key, value):
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)) \
+       or value < 0:
+        raise ValueError(u"{0} must be a non-negative number, got {1!r}"
+                         .format(key, value))
+    return value
+
+
+def _string(key, value):
+    if not isinstance(value, basestring):
+        raise ValueError(u"{0} must be a string, got {1!r}".format(key, value))
+    return value
+
+
+def _level(key, value):
+    if isinstance(value, basestring):
+        value = logging.getLevelName(value.upper())
+    if not isinstance(value, (int, long)) or isinstance(value, bool):
+        raise ValueError(u"Invalid log level in {0}: {1!r}".format(key, value))
+    return value
+
+
+def _levels(key, value):
+    if not isinstance(value, dict):
+        raise ValueError(u"{0} must be a dict, got {1!r}".format(key, value))
+    for level in value.itervalues():
+        _level(key, level)
+    return value
+
+
+def _bridges(key, value):
+    parse_bridges(value)
+    return value
+
+
+def _policy(key, value):
+    if value not in (DROP_OLDEST, DROP_NEWEST):
+        raise ValueError(u"Invalid spool policy: {0!r}".format(value))
+    return value
+
+
+# 非负数以外的配置的检查函数
+CHECKS = {"BRIDGES": _bridges, "MUC_ROOMS": _bridges, "LOG_LEVEL": _level,
+          "LOG_LEVELS": _levels, "SPOOL_POLICY": _policy,
+          "IMAGE_BASE_URL": _string, "PROFILE_DIR": _string}
+
+
+class _Values(object):
+    """ 以属性访问 {配置名: 值} """
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+
+class ConfigReloader(object):
+    """ 重新读取settings.py, 校验通过后替换桥接路由等可以在线修改的配置,
+    不影响已登录的QQ会话和XMPP连接. 由SIGHUP或控制接口的reload命令触发
+    """
+    def __init__(self, qxbot, path = None):
+        self.logger = get_logger("config")
+        self.qxbot = qxbot
+        if path is None:
+            import settings
+            path = settings.__file__
+        if path.endswith((".pyc", ".pyo")):
+            path = path[:-1]
+        self.path = path
+        self.current = self.load()
+
+    def load(self):
+        """ 执行配置文件得到新的模块对象, 不修改已导入的settings """
+        module = imp.new_module("settings")
+        module.__file__ = self.path
+        execfile(self.path, module.__dict__)
+        return module
+
+    def install_signal(self):
+        """ 收到SIGHUP时在mainloop中重新加载 """
+        mainloop = self.qxbot.mainloop
+        signal.signal(signal.SIGHUP,
+                      lambda signum, frame: mainloop.add_callback(self.reload))
+        # 被信号中断的系统调用自动重启, 避免写spool和日志时出现EINTR
+        signal.siginterrupt(signal.SIGHUP, False)
+
+    def validate(self, new):
+        """ 读取并检查 `LIVE_KEYS` 的值, 返回 {配置名: 值},
+        缺少配置或格式错误时抛出异常 """
+        values = {}
+        for key in LIVE_KEYS:
+            if not hasattr(new, key):
+                raise ValueError(u"Missing setting {0}".format(key))
+            values[key] = CHECKS.get(key, _number)(key, getattr(new, key))
+        for high, low in (("XMPP_OUTPUT_HIGH", "XMPP_OUTPUT_LOW"),
+                          ("QQ_SEND_HIGH", "QQ_SEND_LOW")):
+            if values[low] > values[high]:
+                raise ValueError(u"{0} is greater than {1}".format(low, high))
+        return values
+
+    def reload(self, request = None):
+        """ 重新加载配置, 返回结果描述, 也用作控制命令
+        全部配置检查通过后才修改运行中的组件 """
+        try:
+            new = self.load()
+            values = self.validate(new)
+        except Exception, err:
+            self.logger.warn(u"Reload {0} failed: {1}, keep current "
+                             u"settings".format(self.path, err))
+            return u"reload failed: {0}".format(err)
+
+        self.apply(values)
+        ignored = [key for key in RESTART_KEYS
+                   if getattr(new, key, None) !=
+                      getattr(self.current, key, None)]
+        if ignored:
+            self.logger.warn(u"Settings {0} changed, restart to apply"
+                             .format(u", ".join(ignored)))
+        self.current = new
+        bridges = len(values["BRIDGES"])
+        rooms = len(values["MUC_ROOMS"])
+        self.logger.info(u"Settings reloaded, {0} bridges, {1} rooms"
+                         .format(bridges, rooms))
+        result = u"reloaded {0} bridges, {1} rooms".format(bridges, rooms)
+        if ignored:
+            result += u", restart required for {0}".format(u", ".join(ignored))
+        return result
+
+    def apply(self, values):
+        """ 把 `validate` 返回的配置应用到运行中的各组件 """
+        new = _Values(values)
+        qxbot = self.qxbot
+        qxbot.msg_dispatch.routes.set_bridges(new.BRIDGES, new.MUC_ROOMS)
+        if qxbot.connected:
+            qxbot.join_rooms()
+        connections = qxbot.mainloop.connections
+        connections.per_endpoint_limit = new.CONN_ALERT_PER_ENDPOINT
+        connections.total_limit = new.CONN_ALERT_TOTAL
+        connections.untracked_limit = new.CONN_ALERT_UNTRACKED
+        set_levels(new.LOG_LEVEL, new.LOG_LEVELS)
+
+        webqq = qxbot.webqq
+        webqq.send_interval = new.QQ_SEND_INTERVAL
+        webqq.send_queue_size = new.QQ_SEND_QUEUE_SIZE
+        webqq.poll_timeout = new.QQ_POLL_TIMEOUT
+        webqq.poll_max_delay = new.QQ_POLL_MAX_DELAY
+        webqq.member_concurrency = new.QQ_MEMBER_CONCURRENCY
+
+        qxbot.msg_dispatch.flood.configure(new.FLOOD_RATE, new.FLOOD_BURST,
+                                           new.FLOOD_DEGRADED_BURST)
+        marks = qxbot.flow.marks
+        marks["xmpp"].high = new.XMPP_OUTPUT_HIGH
+        marks["xmpp"].low = new.XMPP_OUTPUT_LOW
+        marks["qq"].high = new.QQ_SEND_HIGH
+        marks["qq"].low = new.QQ_SEND_LOW
+
+        spool = qxbot.spool
+        spool.max_bytes = new.SPOOL_MAX_BYTES
+        spool.segment_bytes = max(min(spool.segment_bytes,
+                                      new.SPOOL_MAX_BYTES // 4), 1)
+        spool.max_age = new.SPOOL_MAX_AGE
+        spool.policy = new.SPOOL_POLICY
+
+        qxbot.resolver.ttl = new.DNS_TTL
+        qxbot.image_store.base_url = new.IMAGE_BASE_URL.rstrip("/") + "/"
+        qxbot.image_store.quota = new.IMAGE_STORE_QUOTA
+        qxbot.tracer.sample_rate = new.TRACE_SAMPLE_RATE
+        qxbot.tracer.slow = new.TRACE_SLOW
+
+        profiler = qxbot.profiler
+        profiler.directory = new.PROFILE_DIR
+        profiler.interval = new.PROFILE_INTERVAL
+        profiler.max_seconds = new.PROFILE_MAX_SECONDS
+
+        memory = qxbot.memory
+        memory.growth_factor = new.MEMORY_GROWTH_FACTOR
+        memory.min_growth = new.MEMORY_GROWTH_MIN
+        memory.rss_limit = new.MEMORY_RSS_LIMIT
+        memory.report_interval = new.MEMORY_REPORT_INTERVAL
+        memory.check_interval = new.MEMORY_CHECK_INTERVAL
+        memory.start()              # 原来未开启定时检查时开始
+
+        qxbot.batcher.max_bytes = new.XMPP_BATCH_BYTES
+        qxbot.batcher.max_delay = new.XMPP_BATCH_DELAY
+        qxbot.stream_management.ack_every = new.XMPP_SM_ACK_EVERY
+        qxbot.stream_management.max_unacked = new.XMPP_SM_MAX_UNACKED
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/15 16:27:40
+#   Desc    :   连接(文件描述符)的生命周期统计
+#
+import os
+import time
+
+from .utils import get_logger
+
+
+class ConnectionTracker(object):
+    """ 记录mainloop上所有打开的连接, 按端点统计数量和存活时间
+    定时检查, 数量超过阈值或进程打开的文件描述符远多于记录的连接时告警
+    `per_endpoint_limit`  单个端点的连接数阈值
+    `total_limit`         所有连接数阈值
+    `untracked_limit`     未记录的文件描述符数阈值(可能有泄露)
+    """
+    def __init__(self, mainloop, per_endpoint_limit = 20, total_limit = 200,
+                 untracked_limit = 50, check_interval = 60):
+        self.logger = get_logger("connections")
+        self.mainloop = mainloop
+        self.per_endpoint_limit = per_endpoint_limit
+        self.total_limit = total_limit
+        self.untracked_limit = untracked_limit
+        self.check_interval = check_interval
+        self.opened_total = 0
+        self.closed_total = 0
+        self._conns = {}        # conn -> (endpoint, 打开时间)
+        self._alerts = set()
+        self._timer = None
+
+    def opened(self, conn, endpoint):
+        if conn in self._conns:
+            self.closed(conn)
+        self._conns[conn] = (endpoint, time.time())
+        self.opened_total += 1
+
+    def closed(self, conn):
+        if self._conns.pop(conn, None) is not None:
+            self.closed_total += 1
+
+    def __len__(self):
+        return len(self._conns)
+
+    def count(self, endpoint = None):
+        if endpoint is None:
+            return len(self._conns)
+        return sum(1 for e, _ in self._conns.itervalues() if e == endpoint)
+
+    def report(self):
+        """ 返回 [(端点, 数量, 最长存活秒数, 最短存活秒数)], 按数量降序 """
+        now = time.time()
+        stats = {}
+        for endpoint, opened in self._conns.itervalues():
+            ages = stats.setdefault(endpoint, [])
+            ages.append(now - opened)
+        result = [(endpoint, len(ages), max(ages), min(ages))
+                  for endpoint, ages in stats.iteritems()]
+        result.sort(key = lambda x: (-x[1], x[0]))
+        return result
+
+    @staticmethod
+    def process_fds():
+        """ 进程当前打开的文件描述符数, 无法获取时返回None """
+        try:
+            return len(os.listdir("/proc/self/fd"))
+        except OSError:
+            return None
+
+    def format_report(self):
+        lines = [u"open {0} opened {1} closed {2} process fds {3}"
+                 .format(len(self._conns), self.opened_total,
+                         self.closed_total, self.process_fds())]
+        for endpoint, count, oldest, newest in self.report():
+            lines.append(u"{0:<48} {1:>5} oldest {2:>8.1f}s newest {3:>8.1f}s"
+                         .format(endpoint, count, oldest, newest))
+        return u"\n".join(lines)
+
+    def start(self):
+        if self._timer is None:
+            self._timer = self.mainloop.call_later(self.check_interval,
+                                                   self.check)
+
+    def check(self):
+        """ 检查阈值, 状态变化时才记录日志 """
+        alerts = set()
+        for endpoint, count, oldest, _ in self.report():
+            if count > self.per_endpoint_limit:
+                alerts.add((u"endpoint", endpoint, count))
+        if len(self._conns) > self.total_limit:
+            alerts.add((u"total", None, len(self._conns)))
+        fds = self.process_fds()
+        if fds is not None and fds - len(self._conns) > self.untracked_limit:
+            alerts.add((u"untracked", None, fds - len(self._conns)))
+
+        keys = set(a[:2] for a in alerts)
+        for kind, endpoint, count in alerts:
+            if (kind, endpoint) not in self._alerts:
+                self.logger.warn(u"Connection alert: {0} {1} count {2}\n{3}"
+                                 .format(kind, endpoint or u"", count,
+                                         self.format_report()))
+        for kind, endpoint in self._alerts - keys:
+            self.logger.info(u"Connection alert cleared: {0} {1}"
+                             .format(kind, endpoint or u""))
+        self._alerts = keys
+        self._timer = self.mainloop.call_later(self.check_interval,
+                                               self.check)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/14 09:41:08
+#   Desc    :   本地控制接口
+#
+from .httpd import HTTPServer, HTTPResponse
+from .utils import get_logger
+
+
+class ControlServer(object):
+    """ 本地控制接口, 监听TCP地址或UNIX socket
+    请求 /<命令>?参数=值 执行注册的命令, 请求 / 列出所有命令
+    例: curl 'http://127.0.0.1:8001/captcha?code=abcd'
+        curl --unix-socket /tmp/qxbot.sock 'http://localhost/captcha'
+    """
+    def __init__(self, mainloop, address):
+        self.logger = get_logger("control")
+        self.address = address
+        self.commands = {}
+        self.httpd = HTTPServer(mainloop, address)
+        self.httpd.route("/", self.dispatch)
+
+    def register(self, name, callback, desc = u""):
+        """ 注册命令, `callback` 接收 `HTTPRequest`,
+        返回 `HTTPResponse` 或文本 """
+        self.commands[name] = (callback, desc)
+
+    def start(self):
+        self.httpd.start()
+
+    def dispatch(self, request):
+        name = request.path.strip("/").split("/")[0]
+        if not name:
+            lines = [u"{0:<16}{1}".format(key, self.commands[key][1])
+                     for key in sorted(self.commands)]
+            return HTTPResponse(200, u"\n".join(lines) + u"\n")
+        if name not in self.commands:
+            return None
+        self.logger.info(u"Control command: {0} {1!r}"
+                         .format(name, request.form))
+        result = self.commands[name][0](request)
+        if isinstance(result, HTTPResponse):
+            return result
+        return HTTPResponse(200, (result or u"ok") + u"\n")
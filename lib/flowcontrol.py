@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/18 09:47:15
+#   Desc    :   流量控制
+#
+import time
+
+from .utils import get_logger
+
+
+class Watermark(object):
+    """ 高低水位, 超过 `high` 时暂停, 降到 `low` 以下时恢复 """
+    def __init__(self, name, level, high, low, on_resume = None):
+        self.name = name
+        self.level = level          # 返回当前积压量的函数
+        self.high = high
+        self.low = low
+        self.on_resume = on_resume
+        self.paused = False
+        self.pauses = 0
+
+    def update(self):
+        """ 返回 (是否暂停, 状态是否变化) """
+        level = self.level()
+        if not self.paused and level >= self.high:
+            self.paused = True
+            self.pauses += 1
+            return True, True
+        if self.paused and level <= self.low:
+            self.paused = False
+            return False, True
+        return self.paused, False
+
+
+class FlowControl(object):
+    """ 管理多个水位, 有水位处于暂停状态时每 `interval` 秒检查一次,
+    恢复时调用其 `on_resume`
+    """
+    def __init__(self, mainloop, interval = 0.2):
+        self.logger = get_logger("flowcontrol")
+        self.mainloop = mainloop
+        self.interval = interval
+        self.marks = {}
+        self._timer = None
+
+    def add(self, name, level, high, low, on_resume = None):
+        self.marks[name] = Watermark(name, level, high, low, on_resume)
+
+    def blocked(self, name):
+        """ `name` 的积压是否超过水位, 调用方应暂停产生更多数据 """
+        return self._update(self.marks[name])
+
+    def _update(self, mark):
+        paused, changed = mark.update()
+        if changed and paused:
+            self.logger.warn(u"Backpressure on {0}: {1} >= {2}, pause"
+                             .format(mark.name, mark.level(), mark.high))
+        elif changed:
+            self.logger.info(u"Backpressure on {0} released".format(mark.name))
+            if mark.on_resume is not None:
+                mark.on_resume()
+        if paused and self._timer is None:
+            self._timer = self.mainloop.call_later(self.interval, self._check)
+        return paused
+
+    def _check(self):
+        self._timer = None
+        for mark in self.marks.values():
+            if mark.paused:
+                self._update(mark)
+
+
+class TokenBucket(object):
+    """ 令牌桶, 每秒补充 `rate` 个, 最多 `burst` 个 """
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def configure(self, rate, burst):
+        """ 之前的时间按原来的速度补充, 之后按新的速度 """
+        self._refill()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = min(self.tokens, burst)
+
+    def take(self, floor = 0):
+        """ 取一个令牌, 取后不低于 `floor` 时成功(floor为负表示允许透支) """
+        self._refill()
+        if self.tokens - 1 >= floor:
+            self.tokens -= 1
+            return True
+        return False
+
+
+FULL = "full"               # 正常处理
+DEGRADED = "degraded"       # 超出预算: 不转发图片
+DROP = "drop"               # 丢弃, 之后汇总为 "略过N条消息"
+COUNTERS = (FULL, DEGRADED, DROP, "duplicate", "images_skipped")
+
+
+class FloodControl(object):
+    """ 每个群的入站预算
+    `rate`/`burst`      正常处理的速度(条/秒)和突发数
+    `degraded_burst`    预算用完后还可以降级处理的条数, 之后丢弃
+    预算用完后连续相同的消息只保留一条
+    """
+    def __init__(self, rate = 0.5, burst = 10, degraded_burst = 20):
+        self.rate = rate
+        self.burst = burst
+        self.degraded_burst = degraded_burst
+        self.counters = {}          # gcode -> {计数名: 数量}
+        self._buckets = {}
+        self._last = {}
+        self._skipped = {}
+
+    def __len__(self):
+        """ 记录了状态的群数 """
+        return len(self._buckets)
+
+    def configure(self, rate, burst, degraded_burst):
+        """ 修改预算, 已有的令牌桶也按新的速度和突发数计算 """
+        self.rate = rate
+        self.burst = burst
+        self.degraded_burst = degraded_burst
+        for bucket in self._buckets.itervalues():
+            bucket.configure(rate, burst)
+
+    def admit(self, gcode, key):
+        """ 返回对这条消息的处理方式, `key` 用于判断是否重复 """
+        bucket = self._buckets.get(gcode)
+        if bucket is None:
+            bucket = self._buckets[gcode] = TokenBucket(self.rate, self.burst)
+        last = self._last.get(gcode)
+        self._last[gcode] = key
+        if bucket.take():
+            verdict = FULL
+        elif last == key:
+            verdict = "duplicate"
+        elif bucket.take(-self.degraded_burst):
+            verdict = DEGRADED
+        else:
+            verdict = DROP
+        self.count(gcode, verdict)
+        if verdict in (FULL, DEGRADED):
+            return verdict
+        self._skipped[gcode] = self._skipped.get(gcode, 0) + 1
+        return DROP
+
+    def count(self, gcode, name, n = 1):
+        counters = self.counters.get(gcode)
+        if counters is None:
+            counters = self.counters[gcode] = dict.fromkeys(COUNTERS, 0)
+        counters[name] += n
+
+    def take_skipped(self, gcode):
+        """ 返回并清零该群被丢弃的消息数 """
+        return self._skipped.pop(gcode, 0)
+
+    def report(self):
+        lines = [u"{0:<14}".format(u"gcode") +
+                 u"".join(u"{0:>16}".format(name) for name in COUNTERS)]
+        for gcode in sorted(self.counters):
+            counters = self.counters[gcode]
+            lines.append(u"{0:<14}".format(gcode) +
+                         u"".join(u"{0:>16}".format(counters[name])
+                                  for name in COUNTERS))
+        return u"\n".join(lines)
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/12 10:21:36
+#   Desc    :   运行在EpollMainLoop上的简单HTTP服务
+#
+import os
+import time
+import errno
+import socket
+import urllib
+import urlparse
+import httplib
+import mimetypes
+
+from .libepoll import SocketIOHandler
+from .utils import get_logger, sendfile
+
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+_BLOCKING_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class HTTPRequest(object):
+    """ 解析后的HTTP请求 """
+    def __init__(self, method, path, query, headers, body, remote):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers          # 键为小写
+        self.body = body
+        self.remote = remote
+
+    @property
+    def form(self):
+        """ 合并查询参数和urlencoded的请求体 """
+        form = dict(self.query)
+        if self.body:
+            form.update(urlparse.parse_qsl(self.body))
+        return form
+
+
+class HTTPResponse(object):
+    """ HTTP响应
+    `body` 为字符串, 或者通过 `fileobj`, `offset`, `length` 指定发送文件的片段
+    """
+    def __init__(self, code = 200, body = "",
+                 content_type = "text/plain; charset=utf-8", headers = None):
+        if isinstance(body, unicode):
+            body = body.encode("utf-8")
+        self.code = code
+        self.body = body
+        self.headers = [("Content-Type", content_type)]
+        if headers:
+            self.headers.extend(headers)
+        self.fileobj = None
+        self.offset = 0
+        self.length = len(body)
+
+    def make_head(self, keep_body = True):
+        lines = ["HTTP/1.1 {0} {1}".format(self.code,
+                                           httplib.responses.get(self.code,
+                                                                 "Unknown"))]
+        headers = self.headers + [("Content-Length", self.length),
+                                  ("Connection", "close"),
+                                  ("Server", "qxbot")]
+        for key, value in headers:
+            lines.append("{0}: {1}".format(key, value))
+        lines.extend(("", ""))
+        head = "\r\n".join(lines)
+        if keep_body and self.fileobj is None:
+            head += self.body
+        return head
+
+
+def error_response(code):
+    return HTTPResponse(code, "{0} {1}\n".format(code,
+                                                 httplib.responses.get(code)))
+
+
+def parse_range(value, size):
+    """ 解析单个 `bytes=start-end` 的Range头, 返回 (start, end) 或 None
+    不满足时抛出ValueError
+    """
+    if not value or not value.startswith("bytes=") or "," in value:
+        return None
+    start, _, end = value[6:].strip().partition("-")
+    if start:
+        start = int(start)
+        end = int(end) if end else size - 1
+    elif end:
+        start = max(size - int(end), 0)     # 后缀形式: bytes=-500
+        end = size - 1
+    else:
+        return None
+    end = min(end, size - 1)
+    if start > end:
+        raise ValueError(value)
+    return start, end
+
+
+def file_response(path, request, content_type = None, headers = None):
+    """ 构造发送文件的响应, 支持Range请求 """
+    try:
+        fp = open(path, 'rb')
+    except IOError:
+        return error_response(404)
+    size = os.fstat(fp.fileno()).st_size
+    if content_type is None:
+        content_type = (mimetypes.guess_type(path)[0] or
+                        "application/octet-stream")
+    resp = HTTPResponse(200, content_type = content_type, headers = headers)
+    resp.headers.append(("Accept-Ranges", "bytes"))
+    try:
+        rng = parse_range(request.headers.get("range"), size)
+    except ValueError:
+        fp.close()
+        resp = error_response(416)
+        resp.headers.append(("Content-Range", "bytes */{0}".format(size)))
+        return resp
+    start, end = rng if rng else (0, size - 1)
+    if rng:
+        resp.code = 206
+        resp.headers.append(("Content-Range", "bytes {0}-{1}/{2}"
+                             .format(start, end, size)))
+    resp.fileobj = fp
+    resp.offset = start
+    resp.length = max(end - start + 1, 0)
+    return resp
+
+
+class HTTPServerConnection(SocketIOHandler):
+    """ 服务端的一个连接, 处理一个请求后关闭 """
+    def __init__(self, server, sock, remote):
+        SocketIOHandler.__init__(self, server.mainloop, sock)
+        self.server = server
+        self.remote = remote
+        self.created = time.time()
+        self._rbuf = ""
+        self._wbuf = ""
+        self._resp = None
+        self._head = None
+        self._timer = server.mainloop.call_later(server.timeout, self._expire)
+
+    def is_readable(self):
+        return self.sock is not None and self._resp is None
+
+    def is_writable(self):
+        return self.sock is not None and self._resp is not None
+
+    def handle_read(self):
+        while True:
+            try:
+                data = self.sock.recv(8192)
+            except socket.error, err:
+                if err.args[0] in _BLOCKING_ERRORS:
+                    break
+                self.close()
+                return
+            if not data:
+                self.close()
+                return
+            self._rbuf += data
+            if len(self._rbuf) > MAX_HEADER_SIZE + MAX_BODY_SIZE:
+                self.respond(error_response(413))
+                return
+        self._try_parse()
+
+    def _try_parse(self):
+        if self._head is None:
+            pos = self._rbuf.find("\r\n\r\n")
+            if pos < 0:
+                if len(self._rbuf) > MAX_HEADER_SIZE:
+                    self.respond(error_response(431))
+                return
+            self._head = self._rbuf[:pos]
+            self._rbuf = self._rbuf[pos + 4:]
+        lines = self._head.split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            self.respond(error_response(400))
+            return
+        headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            self.respond(error_response(400))
+            return
+        if length > MAX_BODY_SIZE:
+            self.respond(error_response(413))
+            return
+        if len(self._rbuf) < length:
+            return
+        parse = urlparse.urlparse(target)
+        request = HTTPRequest(method.upper(), urllib.unquote(parse.path),
+                              urlparse.parse_qsl(parse.query), headers,
+                              self._rbuf[:length], self.remote)
+        self.respond(self.server.dispatch(request), method.upper() == "HEAD")
+
+    def respond(self, resp, head_only = False):
+        self._resp = resp
+        self._wbuf = resp.make_head(not head_only)
+        if head_only and resp.fileobj is not None:
+            resp.fileobj.close()
+            resp.fileobj = None
+            resp.length = 0
+
+    def handle_write(self):
+        try:
+            while self._wbuf:
+                sent = self.sock.send(self._wbuf)
+                self._wbuf = self._wbuf[sent:]
+            resp = self._resp
+            while resp.fileobj is not None and resp.length > 0:
+                sent = sendfile(self.sock.fileno(), resp.fileobj.fileno(),
+                                resp.offset, resp.length)
+                if not sent:
+                    break
+                resp.offset += sent
+                resp.length -= sent
+        except (socket.error, OSError), err:
+            if err.args[0] in _BLOCKING_ERRORS:
+                return
+            self.server.logger.warn(u"HTTP write to {0!r} failed: {1}"
+                                    .format(self.remote, err))
+        self.close()
+
+    def _expire(self):
+        self._timer = None
+        if self.sock is not None:
+            self.server.logger.warn(u"HTTP connection from {0!r} timed out"
+                                    .format(self.remote))
+            self.close()
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._resp is not None and self._resp.fileobj is not None:
+            self._resp.fileobj.close()
+            self._resp.fileobj = None
+        SocketIOHandler.close(self)
+
+
+class HTTPServer(SocketIOHandler):
+    """ 监听socket, 按路径前缀将请求分发给回调
+    `address` 为 (host, port) 或 UNIX socket 路径
+    回调接收 `HTTPRequest` 返回 `HTTPResponse`, 返回None表示404
+    连接超过 `timeout` 秒未完成则关闭
+    """
+    timeout = 30
+
+    def __init__(self, mainloop, address):
+        SocketIOHandler.__init__(self, mainloop)
+        self.address = address
+        self.routes = []
+        self.logger = get_logger("httpd")
+
+    @property
+    def endpoint(self):
+        if isinstance(self.address, basestring):
+            return self.address
+        return u"{0}:{1}".format(*self.address)
+
+    def route(self, prefix, callback):
+        self.routes.append((prefix, callback))
+        self.routes.sort(key = lambda x: len(x[0]), reverse = True)
+
+    def start(self):
+        if isinstance(self.address, basestring):
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(self.address)
+        sock.listen(128)
+        sock.setblocking(0)
+        self.sock = sock
+        self.track(u"listen {0}".format(self.endpoint))
+        self.mainloop.add_handler(self)
+        self.logger.info(u"HTTP server listening on {0!r}"
+                         .format(self.address))
+
+    def handle_read(self):
+        while True:
+            try:
+                sock, remote = self.sock.accept()
+            except socket.error, err:
+                if err.args[0] in _BLOCKING_ERRORS + (errno.EINTR,):
+                    return
+                self.logger.warn(u"HTTP accept error: {0}".format(err))
+                return
+            sock.setblocking(0)
+            conn = HTTPServerConnection(self, sock, remote)
+            conn.track(u"serve {0}".format(self.endpoint))
+            self.mainloop.add_handler(conn)
+
+    def dispatch(self, request):
+        for prefix, callback in self.routes:
+            if request.path.startswith(prefix):
+                try:
+                    resp = callback(request)
+                except Exception, err:
+                    self.logger.exception(u"HTTP handler error: {0}"
+                                          .format(err))
+                    return error_response(500)
+                if resp is not None:
+                    return resp
+        return error_response(404)
+
+    def handle_hup(self):
+        pass
+
+    def handle_err(self):
+        pass
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/12 11:05:12
+#   Desc    :   本地图片存储
+#
+import os
+import re
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+from .httpd import file_response
+from .utils import get_logger
+
+NAME_RE = re.compile(r"^[0-9a-f]{40}\.[0-9A-Za-z]{1,8}$")
+
+
+class ImageStore(object):
+    """ 以内容的sha1命名的图片存储, 超过配额时按LRU淘汰
+    `root`      存储目录
+    `base_url`  对外访问的地址前缀
+    `quota`     最大占用字节数
+    """
+    def __init__(self, root, base_url, quota):
+        self.logger = get_logger("image_store")
+        self.root = root
+        self.base_url = base_url.rstrip("/") + "/"
+        self.quota = quota
+        self.size = 0
+        self.hits = 0               # 写入已有的图片
+        self.misses = 0
+        self._entries = OrderedDict()      # name -> size, 越靠后越新
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load(self):
+        """ 按访问时间加载已有文件 """
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if not NAME_RE.match(name):
+                    continue
+                st = os.stat(os.path.join(dirpath, name))
+                files.append((st.st_atime, name, st.st_size))
+        files.sort()
+        for _, name, size in files:
+            self._entries[name] = size
+            self.size += size
+        self._evict()
+
+    def path(self, name):
+        return os.path.join(self.root, name[:2], name)
+
+    def url(self, name):
+        return self.base_url + name
+
+    def touch(self, name):
+        """ 标记为最近使用 """
+        size = self._entries.pop(name, None)
+        if size is None:
+            return False
+        self._entries[name] = size
+        return True
+
+    def put(self, data, ext = "jpg"):
+        """ 写入图片数据, 返回文件名 """
+        ext = ext.lstrip(".").lower() or "jpg"
+        name = "{0}.{1}".format(hashlib.sha1(data).hexdigest(), ext)
+        if self.touch(name):
+            self.hits += 1
+            return name
+        self.misses += 1
+        path = self.path(name)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmp = tempfile.mkstemp(dir = dirname)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+        self._entries[name] = len(data)
+        self.size += len(data)
+        self._evict()
+        return name
+
+    def _evict(self):
+        while self.size > self.quota and len(self._entries) > 1:
+            name, size = self._entries.popitem(last = False)
+            self.size -= size
+            try:
+                os.unlink(self.path(name))
+            except OSError:
+                pass
+            self.logger.debug(u"Image %s evicted", name)
+
+    def serve(self, request, prefix):
+        """ HTTPServer的路由回调 """
+        name = request.path[len(prefix):]
+        if not NAME_RE.match(name) or not self.touch(name):
+            return None
+        return file_response(self.path(name), request,
+                             headers = [("Cache-Control",
+                                         "public, max-age=31536000")])
@@ -7,11 +7,95 @@
 #   Desc    :   Epoll main Loop
 #
 
+import os
+import time
+import fcntl
+import errno
+import heapq
 import select
-from pyxmpp2.mainloop.interfaces import HandlerReady, PrepareAgain
+import logging
+import itertools
+from collections import deque
+from pyxmpp2.mainloop.interfaces import HandlerReady, PrepareAgain, IOHandler
 from pyxmpp2.mainloop.base import MainLoopBase
 
 from .utils import get_logger
+from .connections import ConnectionTracker
+from .metrics import LoopMetrics
+
+
+class Timer(object):
+    """ `EpollMainLoop.call_later` 返回的定时器, 可以取消 """
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Waker(IOHandler):
+    """ 管道, 用于从其他线程唤醒阻塞在epoll上的mainloop """
+    drains_io = True
+    def __init__(self):
+        self._rfd, self._wfd = os.pipe()
+        for fd in (self._rfd, self._wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def wake(self):
+        try:
+            os.write(self._wfd, "x")
+        except OSError, err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def fileno(self):
+        return self._rfd
+
+    def is_readable(self):
+        return True
+
+    def wait_for_readability(self):
+        return True
+
+    def is_writable(self):
+        return False
+
+    def wait_for_writability(self):
+        return False
+
+    def prepare(self):
+        return HandlerReady()
+
+    def handle_read(self):
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except OSError, err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def handle_write(self):
+        pass
+
+    def handle_hup(self):
+        pass
+
+    def handle_err(self):
+        pass
+
+    def handle_nval(self):
+        pass
+
+    def close(self):
+        os.close(self._rfd)
+        os.close(self._wfd)
+
 
 class EpollMainLoop(MainLoopBase):
     """ Main event loop based on the epoll() syscall on Linux system """
@@ -25,18 +109,33 @@ class EpollMainLoop(MainLoopBase):
         self._unprepared_handlers = {}
         self._timeout = None
         self._exists_fd = {}
-        self.logger = get_logger()
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._callbacks = deque()
+        self.logger = get_logger("libepoll")
+        self.connections = ConnectionTracker(self)
+        self.metrics = LoopMetrics(self)    # 为None时不统计
+        self.profile = None     # cProfile.Profile, 不为None时分析每轮循环
         MainLoopBase.__init__(self, settings, handlers)
+        self._waker = Waker()
+        self.add_handler(self._waker)
 
         return
 
+    def queue_sizes(self):
+        """ 各内部队列的长度 """
+        return {"handlers": len(self._handlers),
+                "fds": len(self._exists_fd),
+                "unprepared": len(self._unprepared_handlers),
+                "timers": len(self._timers),
+                "callbacks": len(self._callbacks)}
+
     def _add_io_handler(self, handler):
         self._unprepared_handlers[handler] = None
         self._configure_io_handler(handler)
 
     def _configure_io_handler(self, handler):
-        if self.check_events():
-            return
+        # 不在此处分发事件, 否则在回调中添加handler会重入事件分发
         if handler in self._unprepared_handlers:
             old_fileno = self._unprepared_handlers[handler]
             prepared = self._prepare_io_handler(handler)
@@ -54,21 +153,49 @@ class EpollMainLoop(MainLoopBase):
         if not fileno:
             return
 
+        if self._handlers.get(fileno, handler) is not handler:
+            # 旧handler的socket已关闭(如XMPP断线), fd被新连接重用
+            self._exists_fd.pop(fileno, None)
         self._handlers[fileno] = handler
         events = 0
         if handler.is_readable():
-            self.logger.debug(" {0!r} readable".format(handler))
             events |= self.READ_ONLY
         if handler.is_writable():
-            self.logger.debug(" {0!r} writable".format(handler))
             events |= self.READ_WRITE
+        # 每轮都会调用, 关闭DEBUG时不构造日志记录
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(" %r readable %s writable %s", handler,
+                              bool(events & self.READ_ONLY),
+                              bool(events & select.EPOLLOUT))
 
         if events is not None: # events may be 0
-            if fileno in self._exists_fd:
-                self.epoll.modify(fileno, events)
-            else:
-                self._exists_fd.update({fileno:1})
-                self.epoll.register(fileno, events)
+            old_events = self._exists_fd.get(fileno)
+            if old_events is None:
+                self._exists_fd[fileno] = events
+                self._epoll_register(fileno, events)
+            elif (old_events != events or
+                  not getattr(handler, "drains_io", False)):
+                # 边缘触发下modify会重新检查就绪状态, 不读到EAGAIN的
+                # handler(如pyxmpp2的transport)依赖它取到剩余数据
+                self._exists_fd[fileno] = events
+                self._epoll_modify(fileno, events)
+
+    def _epoll_register(self, fileno, events):
+        try:
+            self.epoll.register(fileno, events)
+        except (IOError, OSError), err:
+            if err.errno != errno.EEXIST:
+                raise
+            self.epoll.modify(fileno, events)
+
+    def _epoll_modify(self, fileno, events):
+        try:
+            self.epoll.modify(fileno, events)
+        except (IOError, OSError), err:
+            if err.errno != errno.ENOENT:
+                raise
+            # 关闭fd时内核已将其从epoll中删除
+            self.epoll.register(fileno, events)
 
     def _prepare_io_handler(self, handler):
         ret = handler.prepare()
@@ -101,8 +228,70 @@ class EpollMainLoop(MainLoopBase):
             except KeyError:
                 pass
 
+    def call_later(self, delay, callback, *args):
+        """ `delay` 秒后在mainloop中调用 `callback(*args)`, 返回 `Timer` """
+        timer = Timer(time.time() + delay, callback, args)
+        heapq.heappush(self._timers, (timer.deadline, next(self._timer_seq),
+                                      timer))
+        return timer
+
+    def add_callback(self, callback, *args):
+        """ 在mainloop线程中调用 `callback(*args)`, 可以在其他线程中调用 """
+        self._callbacks.append((callback, args))
+        self._waker.wake()
+
+    def _run_callbacks(self):
+        handled = 0
+        while self._callbacks:
+            callback, args = self._callbacks.popleft()
+            try:
+                callback(*args)
+            except Exception, err:
+                self.logger.exception(u"Callback error: {0}".format(err))
+            handled += 1
+        return handled
+
+    def _call_timers(self):
+        """ 调用到期的定时器, 返回调用的数量 """
+        handled = 0
+        now = time.time()
+        metrics = self.metrics
+        while self._timers:
+            deadline, _, timer = self._timers[0]
+            if deadline > now and not timer.cancelled:
+                break
+            heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+            if metrics is not None:
+                metrics.lag.observe(now - deadline)
+            try:
+                timer.callback(*timer.args)
+            except Exception, err:
+                self.logger.exception(u"Timer callback error: {0}".format(err))
+            handled += 1
+        return handled
+
+    def _timer_timeout(self):
+        """ 距下一个定时器的秒数 """
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return None
+        return max(self._timers[0][0] - time.time(), 0.001)
+
     def loop_iteration(self, timeout = 60):
+        if self.profile is not None:
+            return self.profile.runcall(self._loop_iteration, timeout)
+        return self._loop_iteration(timeout)
+
+    def _loop_iteration(self, timeout):
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.time()
         next_timeout, sources_handled = self._call_timeout_handlers()
+        sources_handled += self._call_timers()
+        sources_handled += self._run_callbacks()
         if self.check_events():
             return
         if self._quit:
@@ -113,25 +302,125 @@ class EpollMainLoop(MainLoopBase):
             timeout = min(timeout, self._timeout)
         if next_timeout is not None:
             timeout = min(next_timeout, timeout)
+        timer_timeout = self._timer_timeout()
+        if timer_timeout is not None:
+            timeout = min(timer_timeout, timeout)
+        if self._callbacks:
+            timeout = 0.001
 
         if timeout == 0:
             timeout += 1    # 带有超时的非阻塞,解约资源
-        events = self.epoll.poll(timeout)
+        if metrics is not None:
+            waiting = time.time()
+        try:
+            events = self.epoll.poll(timeout)
+        except (IOError, OSError), err:
+            if err.errno != errno.EINTR:
+                raise
+            events = []     # 被信号中断(如SIGHUP重新加载配置)
+        if metrics is not None:
+            wait = time.time() - waiting
+            metrics.wait.observe(wait)
+            metrics.events.observe(len(events))
         for fd, flag in events:
+            handler = self._handlers.get(fd)
+            if handler is None:
+                continue
+            stats = None if metrics is None else metrics.handler_stats(handler)
             if flag & (select.EPOLLIN | select.EPOLLPRI | select.EPOLLET):
-                self._handlers[fd].handle_read()
-            if flag & (select.EPOLLOUT|select.EPOLLET):
-                self._handlers[fd].handle_write()
-            if flag & (select.EPOLLERR | select.EPOLLET):
-                self._handlers[fd].handle_err()
-            if flag & (select.EPOLLHUP | select.EPOLLET):
-                self._handlers[fd].handle_hup()
+                if stats is None:
+                    handler.handle_read()
+                else:
+                    t = time.time()
+                    handler.handle_read()
+                    stats.read.observe(time.time() - t)
+            # handler可能在回调中将自己移除(如关闭了连接)
+            if flag & (select.EPOLLOUT|select.EPOLLET) and \
+               self._handlers.get(fd) is handler:
+                if stats is None:
+                    handler.handle_write()
+                else:
+                    t = time.time()
+                    handler.handle_write()
+                    stats.write.observe(time.time() - t)
+            if flag & (select.EPOLLERR | select.EPOLLET) and \
+               self._handlers.get(fd) is handler:
+                handler.handle_err()
+            if flag & (select.EPOLLHUP | select.EPOLLET) and \
+               self._handlers.get(fd) is handler:
+                handler.handle_hup()
             #if flag & select.EPOLLNVAL:
                 #self._handlers[fd].handle_nval()
 
             sources_handled += 1
-            self._configure_io_handler(self._handlers[fd])
+            if self._handlers.get(fd) is handler:
+                self._configure_io_handler(handler)
 
+        if metrics is not None:
+            metrics.iterations += 1
+            metrics.iteration.observe(time.time() - started - wait)
         return sources_handled
 
 
+class SocketIOHandler(IOHandler):
+    """ 非阻塞socket的IOHandler基类
+    子类设置 `self.sock` 并实现 handle_read/handle_write,
+    打开socket后调用 `track` 记入 `mainloop.connections`,
+    `close` 会将自身从mainloop移除, 关闭socket并注销记录
+    """
+    drains_io = True    # 读写都进行到EAGAIN, 事件不变时无需重新modify
+
+    def __init__(self, mainloop, sock = None):
+        self.mainloop = mainloop
+        self.sock = sock
+
+    def fileno(self):
+        if self.sock is not None:
+            return self.sock.fileno()
+        return None
+
+    def is_readable(self):
+        return self.sock is not None
+
+    def wait_for_readability(self):
+        return self.is_readable()
+
+    def is_writable(self):
+        return False
+
+    def wait_for_writability(self):
+        return self.is_writable()
+
+    def prepare(self):
+        return HandlerReady()
+
+    def handle_read(self):
+        pass
+
+    def handle_write(self):
+        pass
+
+    def handle_hup(self):
+        self.close()
+
+    def handle_err(self):
+        self.close()
+
+    def handle_nval(self):
+        self.close()
+
+    def track(self, endpoint):
+        """ 记录当前socket属于 `endpoint` """
+        self.mainloop.connections.opened(self, endpoint)
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.mainloop.connections.closed(self)
+        self.mainloop.remove_handler(self)
+        try:
+            self.sock.close()
+        finally:
+            self.sock = None
+
+
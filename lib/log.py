@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/21 16:20:44
+#   Desc    :   日志配置: 按模块的级别, 后台线程写入, 重复日志限流
+#
+from __future__ import absolute_import
+
+import sys
+import time
+import Queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+
+_handler = None             # setup_logging安装在root上的handler
+_levels = {}                # 上一次LOG_LEVELS设置的级别
+
+
+def get_logger(name = None, level = None):
+    """ 返回 `qxbot` 或 `qxbot.<name>` logger, 可用 `LOG_LEVELS` 单独设置
+    级别. 没有调用过 `setup_logging` 时以默认配置输出到stderr """
+    if _handler is None:
+        setup_logging()
+    name = "qxbot" if not name else "qxbot." + name
+    logger = logging.getLogger(name)
+    if level is not None:
+        logger.setLevel(level)
+    return logger
+
+
+def _level(value):
+    if isinstance(value, basestring):
+        return logging.getLevelName(value.upper())
+    return value
+
+
+def set_levels(level = "INFO", levels = None):
+    """ 设置 `qxbot` 和 `levels` ({logger名: 级别}) 中各logger的级别,
+    可在重新加载配置时调用 """
+    global _levels
+    levels = levels or {}
+    for name in _levels:
+        if name not in levels:
+            logging.getLogger(name).setLevel(logging.NOTSET)
+    logging.getLogger("qxbot").setLevel(_level(level))
+    for name, value in levels.iteritems():
+        logging.getLogger(name).setLevel(_level(value))
+    _levels = levels
+
+
+class RateLimitFilter(logging.Filter):
+    """ 同一处调用(logger, 级别, 源文件和行号)每 `interval` 秒最多通过
+    `burst` 条, 其余丢弃, 下一个周期第一条通过时附上被丢弃的数量.
+    按调用位置而不是消息区分, 用format预先生成的消息内容不同也能限流 """
+    def __init__(self, interval = 60, burst = 5):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.burst = burst
+        self.suppressed = 0
+        self._windows = {}      # 调用位置 -> [开始时间, 条数, 丢弃]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.pathname, record.lineno)
+        now = time.time()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                dropped = window[2] if window is not None else 0
+                if len(self._windows) >= 1000:
+                    self._prune(now)
+                self._windows[key] = [now, 1, 0]
+            elif window[1] < self.burst:
+                window[1] += 1
+                return True
+            else:
+                window[2] += 1
+                self.suppressed += 1
+                return False
+        if dropped:
+            record.msg = u"{0} ({1} similar messages suppressed)".format(
+                record.getMessage(), dropped)
+            record.args = ()
+        return True
+
+    def _prune(self, now):
+        for key, window in self._windows.items():
+            if now - window[0] >= self.interval:
+                del self._windows[key]
+
+
+class AsyncHandler(logging.Handler):
+    """ 记录放入队列后立即返回, 由后台线程格式化并交给 `target` 写入,
+    mainloop不会因为写日志阻塞. 队列满时丢弃并计数 """
+    def __init__(self, target, maxsize = 10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.dropped = 0
+        self._queue = Queue.Queue(maxsize)
+        self._thread = threading.Thread(target = self._run,
+                                        name = "log_writer")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def emit(self, record):
+        if record.exc_info:
+            # traceback在调用线程格式化, 避免后台线程持有栈帧
+            record.exc_text = self.target.formatter.formatException(
+                record.exc_info)
+            record.exc_info = None
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        dropped = 0
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            if self.dropped != dropped:
+                lost, dropped = self.dropped - dropped, self.dropped
+                self.target.handle(logging.LogRecord(
+                    "qxbot", logging.WARNING, __file__, 0,
+                    "%d log records dropped, queue full", (lost,), None))
+            self.target.handle(record)
+
+    def close(self):
+        """ 写完队列中剩余的记录后结束后台线程 """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(5)
+        self.target.close()
+        logging.Handler.close(self)
+
+
+def setup_logging(level = "INFO", levels = None, path = None,
+                  format = LOG_FORMAT, threaded = False, queue_size = 10000,
+                  rate_interval = 60, rate_burst = 5):
+    """ 配置日志, 可重复调用, 替换上一次安装的handler
+    `path`      写入的文件, 为None时输出到stderr. 用WatchedFileHandler,
+                logrotate移走文件后自动重新打开
+    `threaded`  在后台线程中写入
+    `rate_interval`, `rate_burst`  见 `RateLimitFilter`, interval为0时不限流
+    """
+    global _handler
+    root = logging.getLogger()
+    if path:
+        target = logging.handlers.WatchedFileHandler(path)
+    else:
+        target = logging.StreamHandler(sys.stderr)
+    target.setFormatter(logging.Formatter(format))
+    handler = AsyncHandler(target, queue_size) if threaded else target
+    if rate_interval:
+        handler.addFilter(RateLimitFilter(rate_interval, rate_burst))
+    if _handler is not None:
+        root.removeHandler(_handler)
+        _handler.close()
+    else:
+        atexit.register(lambda: _handler is not None and _handler.close())
+    _handler = handler
+    root.addHandler(handler)
+    set_levels(level, levels)
+    return handler
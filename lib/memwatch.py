@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/21 09:48:26
+#   Desc    :   内存占用统计和增长告警
+#
+import gc
+import time
+import resource
+from collections import Counter
+
+from .utils import get_logger
+
+try:
+    import tracemalloc          # pytracemalloc, 需要打过补丁的Python 2.7
+except ImportError:
+    tracemalloc = None
+
+
+def process_rss():
+    """ 进程当前的常驻内存(字节), 无法获取时返回None """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+class MemoryWatch(object):
+    """ 定时统计已知容器的大小和进程的RSS, 持续增长时告警
+    容器第一次检查时的大小为基线, 增长到基线的 `growth_factor` 倍且至少多出
+    `min_growth` 项时告警, 之后每再增长 `growth_factor` 倍告警一次;
+    RSS超过 `rss_limit` 字节时告警
+    `snapshot` 记录各类型的对象数(有tracemalloc时为按代码行的内存分配),
+    与上一次比较, 用于找出泄露的对象
+    """
+    def __init__(self, mainloop, check_interval = 300, growth_factor = 2,
+                 min_growth = 1000, rss_limit = 0, report_interval = 0):
+        self.logger = get_logger("memwatch")
+        self.mainloop = mainloop
+        self.check_interval = check_interval
+        self.growth_factor = growth_factor
+        self.min_growth = min_growth
+        self.rss_limit = rss_limit
+        self.report_interval = report_interval
+        self.alerts = 0
+        self.containers = {}        # 名称 -> 返回大小的函数
+        self.last = {}              # 最近一次检查时各容器的大小
+        self._baseline = {}
+        self._alert_at = {}         # 名称 -> 下一次告警的大小
+        self._rss_alerted = False
+        self._snapshot = None
+        self._last_report = time.time()
+        self._timer = None
+
+    def watch(self, name, size):
+        """ 统计 `size()` 返回的容器大小 """
+        self.containers[name] = size
+
+    def sizes(self):
+        result = {}
+        for name, size in self.containers.iteritems():
+            try:
+                result[name] = size()
+            except Exception, err:
+                self.logger.warn(u"Get size of {0} failed: {1}"
+                                 .format(name, err))
+        return result
+
+    def start(self, trace_frames = 0):
+        """ 开始定时检查, `trace_frames` 大于0且有tracemalloc时开始记录
+        内存分配的调用栈 """
+        if trace_frames and tracemalloc is not None and \
+           not tracemalloc.is_tracing():
+            tracemalloc.start(trace_frames)
+        if self._timer is None and self.check_interval:
+            self._timer = self.mainloop.call_later(self.check_interval,
+                                                   self.check)
+
+    def check(self):
+        sizes = self.last = self.sizes()
+        for name, size in sizes.iteritems():
+            if name not in self._baseline:
+                self._baseline[name] = size
+                self._alert_at[name] = max(size * self.growth_factor,
+                                           size + self.min_growth)
+            elif size >= self._alert_at[name]:
+                self.alerts += 1
+                self.logger.warn(u"Memory alert: {0} grew from {1} to {2}"
+                                 .format(name, self._baseline[name], size))
+                self._alert_at[name] = size * self.growth_factor
+        rss = process_rss()
+        if self.rss_limit and rss is not None:
+            if rss > self.rss_limit and not self._rss_alerted:
+                self.alerts += 1
+                self.logger.warn(u"Memory alert: RSS {0} bytes over limit "
+                                 u"{1}\n{2}".format(rss, self.rss_limit,
+                                                    self.format_report()))
+            elif rss <= self.rss_limit and self._rss_alerted:
+                self.logger.info(u"Memory alert cleared: RSS {0} bytes"
+                                 .format(rss))
+            self._rss_alerted = rss > self.rss_limit
+        if self.report_interval and \
+           time.time() - self._last_report >= self.report_interval:
+            self._last_report = time.time()
+            self.logger.info(u"Memory report:\n{0}"
+                             .format(self.format_report()))
+        self._timer = None
+        if self.check_interval:     # 重新加载配置时可能改为0, 停止检查
+            self._timer = self.mainloop.call_later(self.check_interval,
+                                                   self.check)
+
+    def format_report(self):
+        lines = [u"rss {0} gc objects {1}".format(process_rss(),
+                                                   len(gc.get_objects()))]
+        sizes = self.sizes()
+        for name in sorted(sizes):
+            baseline = self._baseline.get(name)
+            lines.append(u"{0:<36}{1:>10}{2:>10}".format(
+                name, sizes[name], u"" if baseline is None else baseline))
+        return u"\n".join(lines)
+
+    def snapshot(self, limit = 30):
+        """ 记录快照并与上一次比较, 返回增长最多的 `limit` 项 """
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            current = tracemalloc.take_snapshot()
+            if self._snapshot is None or \
+               not hasattr(self._snapshot, "compare_to"):
+                stats = current.statistics("lineno")[:limit]
+            else:
+                stats = current.compare_to(self._snapshot, "lineno")[:limit]
+            self._snapshot = current
+            return [unicode(stat) for stat in stats]
+        gc.collect()
+        current = Counter(type(obj).__name__ for obj in gc.get_objects())
+        previous = self._snapshot if isinstance(self._snapshot, Counter) \
+                   else Counter()
+        self._snapshot = current
+        diff = [(name, count, count - previous.get(name, 0))
+                for name, count in current.iteritems()]
+        diff.sort(key = lambda x: (-x[2], -x[1]))
+        return [u"{0:<40}{1:>10}{2:>+10}".format(name, count, delta)
+                for name, count, delta in diff[:limit]]
+
+    def handle_command(self, request):
+        """ 控制命令: 容器大小, 带snapshot参数时返回与上一次快照的差异 """
+        if request.form.get("snapshot"):
+            return u"\n".join(self.snapshot(int(request.form.get("limit",
+                                                                 30))))
+        return self.format_report()
@@ -6,67 +6,180 @@
 #   Date    :   13/03/01 11:44:05
 #   Desc    :   消息调度
 #
-import random
-import tempfile
-from lib.utils import get_logger, upload_file
+import os
+import time
+from collections import deque, OrderedDict
+from functools import partial
+from pyxmpp2.jid import JID
+from pyxmpp2.message import Message
+from lib.utils import get_logger
+from lib.routing import RoutingTable
+from lib.flowcontrol import FloodControl, FULL, DROP
+from lib.metrics import LATENCY_BUCKETS
 
 class MessageDispatch(object):
     """ 消息调度器 """
-    def __init__(self, qxbot, webqq, bridges):
-        self.logger = get_logger()
+    replay_batch = 10   # 重放缓存时, 保持QQ发送队列中最多这么多条消息
+    summary_delay = 10  # 群消息被丢弃后, 多久发送 "略过N条消息" 的汇总
+    def __init__(self, qxbot, webqq, bridges, rooms = ()):
+        self.logger = get_logger("message_dispatch")
         self.qxbot = qxbot
         self.webqq = webqq
         self.uin_qid_map = {}
         self.qid_uin_map = {}
-        self.bridges = bridges
-        self._maped = False
+        self.routes = RoutingTable(bridges, rooms)
+        self._mapped_groups = set()     # 已获取群号的群
+        self._member_groups = set()     # 已获取成员的群
+        self._live_groups = set()       # 开始转发消息的群
+        self._group_queues = {}     # gcode -> 等待发送的消息, 保证顺序
+        self._replay_timer = None
+        self.flood = FloodControl()
+        self._summary_timers = {}
+        self.qid_hits = 0
+        self.qid_misses = 0
+        metrics = qxbot.metrics
+        self.bridged = metrics.counter("qxbot_messages_bridged_total",
+                                       u"转发的消息数",
+                                       ("direction", "group"))
+        self.latency = metrics.histogram("qxbot_bridge_latency_seconds",
+                                         u"从收到消息到转发出去的时间",
+                                         ("direction",),
+                                         bounds = LATENCY_BUCKETS)
+        metrics.quantiles("qxbot_bridge_latency_quantile_seconds",
+                          u"转发延迟的百分位数(估计值)", self.latency)
 
-    def get_map(self):
+    def group_label(self, gcode):
+        """ 统计中群的标签, 有群号时用群号 """
+        return self.uin_qid_map.get(gcode, gcode)
+
+    def get_map(self, callback = None, on_group = None):
+        """ 异步获取所有群的群号, 每得到一个群的群号就更新路由表并以gcode
+        调用on_group, 全部完成后调用callback """
         uins = [key for key, value in self.webqq.group_map.items()]
+        pending = [len(uins)]
+        qid_uin_map = {}
+        timeline = self.qxbot.timeline
+        def done(uin, qid):
+            pending[0] -= 1
+            if uin is not None:
+                timeline.finish("qid:{0}".format(uin))
+            if qid:
+                qid_uin_map[qid] = uin
+                if self.qid_uin_map.get(qid) != uin:
+                    self.qid_uin_map[qid] = uin
+                    self.routes.rebuild(self.qid_uin_map)
+            elif uin is not None:
+                # 获取失败时沿用上一次的群号
+                kept = [q for q, u in self.qid_uin_map.items() if u == uin
+                        and uin in self.webqq.group_map]
+                for q in kept:
+                    qid_uin_map[q] = uin
+                name = self.webqq.get_group_name(uin)
+                if kept:
+                    self.logger.warn(u"Get number of group {0} failed, keep "
+                                     u"{1}".format(name, kept[0]))
+                else:
+                    self.logger.warn(u"Get number of group {0} failed, its "
+                                     u"messages are not bridged until the "
+                                     u"next refresh".format(name))
+            if uin is not None:
+                self._mapped_groups.add(uin)
+                if on_group:
+                    on_group(uin)
+                self._try_live(uin)
+            if not pending[0]:
+                # 去掉已退出的群
+                self.qid_uin_map = qid_uin_map
+                self.routes.rebuild(qid_uin_map)
+                for gcode in list(self._group_queues):
+                    self._flush_group(gcode)
+                if callback:
+                    callback()
+        if not uins:
+            pending[0] = 1
+            done(None, None)
         for uin in uins:
-            qid = self.get_qid_with_uin(uin)
-            self.uin_qid_map[uin] = qid
-            self.qid_uin_map[qid] = uin
-        self._maped = True
+            timeline.start("qid:{0}".format(uin))
+            self.get_qid_with_uin(uin, partial(done, uin))
 
-    def get_xmpp_account(self, uin):
-        """ 根据uin获取桥接的XMPP帐号 """
-        qid = self.get_qid_with_uin(uin)
-        xmpps = []
-        for q, xmpp in self.bridges:
-            if q == qid:
-                xmpps.append(xmpp)
+    def members_ready(self, gcode):
+        """ 群成员已获取 """
+        self._member_groups.add(gcode)
+        self._try_live(gcode)
 
-        return xmpps
+    def _try_live(self, gcode):
+        """ 群号和群成员都已获取的群开始转发, 发送之前缓存的消息 """
+        if gcode in self._live_groups or gcode not in self._mapped_groups \
+           or gcode not in self._member_groups:
+            return
+        self._live_groups.add(gcode)
+        if self.is_bridged(gcode):
+            self.logger.info(u"Group {0} is live"
+                             .format(self.webqq.get_group_name(gcode)))
+            self.qxbot.timeline.mark("first_group_live")
+        self._flush_group(gcode)
+        if self.all_live:
+            self.qxbot.timeline.mark("all_groups_live")
+            self.qxbot.check_go_live()
 
-    def get_uin_account(self, xmpp):
-        """ 根据xmpp帐号获取桥接的qq号的uin """
-        qids = []
-        for qid, x in self.bridges:
-            if x == xmpp:
-                qids.append(self.qid_uin_map.get(qid))
+    @property
+    def queued(self):
+        """ 各群等待按顺序发送的消息数 """
+        return sum(len(queue) for queue in self._group_queues.itervalues())
 
-        return qids
+    @property
+    def all_live(self):
+        return self._live_groups.issuperset(self.webqq.group_map)
 
-    def get_qid_with_uin(self, uin):
+    def is_bridged(self, gcode):
+        return bool(self.routes.to_xmpp(gcode) or self.routes.to_muc(gcode))
+
+    def get_xmpp_account(self, uin):
+        """ 根据群uin获取桥接的XMPP帐号(JID元组) """
+        return self.routes.to_xmpp(uin)
+
+    def get_uin_account(self, xmpp):
+        """ 根据xmpp帐号获取桥接的群uin元组 """
+        return self.routes.to_qq(xmpp)
+
+    def get_qid_with_uin(self, uin, callback):
+        """ 获取uin对应的QQ号, 有缓存时直接调用callback """
         qid = self.uin_qid_map.get(uin)
-        if not qid:
-            qid = self.webqq.get_qid_with_uin(uin)
-            self.uin_qid_map[uin] = qid
-        return qid
-
-    def get_group_msg_img(self, uin, info):
-        res = self.webqq.get_group_msg_img(uin, info)
-        path = tempfile.mktemp()
-        fp = open(path, 'wb')
-        fp.write(res.read())
-        fp.close()
-        filename = info.get("name")
-        name, typ = filename.split(".")
-        name = random.sample(name, 3)
-        filename = "{0}.{1}".format("".join(name), typ)
-        res = upload_file(filename, path)
-        return res.geturl()
+        if qid:
+            self.qid_hits += 1
+            callback(qid)
+            return
+        self.qid_misses += 1
+        def got(qid):
+            if qid:
+                self.uin_qid_map[uin] = qid
+            callback(qid)
+        self.webqq.get_qid_with_uin(uin, got)
+
+    def get_group_msg_img(self, gcode, uin, info, callback):
+        """ 下载消息中的图片存入本地图片存储, 以访问地址调用callback """
+        typ = os.path.splitext(info.get("name", ""))[1] or "jpg"
+        def got(resp):
+            if resp.error or not resp.body:
+                callback(None)
+                return
+            store = self.qxbot.image_store
+            callback(store.url(store.put(resp.body, typ)))
+        self.webqq.get_group_msg_img(gcode, uin, info, got)
+
+    def get_group_msg_imgs(self, gcode, uin, infos, callback):
+        """ 并发获取多张图片, 全部完成后以地址列表调用callback """
+        urls = [None] * len(infos)
+        pending = [len(infos)]
+        def done(i, url):
+            urls[i] = url
+            pending[0] -= 1
+            if not pending[0]:
+                callback([url for url in urls if url])
+        if not infos:
+            callback([])
+        for i, info in enumerate(infos):
+            self.get_group_msg_img(gcode, uin, info, partial(done, i))
 
     def get_xmpp_face(self, qface_id):
         for q, x in face_map:
@@ -74,8 +187,9 @@ class MessageDispatch(object):
                 return x
         return False
 
-    def handle_qq_group_contents(self, gcode, uin, contents):
-        result = []
+    def handle_qq_group_contents(self, gcode, uin, contents, urls):
+        """ 将消息内容渲染为文本, `urls` 为消息中图片的地址 """
+        result = list(urls)
         content = ""
         face = False
         for row in contents:
@@ -89,9 +203,6 @@ class MessageDispatch(object):
                         f = self.get_xmpp_face(value)
                         if f: content += f
                         else: face = True
-                    if key == "cface":
-                        url  = self.get_group_msg_img(uin, value)
-                        result.append(url)
 
         gender = self.webqq.group_m_map.get(gcode, {}).get(uin, {}).get("gender")
         gender_desc_map = {"male":u"他", None:u"它", "female":u"她"}
@@ -106,33 +217,177 @@ class MessageDispatch(object):
             body = body.replace("\r", "\n")
             return body
 
-    def handle_qq_group_msg(self, message):
-        """ 处理组消息 """
+    def handle_qq_group_msg(self, message, timing = None):
+        """ 处理组消息
+        图片是异步获取的, 同一个群的消息按到达顺序发送
+        `timing` 为poll2响应的 (收到第一个字节, 收完, 解析完) 的时间
+        """
         value = message.get("value", {})
         gcode = value.get("group_code")
+        trace = self.qxbot.tracer.start("qq_to_xmpp",
+                                        timing[0] if timing else None)
+        if trace is not None and timing:
+            trace.span("receive", timing[1])
+            trace.span("parse", timing[2])
+        if gcode in self._mapped_groups and not self.is_bridged(gcode):
+            return      # 没有桥接的群, 不必下载图片和渲染
         uin = value.get("send_uin")
         contents = value.get("content", [])
-        content = self.handle_qq_group_contents(gcode, uin, contents)
-        gname = self.webqq.get_group_name(gcode)
-        uname = self.webqq.get_group_member_nick(gcode, uin)
-        body = u"<{1}> {2}".format(gname, uname, content)
-        tos = self.get_xmpp_account(gcode)
-        [self.qxbot.send_msg(to, body) for to in tos]
-
-    def dispatch_qq(self, qq_source):
+        verdict = self.flood.admit(gcode, repr(contents))
+        if verdict == DROP:
+            if gcode not in self._summary_timers:
+                self._summary_timers[gcode] = self.webqq.mainloop.call_later(
+                    self.summary_delay, self._summarize, gcode)
+            return
+        self._summarize(gcode)
+        infos = [row[1] for row in contents
+                 if isinstance(row, (list, tuple)) and len(row) == 2
+                 and row[0] == "cface"]
+        if trace is not None:
+            trace.tags.update(group = self.group_label(gcode),
+                              msg_id = value.get("msg_id"),
+                              images = len(infos))
+            trace.span("lookup")
+        placeholders = []
+        if verdict != FULL and infos:
+            # 超出预算, 不转发图片
+            self.flood.count(gcode, "images_skipped", len(infos))
+            placeholders = [u"[图片]"] * len(infos)
+            infos = []
+        item = [None, time.time(), trace]
+        self._group_queues.setdefault(gcode, deque()).append(item)
+        def rendered(urls):
+            if trace is not None:
+                trace.span("image")
+            content = self.handle_qq_group_contents(gcode, uin, contents,
+                                                    urls + placeholders)
+            uname = self.webqq.get_group_member_nick(gcode, uin)
+            item[0] = u"<{0}> {1}".format(uname, content)
+            if trace is not None:
+                trace.span("render")
+            self._flush_group(gcode)
+        self.get_group_msg_imgs(gcode, uin, infos, rendered)
+
+    def _summarize(self, gcode):
+        """ 将该群被丢弃的消息数作为一条消息按顺序发送 """
+        timer = self._summary_timers.pop(gcode, None)
+        if timer is not None:
+            timer.cancel()
+        skipped = self.flood.take_skipped(gcode)
+        if skipped:
+            self._group_queues.setdefault(gcode, deque()).append(
+                [u"(消息太多, 略过了{0}条)".format(skipped), None, None])
+            self._flush_group(gcode)
+
+    def _flush_group(self, gcode):
+        """ 按顺序发送该群已经渲染好的消息, 群的数据就绪之前先缓存 """
+        if gcode not in self._live_groups:
+            return
+        queue = self._group_queues.get(gcode)
+        tos = self.routes.to_xmpp(gcode)
+        rooms = self.routes.to_muc(gcode)
+        while queue and queue[0][0] is not None:
+            body, received, trace = queue.popleft()
+            on_written = None
+            if trace is not None:
+                trace.span("enqueue")
+                on_written = partial(trace.finish, "write")
+            for to in tos:
+                self.qxbot.send_msg(to, body, on_written)
+            for room in rooms:
+                self.qxbot.send_groupchat(room, body, on_written)
+            if received is not None and (tos or rooms):
+                self.bridged.inc(("qq_to_xmpp", self.group_label(gcode)))
+                self.latency.observe(time.time() - received, ("qq_to_xmpp",))
+        if not queue:
+            self._group_queues.pop(gcode, None)
+
+    def dispatch_qq(self, qq_source, timing = None):
+        """ 各群的消息轮流处理, 一个群的大量消息不会阻塞其他群 """
         if qq_source.get("retcode") == 0:
-            messages = qq_source.get("result")
-            for m in messages:
+            groups = OrderedDict()
+            for m in qq_source.get("result"):
                 if m.get("poll_type") == "group_message":
-                    self.handle_qq_group_msg(m)
+                    gcode = m.get("value", {}).get("group_code")
+                    groups.setdefault(gcode, deque()).append(m)
+            while groups:
+                for gcode, queue in groups.items():
+                    self.handle_qq_group_msg(queue.popleft(), timing)
+                    if not queue:
+                        del groups[gcode]
+
+    def spool_xmpp(self, stanza):
+        """ QQ未就绪或仍有缓存未重放时, 将XMPP消息写入磁盘缓存 """
+        if not stanza.body:
+            return
+        self.qxbot.spool.append({"from": stanza.from_jid.as_unicode(),
+                                 "type": stanza.stanza_type,
+                                 "body": stanza.body})
+        if self.webqq.connected:
+            self.schedule_replay()
 
-    def dispatch_xmpp(self, stanza):
+    def schedule_replay(self):
+        if self._replay_timer is None and len(self.qxbot.spool):
+            self._replay_timer = self.webqq.mainloop.call_later(0,
+                                                    self._replay_spool)
+
+    def _replay_spool(self):
+        """ 按QQ发送队列的空闲程度分批重放缓存的消息 """
+        self._replay_timer = None
+        spool = self.qxbot.spool
+        room = self.replay_batch - self.webqq.send_pending
+        if room > 0 and not self.qxbot.flow.blocked("qq"):
+            for record in spool.pop(room):
+                self.dispatch_xmpp(Message(from_jid = JID(record["from"]),
+                                           stanza_type = record["type"],
+                                           body = record["body"]),
+                                   record.get("t"))
+        if self.qxbot.flow.blocked("qq"):
+            pass        # 发送队列降到低水位后由flow control重新调度
+        elif len(spool):
+            self._replay_timer = self.webqq.mainloop.call_later(
+                self.webqq.send_interval, self._replay_spool)
+        else:
+            self.logger.info(u"Spooled XMPP messages replayed, {0} dropped, "
+                             u"{1} expired".format(spool.dropped,
+                                                   spool.expired))
+
+    def dispatch_xmpp(self, stanza, received = None):
+        """ `received` 为收到消息的时间, 从磁盘缓存重放时为写入缓存的时间 """
         body = stanza.body
+        if not body:
+            return
+        if received is None:
+            received = time.time()
+        trace = self.qxbot.tracer.start("xmpp_to_qq", received)
+        if trace is not None:
+            trace.span("receive")   # 从磁盘缓存重放时包括缓存的时间
+        nick = None
+        if self.routes.is_muc(stanza.from_jid):
+            nick = stanza.from_jid.resource
+            if stanza.stanza_type != "groupchat" or not nick or \
+               nick == self.qxbot.muc_nick:
+                return      # 私聊, 聊天室主题或自己发送的消息
+        tos = self.routes.to_qq(stanza.from_jid)
+        if trace is not None:
+            trace.span("lookup")
+        if nick is not None:
+            body = u"<{0}> {1}".format(nick, body)
         body = body.replace("\n", "\r")
         body = body.replace("\r\r", "\r")
-        frm = stanza.from_jid.bare().as_string()
-        tos = self.get_uin_account(frm)
-        [self.webqq.send_qq_group_msg(to, body) for to in tos]
+        if trace is not None:
+            trace.span("render")
+        for to in tos:
+            copy = None
+            if trace is not None:
+                copy = trace.copy(group = self.group_label(to))
+            self.webqq.send_qq_group_msg(to, body, received, copy)
+
+    def sent_to_qq(self, gcode, received):
+        """ 一条XMPP消息已成功发送到QQ群 """
+        self.bridged.inc(("xmpp_to_qq", self.group_label(gcode)))
+        if received is not None:
+            self.latency.observe(time.time() - received, ("xmpp_to_qq",))
 
 face_map = [
     (14, ":)"),
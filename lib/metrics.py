@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/19 14:37:05
+#   Desc    :   运行统计, 以Prometheus文本格式导出
+#
+import time
+import bisect
+from collections import OrderedDict
+
+from .utils import get_logger
+
+# 耗时(秒)的桶边界, 100微秒到10秒
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# 数量的桶边界
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+# 请求和端到端延迟(秒)的桶边界, 长轮询最长约一分钟
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Histogram(object):
+    """ 固定桶的直方图, `counts[i]` 为落在 (bounds[i-1], bounds[i]] 的数量,
+    最后一个桶为大于所有边界的值 """
+    __slots__ = ("bounds", "counts", "count", "sum", "max")
+
+    def __init__(self, bounds = TIME_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """ 第 `p` 百分位所在桶的上边界(估计值) """
+        if not self.count:
+            return 0
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+    def cumulative(self):
+        """ [(上边界, 累计数量)], 最后一项上边界为 inf """
+        result = []
+        seen = 0
+        for bound, n in zip(self.bounds + (float("inf"),), self.counts):
+            seen += n
+            result.append((bound, seen))
+        return result
+
+    def snapshot(self):
+        return {"count": self.count, "sum": self.sum, "max": self.max,
+                "p50": self.percentile(50), "p90": self.percentile(90),
+                "p99": self.percentile(99)}
+
+
+class HandlerStats(object):
+    """ 一个handler类的调用次数和耗时 """
+    __slots__ = ("read", "write")
+
+    def __init__(self):
+        self.read = Histogram()
+        self.write = Histogram()
+
+
+class LoopMetrics(object):
+    """ `EpollMainLoop` 的运行统计
+    每轮循环的耗时(不含epoll等待), epoll等待时间, 每轮处理的事件数,
+    定时器的延迟(实际调用时间 - 预定时间)和每个handler类的
+    handle_read/handle_write 耗时. 用 `time.time` 计时, 每次调用只多两次
+    函数调用. 由 `EpollMainLoop.metrics` 引用, 为None时不统计
+    """
+    def __init__(self, mainloop):
+        self.logger = get_logger("metrics")
+        self.mainloop = mainloop
+        self.started = time.time()
+        self.iterations = 0
+        self.iteration = Histogram()
+        self.wait = Histogram()
+        self.events = Histogram(COUNT_BUCKETS)
+        self.lag = Histogram()
+        self.handlers = {}          # handler类名 -> HandlerStats
+        self._timer = None
+
+    def handler_stats(self, handler):
+        name = handler.__class__.__name__
+        stats = self.handlers.get(name)
+        if stats is None:
+            stats = self.handlers[name] = HandlerStats()
+        return stats
+
+    def queue_depths(self):
+        """ mainloop中各队列当前的长度 """
+        mainloop = self.mainloop
+        event_queue = mainloop.event_queue
+        sizes = mainloop.queue_sizes()
+        return {"handlers": sizes["handlers"],
+                "timers": sizes["timers"],
+                "callbacks": sizes["callbacks"],
+                "events": event_queue.qsize() if event_queue else 0}
+
+    def snapshot(self):
+        handlers = {}
+        for name, stats in self.handlers.iteritems():
+            handlers[name] = {"read": stats.read.snapshot(),
+                              "write": stats.write.snapshot()}
+        return {"uptime": time.time() - self.started,
+                "iterations": self.iterations,
+                "iteration": self.iteration.snapshot(),
+                "wait": self.wait.snapshot(),
+                "events": self.events.snapshot(),
+                "lag": self.lag.snapshot(),
+                "queues": self.queue_depths(),
+                "handlers": handlers}
+
+    def format_report(self, request = None):
+        """ 文本报告, 也用作控制命令 """
+        def ms(value):
+            return u"{0:.2f}".format(value * 1000)
+        lines = [u"iterations {0}, queues {1}".format(
+                    self.iterations,
+                    u" ".join(u"{0}={1}".format(k, v) for k, v
+                              in sorted(self.queue_depths().items())))]
+        lines.append(u"{0:<28}{1:>10}{2:>10}{3:>10}{4:>10}{5:>12}".format(
+                     u"(ms)", u"count", u"p50", u"p99", u"max", u"total"))
+        rows = [(u"iteration", self.iteration), (u"epoll wait", self.wait),
+                (u"timer lag", self.lag)]
+        for name in sorted(self.handlers, key = lambda n: -(
+                    self.handlers[n].read.sum + self.handlers[n].write.sum)):
+            stats = self.handlers[name]
+            rows.append((name + u".read", stats.read))
+            rows.append((name + u".write", stats.write))
+        for name, hist in rows:
+            if not hist.count:
+                continue
+            lines.append(u"{0:<28}{1:>10}{2:>10}{3:>10}{4:>10}{5:>12}".format(
+                         name[:27], hist.count, ms(hist.percentile(50)),
+                         ms(hist.percentile(99)), ms(hist.max),
+                         ms(hist.sum)))
+        lines.append(u"events per iteration p50 {0}, p99 {1}, max {2}".format(
+                     self.events.percentile(50), self.events.percentile(99),
+                     self.events.max))
+        return u"\n".join(lines)
+
+    def start(self, interval):
+        """ 每 `interval` 秒将统计写入日志, 0表示不输出 """
+        if interval:
+            self._timer = self.mainloop.call_later(interval, self._export,
+                                                   interval)
+
+    def _export(self, interval):
+        self.logger.info(u"Loop metrics:\n{0}".format(self.format_report()))
+        self._timer = self.mainloop.call_later(interval, self._export,
+                                               interval)
+
+    def register(self, registry):
+        """ 将统计加入 `Registry` """
+        registry.counter("qxbot_loop_iterations_total", u"mainloop循环次数",
+                         source = lambda: self.iterations)
+        registry.histogram("qxbot_loop_iteration_seconds",
+                           u"每轮循环的耗时(不含epoll等待)",
+                           source = lambda: {(): self.iteration})
+        registry.histogram("qxbot_loop_wait_seconds", u"epoll等待时间",
+                           source = lambda: {(): self.wait})
+        registry.histogram("qxbot_loop_timer_lag_seconds", u"定时器的延迟",
+                           source = lambda: {(): self.lag})
+        registry.histogram("qxbot_loop_events", u"每轮处理的事件数",
+                           bounds = COUNT_BUCKETS,
+                           source = lambda: {(): self.events})
+        def handlers():
+            values = {}
+            for name, stats in self.handlers.iteritems():
+                for op in ("read", "write"):
+                    hist = getattr(stats, op)
+                    if hist.count:
+                        values[(name, op)] = hist
+            return values
+        registry.histogram("qxbot_loop_handler_seconds",
+                           u"各handler类handle_read/handle_write的耗时",
+                           ("handler", "op"), source = handlers)
+        registry.gauge("qxbot_loop_queue_depth", u"mainloop中各队列的长度",
+                       ("queue",), source = lambda: dict(
+                            ((k,), v) for k, v in self.queue_depths().items()))
+
+
+def _escape(value, quote = True):
+    if not isinstance(value, unicode):
+        value = str(value).decode("utf-8", "replace")
+    value = value.replace(u"\\", u"\\\\").replace(u"\n", u"\\n")
+    if quote:
+        value = value.replace(u'"', u'\\"')
+    return value
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return u"+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return unicode(value)
+
+
+def _format_labels(names, values, extra = ()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return u""
+    return u"{" + u",".join(u'{0}="{1}"'.format(name, _escape(value))
+                            for name, value in pairs) + u"}"
+
+
+class Metric(object):
+    """ 一个指标族, `values` 为 {标签值元组: 值}
+    有 `source` 时导出时调用它取值, 可以返回字典或单个值(没有标签)
+    """
+    kind = "untyped"
+
+    def __init__(self, name, help, labels = (), source = None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.source = source
+        self.values = {}
+
+    def collect(self):
+        if self.source is None:
+            return self.values
+        values = self.source()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return values
+
+    def expose(self, lines):
+        lines.append(u"# HELP {0} {1}".format(self.name,
+                                             _escape(self.help, False)))
+        lines.append(u"# TYPE {0} {1}".format(self.name, self.kind))
+        for key, value in sorted(self.collect().iteritems()):
+            self.expose_value(lines, key, value)
+
+    def expose_value(self, lines, key, value):
+        lines.append(u"{0}{1} {2}".format(self.name,
+                                         _format_labels(self.labels, key),
+                                         _format_value(value)))
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, key = (), n = 1):
+        self.values[key] = self.values.get(key, 0) + n
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, key, value):
+        self.values[key] = value
+
+
+class HistogramMetric(Metric):
+    """ 值为 `Histogram` 的指标族 """
+    kind = "histogram"
+
+    def __init__(self, name, help, labels = (), source = None,
+                 bounds = TIME_BUCKETS):
+        Metric.__init__(self, name, help, labels, source)
+        self.bounds = bounds
+
+    def observe(self, value, key = ()):
+        hist = self.values.get(key)
+        if hist is None:
+            hist = self.values[key] = Histogram(self.bounds)
+        hist.observe(value)
+
+    def expose_value(self, lines, key, hist):
+        for bound, count in hist.cumulative():
+            lines.append(u"{0}_bucket{1} {2}".format(
+                self.name, _format_labels(self.labels, key,
+                                          [("le", _format_value(bound))]),
+                count))
+        labels = _format_labels(self.labels, key)
+        lines.append(u"{0}_sum{1} {2}".format(self.name, labels,
+                                              _format_value(hist.sum)))
+        lines.append(u"{0}_count{1} {2}".format(self.name, labels,
+                                                hist.count))
+
+
+class Registry(object):
+    """ 所有指标, `expose` 生成Prometheus文本格式(0.0.4)
+    计数在各组件中直接累加, 导出时只遍历已有的序列, 不会阻塞mainloop
+    """
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.logger = get_logger("metrics")
+        self.metrics = OrderedDict()
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels = (), source = None):
+        return self.add(Counter(name, help, labels, source))
+
+    def gauge(self, name, help, labels = (), source = None):
+        return self.add(Gauge(name, help, labels, source))
+
+    def histogram(self, name, help, labels = (), source = None,
+                  bounds = TIME_BUCKETS):
+        return self.add(HistogramMetric(name, help, labels, source, bounds))
+
+    def quantiles(self, name, help, histogram, percentiles = (50, 90, 99)):
+        """ 由 `histogram` 估计的百分位数, 方便直接查看 """
+        def source():
+            values = {}
+            for key, hist in histogram.collect().iteritems():
+                for p in percentiles:
+                    values[key + (p / 100.0,)] = hist.percentile(p)
+            return values
+        return self.gauge(name, help, histogram.labels + ("quantile",),
+                          source)
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics.itervalues():
+            try:
+                metric.expose(lines)
+            except Exception:
+                self.logger.exception(u"Collect metric {0} failed"
+                                      .format(metric.name))
+        return u"\n".join(lines) + u"\n"
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/20 15:42:10
+#   Desc    :   运行时开关的性能分析
+#
+import os
+import time
+import signal
+import cProfile
+
+from .utils import get_logger
+
+SAMPLE = "sample"
+CPROFILE = "cprofile"
+
+
+class StackSampler(object):
+    """ 用ITIMER_PROF定时中断, 记录主线程(mainloop)当时的调用栈
+    按进程占用的CPU时间计时, 空闲时几乎没有开销. 结果为collapsed stacks
+    格式, 每行 "外层;...;内层 次数", 可直接交给flamegraph.pl或speedscope
+    """
+    def __init__(self, interval = 0.005):
+        self.interval = interval
+        self.samples = {}           # 由外到内的code对象元组 -> 次数
+        self.count = 0
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        # 被信号中断的系统调用自动重启, epoll.poll除外(mainloop已处理EINTR)
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        # 默认处理会结束进程, 忽略停止后才到达的信号
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        stack.reverse()
+        key = tuple(stack)
+        self.samples[key] = self.samples.get(key, 0) + 1
+        self.count += 1
+
+    @staticmethod
+    def _name(code):
+        return "{0} ({1}:{2})".format(code.co_name,
+                                      os.path.basename(code.co_filename),
+                                      code.co_firstlineno)
+
+    def dump(self, path):
+        names = {}
+        lines = {}
+        for stack, count in self.samples.iteritems():
+            for code in stack:
+                if code not in names:
+                    names[code] = self._name(code).replace(";", ":")
+            line = ";".join(names[code] for code in stack)
+            lines[line] = lines.get(line, 0) + count
+        with open(path, "w") as f:
+            for line in sorted(lines):
+                f.write("{0} {1}\n".format(line, lines[line]))
+
+
+class Profiler(object):
+    """ 不重启(重启需重新登录QQ)分析CPU占用, 由SIGUSR1或控制接口的profile
+    命令开关, 结束后把结果写入 `directory`
+    `sample`    统计采样, 开销小, 输出 .collapsed 火焰图数据
+    `cprofile`  用cProfile分析每轮 `loop_iteration`, 开销较大, 输出 .pstats
+    `max_seconds` 秒后自动停止
+    """
+    def __init__(self, mainloop, directory, interval = 0.005,
+                 max_seconds = 300):
+        self.logger = get_logger("profiler")
+        self.mainloop = mainloop
+        self.directory = directory
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.mode = None
+        self.started = None
+        self._sampler = None
+        self._timer = None
+
+    def install_signal(self):
+        """ 收到SIGUSR1时开始或停止采样 """
+        signal.signal(signal.SIGUSR1, lambda signum, frame:
+                      self.mainloop.add_callback(self.toggle))
+
+    def toggle(self, mode = SAMPLE):
+        if self.mode is None:
+            return self.start(mode)
+        return self.stop()
+
+    def start(self, mode = SAMPLE):
+        if self.mode is not None:
+            return u"{0} profiler already running".format(self.mode)
+        if mode == SAMPLE:
+            self._sampler = StackSampler(self.interval)
+            self._sampler.start()
+        elif mode == CPROFILE:
+            self.mainloop.profile = cProfile.Profile()
+        else:
+            return u"unknown profiler mode {0}".format(mode)
+        self.mode = mode
+        self.started = time.time()
+        if self.max_seconds:
+            self._timer = self.mainloop.call_later(self.max_seconds, self.stop)
+        self.logger.info(u"{0} profiler started".format(mode))
+        return u"{0} profiler started".format(mode)
+
+    def stop(self):
+        """ 停止并写入结果, 返回结果文件路径 """
+        if self.mode is None:
+            return u"profiler not running"
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        name = "qxbot-{0}-{1}".format(os.getpid(),
+                                      time.strftime("%Y%m%d-%H%M%S"))
+        duration = time.time() - self.started
+        mode, self.mode = self.mode, None
+        sampler, self._sampler = self._sampler, None
+        profile, self.mainloop.profile = self.mainloop.profile, None
+        if sampler is not None:
+            sampler.stop()
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            if mode == SAMPLE:
+                path = os.path.join(self.directory, name + ".collapsed")
+                sampler.dump(path)
+                detail = u"{0} samples".format(sampler.count)
+            else:
+                path = os.path.join(self.directory, name + ".pstats")
+                profile.dump_stats(path)
+                detail = u"cProfile stats"
+        except (IOError, OSError), err:
+            self.logger.warn(u"Write profile to {0} failed: {1}"
+                             .format(self.directory, err))
+            return u"write profile failed: {0}".format(err)
+        self.logger.info(u"{0} profiler stopped after {1:.1f}s, {2} written "
+                         u"to {3}".format(mode, duration, detail, path))
+        return path
+
+    def handle_command(self, request):
+        """ 控制命令: 未运行时开始(mode参数选择方式), 运行中时停止 """
+        return self.toggle(request.form.get("mode", SAMPLE))
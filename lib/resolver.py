@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/15 10:12:53
+#   Desc    :   带缓存的异步DNS解析
+#
+import time
+import socket
+
+from .utils import ThreadPool, get_logger
+
+
+def is_ip(host):
+    try:
+        socket.inet_aton(host)
+    except socket.error:
+        return False
+    return host.count(".") == 3
+
+
+class _Entry(object):
+    def __init__(self, addrs, expires):
+        self.addrs = addrs
+        self.expires = expires
+
+
+class Resolver(object):
+    """ 在线程池中执行getaddrinfo, 结果在mainloop中回调并按TTL缓存
+    缓存过期后先返回旧结果, 同时在后台刷新, 解析失败时继续使用旧结果
+    `ttl`           缓存时间(秒)
+    `error_ttl`     解析失败且没有旧结果时, 失败结果的缓存时间
+    `overrides`     静态映射 {host: ip}, 不经过解析
+    """
+    def __init__(self, mainloop, ttl = 300, error_ttl = 5, threads = 2,
+                 overrides = None):
+        self.logger = get_logger("resolver")
+        self.mainloop = mainloop
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.overrides = dict(overrides or {})
+        self._cache = {}            # host -> _Entry
+        self._errors = {}           # host -> (error, expires)
+        self._pending = {}          # host -> [callback]
+        self._inflight = set()
+        self._pool = ThreadPool(threads)
+        self._pool.start()
+
+    @property
+    def cached(self):
+        """ 缓存的解析结果数, 包括失败的 """
+        return len(self._cache) + len(self._errors)
+
+    def resolve(self, host, callback):
+        """ 以 (地址列表, 错误) 调用callback, 有缓存时同步调用 """
+        if host in self.overrides:
+            callback([self.overrides[host]], None)
+            return
+        if is_ip(host):
+            callback([host], None)
+            return
+        now = time.time()
+        entry = self._cache.get(host)
+        if entry is not None:
+            if entry.expires <= now:
+                self._lookup(host)
+            callback(list(entry.addrs), None)
+            return
+        error = self._errors.get(host)
+        if error is not None and error[1] > now:
+            callback([], error[0])
+            return
+        self._pending.setdefault(host, []).append(callback)
+        self._lookup(host)
+
+    def prefetch(self, hosts):
+        for host in hosts:
+            if host not in self._cache and not is_ip(host):
+                self._lookup(host)
+
+    def failed(self, host, addr):
+        """ 连接 `addr` 失败, 将其移到最后, 下次优先使用其他地址 """
+        entry = self._cache.get(host)
+        if entry is not None and addr in entry.addrs and len(entry.addrs) > 1:
+            entry.addrs.remove(addr)
+            entry.addrs.append(addr)
+
+    def _lookup(self, host):
+        if host in self._inflight:
+            return
+        self._inflight.add(host)
+        self._pool.add_job(self._worker, host)
+
+    def _worker(self, host):
+        """ 在线程池中执行 """
+        try:
+            infos = socket.getaddrinfo(host, None, socket.AF_INET,
+                                       socket.SOCK_STREAM)
+        except Exception, err:
+            # 不只是socket.error(如UnicodeError), 都要回调, 否则该域名
+            # 一直在 `_inflight` 中, 不会再解析
+            self.mainloop.add_callback(self._resolved, host, None, err)
+            return
+        addrs = []
+        for info in infos:
+            addr = info[4][0]
+            if addr not in addrs:
+                addrs.append(addr)
+        self.mainloop.add_callback(self._resolved, host, addrs, None)
+
+    def _resolved(self, host, addrs, err):
+        self._inflight.discard(host)
+        callbacks = self._pending.pop(host, [])
+        now = time.time()
+        entry = self._cache.get(host)
+        if addrs:
+            if entry is not None and set(entry.addrs) == set(addrs):
+                addrs = entry.addrs         # 保留failover的顺序
+            self._cache[host] = _Entry(addrs, now + self.ttl)
+            self._errors.pop(host, None)
+        elif entry is not None:
+            self.logger.warn(u"Resolve {0} failed: {1}, using cached "
+                             u"addresses".format(host, err))
+            entry.expires = now + self.error_ttl
+            addrs = entry.addrs
+        else:
+            self.logger.warn(u"Resolve {0} failed: {1}".format(host, err))
+            self._errors[host] = (err, now + self.error_ttl)
+        for callback in callbacks:
+            callback(list(addrs or []), None if addrs else err)
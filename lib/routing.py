@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/16 10:02:17
+#   Desc    :   QQ群与XMPP帐号的桥接路由表
+#
+from pyxmpp2.jid import JID
+
+BOTH = "both"           # 双向转发
+TO_XMPP = "qq2xmpp"     # 只将QQ群消息转发到XMPP
+TO_QQ = "xmpp2qq"       # 只将XMPP消息转发到QQ群
+DIRECTIONS = (BOTH, TO_XMPP, TO_QQ)
+
+
+def _as_tuple(value):
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(value)
+    return (value,)
+
+
+def parse_bridges(bridges):
+    """ 解析 `settings.BRIDGES`, 返回 [(群号元组, JID元组, 方向)]
+    每项为 (群号, XMPP帐号) 或 (群号, XMPP帐号, 方向),
+    群号和帐号都可以是列表, 表示多对多桥接. 格式错误时抛出ValueError
+    """
+    result = []
+    for row in bridges:
+        if not isinstance(row, (list, tuple)) or len(row) not in (2, 3):
+            raise ValueError(u"Invalid bridge: {0!r}".format(row))
+        direction = row[2] if len(row) == 3 else BOTH
+        if direction not in DIRECTIONS:
+            raise ValueError(u"Invalid bridge direction: {0!r}"
+                             .format(direction))
+        qids = tuple(int(qid) for qid in _as_tuple(row[0]))
+        jids = tuple(JID(jid).bare() for jid in _as_tuple(row[1]))
+        if not qids or not jids:
+            raise ValueError(u"Empty bridge: {0!r}".format(row))
+        result.append((qids, jids, direction))
+    return result
+
+
+class RoutingTable(object):
+    """ 预先计算的路由索引
+    群gcode -> (JID, ...), 群gcode -> (聊天室JID, ...) 和
+    裸JID(帐号或聊天室) -> (群gcode, ...), 每条消息O(1)查找
+    群号到gcode的映射或桥接配置变化时调用 `rebuild`/`set_bridges`,
+    新索引构造完毕后一次性替换
+    `rooms` 格式与 `bridges` 相同, XMPP一侧为MUC聊天室
+    """
+    def __init__(self, bridges, rooms = ()):
+        self.bridges = parse_bridges(bridges)
+        self.rooms = parse_bridges(rooms)
+        self.qid_gcode_map = {}
+        self._index = ({}, {}, {}, frozenset())
+
+    def set_bridges(self, bridges, rooms = None):
+        """ 更新桥接配置, 格式错误时抛出ValueError且不做任何修改 """
+        bridges = parse_bridges(bridges)
+        if rooms is not None:
+            self.rooms = parse_bridges(rooms)
+        self.bridges = bridges
+        self.rebuild()
+
+    def rebuild(self, qid_gcode_map = None):
+        """ 以 {群号: gcode} 重建索引 """
+        if qid_gcode_map is not None:
+            self.qid_gcode_map = dict(qid_gcode_map)
+        to_xmpp = {}
+        to_muc = {}
+        to_qq = {}
+        for bridges, index in ((self.bridges, to_xmpp), (self.rooms, to_muc)):
+            for qids, jids, direction in bridges:
+                gcodes = [self.qid_gcode_map[qid] for qid in qids
+                          if qid in self.qid_gcode_map]
+                for gcode in gcodes:
+                    if direction != TO_QQ:
+                        targets = index.setdefault(gcode, [])
+                        targets.extend(j for j in jids if j not in targets)
+                if direction != TO_XMPP:
+                    for jid in jids:
+                        targets = to_qq.setdefault(jid, [])
+                        targets.extend(g for g in gcodes if g not in targets)
+        self._index = (dict((k, tuple(v)) for k, v in to_xmpp.iteritems()),
+                       dict((k, tuple(v)) for k, v in to_qq.iteritems()
+                            if v),
+                       dict((k, tuple(v)) for k, v in to_muc.iteritems()),
+                       frozenset(self.muc_rooms()))
+
+    def to_xmpp(self, gcode):
+        """ 群消息要转发到的JID """
+        return self._index[0].get(gcode, ())
+
+    def to_muc(self, gcode):
+        """ 群消息要转发到的聊天室 """
+        return self._index[2].get(gcode, ())
+
+    def muc_rooms(self):
+        """ 所有配置的聊天室JID """
+        return set(jid for _, jids, _ in self.rooms for jid in jids)
+
+    def is_muc(self, jid):
+        return jid.bare() in self._index[3]
+
+    def to_qq(self, jid):
+        """ 该XMPP帐号的消息要转发到的群gcode """
+        if not isinstance(jid, JID):
+            jid = JID(jid)
+        return self._index[1].get(jid.bare(), ())
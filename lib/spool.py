@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/17 15:08:52
+#   Desc    :   有界的磁盘消息缓存
+#
+import os
+import json
+import time
+
+from .utils import get_logger
+
+DROP_OLDEST = "drop-oldest"     # 超出上限时删除最旧的段
+DROP_NEWEST = "drop-newest"     # 超出上限时丢弃新消息
+
+
+class MessageSpool(object):
+    """ 追加写入的段文件, 每行一条JSON记录, 进程崩溃后可以继续读取
+    `root` 目录下为 <序号>.seg 段文件和记录读取位置的 offset 文件
+    `max_bytes`     所有段的总大小上限, 超出时按 `policy` 丢弃
+    `max_age`       记录的有效期(秒), 读取时跳过过期的记录
+    `segment_bytes` 单个段文件的大小, 超过后写入新的段
+    """
+    def __init__(self, root, max_bytes = 10 * 1024 * 1024, max_age = 3600,
+                 policy = DROP_OLDEST, segment_bytes = 1024 * 1024):
+        if policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(u"Invalid spool policy: {0!r}".format(policy))
+        self.logger = get_logger("spool")
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.policy = policy
+        # 至少分成几个段, 才能按段丢弃最旧的消息
+        self.segment_bytes = max(min(segment_bytes, max_bytes // 4), 1)
+        self.dropped = 0
+        self.expired = 0
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self._segments = sorted(int(name[:-4]) for name in os.listdir(root)
+                                if name.endswith(".seg")
+                                and name[:-4].isdigit())
+        self._sizes = dict((seq, self._truncate_partial(seq))
+                           for seq in self._segments)
+        self._wfile = None
+        self._read_seq, self._read_pos = self._load_offset()
+        self._pending = 0
+        self._count_pending()
+
+    def _path(self, seq):
+        return os.path.join(self.root, "{0:08d}.seg".format(seq))
+
+    def _truncate_partial(self, seq):
+        """ 崩溃时写了一半的最后一行不完整, 之后也不会再写入该段,
+        截掉这一行, 否则 `pop` 停在这里, 缓存永远不会读完. 返回段的大小 """
+        with open(self._path(seq), "rb+") as f:
+            data = f.read()
+            if not data or data.endswith("\n"):
+                return len(data)
+            end = data.rfind("\n") + 1
+            f.truncate(end)
+        self.logger.warn(u"Spool segment {0} ends with an incomplete record, "
+                         u"truncated {1} bytes".format(seq, len(data) - end))
+        return end
+
+    def _load_offset(self):
+        try:
+            with open(os.path.join(self.root, "offset")) as f:
+                seq, pos = f.read().split()
+                return int(seq), int(pos)
+        except (IOError, ValueError):
+            return (self._segments[0] if self._segments else 0), 0
+
+    def _save_offset(self):
+        path = os.path.join(self.root, "offset")
+        with open(path + ".tmp", "w") as f:
+            f.write("{0} {1}".format(self._read_seq, self._read_pos))
+        os.rename(path + ".tmp", path)
+
+    def _count_pending(self):
+        for seq in self._segments:
+            with open(self._path(seq)) as f:
+                if seq == self._read_seq:
+                    f.seek(self._read_pos)
+                elif seq < self._read_seq:
+                    continue
+                self._pending += sum(1 for _ in f)
+
+    def __len__(self):
+        return self._pending
+
+    @property
+    def size(self):
+        return sum(self._sizes.itervalues())
+
+    def append(self, record):
+        """ 追加一条记录(可JSON序列化的dict), 被丢弃时返回False """
+        line = json.dumps(dict(record, t = time.time())) + "\n"
+        while self.size + len(line) > self.max_bytes:
+            if self.policy == DROP_NEWEST or len(self._segments) < 2:
+                self.dropped += 1
+                self.logger.warn(u"Spool full, drop message")
+                return False
+            self._drop_segment(self._segments[0])
+        if self._wfile is None or \
+           self._sizes[self._segments[-1]] + len(line) > self.segment_bytes:
+            self._new_segment()
+        self._wfile.write(line)
+        self._wfile.flush()
+        self._sizes[self._segments[-1]] += len(line)
+        self._pending += 1
+        return True
+
+    def _new_segment(self):
+        if self._wfile is not None:
+            self._wfile.close()
+        seq = self._segments[-1] + 1 if self._segments else self._read_seq
+        self._segments.append(seq)
+        self._sizes[seq] = 0
+        self._wfile = open(self._path(seq), "a")
+
+    def _drop_segment(self, seq):
+        with open(self._path(seq)) as f:
+            if seq == self._read_seq:
+                f.seek(self._read_pos)
+            lost = sum(1 for _ in f)
+        self.dropped += lost
+        self._pending -= lost
+        self.logger.warn(u"Spool full, drop {0} oldest messages".format(lost))
+        self._remove_segment(seq)
+
+    def _remove_segment(self, seq):
+        self._segments.remove(seq)
+        del self._sizes[seq]
+        os.unlink(self._path(seq))
+        if seq == self._read_seq:
+            self._read_seq = self._segments[0] if self._segments else seq + 1
+            self._read_pos = 0
+            self._save_offset()
+        if not self._segments and self._wfile is not None:
+            self._wfile.close()
+            self._wfile = None
+
+    def pop(self, count):
+        """ 按顺序取出最多 `count` 条未过期的记录 """
+        records = []
+        deadline = time.time() - self.max_age
+        while len(records) < count and self._segments:
+            seq = self._segments[0]
+            if seq != self._read_seq:
+                self._read_seq, self._read_pos = seq, 0
+            with open(self._path(seq)) as f:
+                f.seek(self._read_pos)
+                while len(records) < count:
+                    line = f.readline()
+                    if not line.endswith("\n"):
+                        break
+                    self._read_pos += len(line)
+                    self._pending -= 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get("t", 0) < deadline:
+                        self.expired += 1
+                        continue
+                    records.append(record)
+            if self._read_pos < self._sizes[seq] or seq == self._segments[-1]:
+                break       # 已取够, 或读到了正在写入的段的末尾
+            self._remove_segment(seq)
+        if not self._pending and self._segments:
+            # 全部读完, 清空段文件
+            for seq in list(self._segments):
+                self._remove_segment(seq)
+        self._save_offset()
+        return records
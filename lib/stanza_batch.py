@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/17 10:21:46
+#   Desc    :   合并XMPP stanza的写入
+#
+import fcntl
+import struct
+import termios
+
+from pyxmpp2.exceptions import PyXMPPIOError
+
+from .utils import get_logger
+
+
+class StanzaBatcher(object):
+    """ 在pyxmpp2的stream前缓存要发送的stanza, 合并为一次transport写入
+    一次分发(如一个poll2响应中的所有消息)中产生的stanza在下一轮mainloop
+    循环时写出, 缓存超过 `max_bytes` 时立即写出, 最多延迟 `max_delay` 秒
+    transport不支持时退化为逐条 `stream.send`
+    设置了 `stream_management` 时, 流未就绪(重连中)或还未加入聊天室时的
+    stanza交给它暂存, 写入的stanza记为待确认.
+    `send` 的 `on_written` 在写入transport后调用
+    """
+    def __init__(self, mainloop, client, max_bytes = 64 * 1024,
+                 max_delay = 0):
+        self.logger = get_logger("stanza_batch")
+        self.mainloop = mainloop
+        self.client = client
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.batches = 0
+        self.stanzas = 0
+        self._buf = []
+        self._size = 0
+        self._written = []         # 写出后要调用的on_written
+        self._serializer = None
+        self._timer = None
+        self.stream_management = None
+
+    def send(self, stanza, on_written = None):
+        sm = self.stream_management
+        if sm is not None and not sm.accepts(stanza):
+            sm.hold(stanza)
+            return
+        stream = self.client.stream
+        transport = getattr(stream, "transport", None)
+        serializer = getattr(transport, "_serializer", None)
+        if serializer is None or not hasattr(transport, "_write"):
+            self.flush()
+            stream.send(stanza)
+            if on_written is not None:
+                on_written()
+            return
+        if serializer is not self._serializer:
+            self._drop()    # 重新连接后旧的数据已无法发送
+            self._serializer = serializer
+        with transport.lock:
+            stream.fix_out_stanza(stanza)
+            data = serializer.emit_stanza(stanza.as_xml()).encode("utf-8")
+        self._buf.append(data)
+        self._size += len(data)
+        if on_written is not None:
+            self._written.append(on_written)
+        if sm is not None:
+            sm.sent(stanza)
+        if self._size >= self.max_bytes:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.mainloop.call_later(self.max_delay, self.flush)
+
+    @property
+    def pending(self):
+        """ 缓存中还未写出的stanza数 """
+        return len(self._buf)
+
+    def output_level(self):
+        """ 待发送的字节数: 缓存中的加上内核socket发送队列中的 """
+        level = self._size
+        sock = getattr(getattr(self.client.stream, "transport", None),
+                       "_socket", None)
+        if sock is not None:
+            try:
+                buf = fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, "\0" * 4)
+                level += struct.unpack("i", buf)[0]
+            except (IOError, OSError, ValueError):
+                pass
+        return level
+
+    def _drop(self):
+        if self._buf:
+            self.logger.warn(u"Drop %s unsent stanzas of a closed stream",
+                             len(self._buf))
+        self._buf = []
+        self._size = 0
+        self._written = []
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buf:
+            return
+        data = "".join(self._buf)
+        count = len(self._buf)
+        written = self._written
+        self._buf = []
+        self._size = 0
+        self._written = []
+        transport = getattr(self.client.stream, "transport", None)
+        if transport is None:
+            self.logger.warn(u"Drop %s unsent stanzas of a closed stream",
+                             count)
+            return
+        with transport.lock:
+            if getattr(transport, "_serializer", None) is not self._serializer:
+                self.logger.warn(u"Drop %s unsent stanzas of a closed "
+                                 u"stream", count)
+                return
+            try:
+                transport._write(data)
+            except PyXMPPIOError, err:
+                self.logger.warn(u"Write %s stanzas failed: %s", count, err)
+                return
+        self.batches += 1
+        self.stanzas += count
+        for callback in written:
+            callback()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/18 16:20:37
+#   Desc    :   XMPP流管理(XEP-0198): 确认, 计数和断线后恢复
+#
+from collections import deque
+
+from pyxmpp2.client import Client
+from pyxmpp2.binding import ResourceBindingHandler, FEATURE_BIND
+from pyxmpp2.streamtls import StreamTLSHandler
+from pyxmpp2.etree import ElementTree
+from pyxmpp2.interfaces import StreamFeatureHandler, StreamFeatureHandled
+from pyxmpp2.interfaces import EventHandler, event_handler
+from pyxmpp2.interfaces import stream_element_handler
+from pyxmpp2.mainloop.interfaces import TimeoutHandler, timeout_handler
+from pyxmpp2.streamevents import (StreamEvent, AuthorizedEvent,
+                                  DisconnectedEvent)
+
+from .utils import get_logger
+
+SM_NS = "urn:xmpp:sm:3"
+SM_QNP = "{%s}" % SM_NS
+FEATURE_SM = SM_QNP + "sm"
+STANZA_TAGS = ("{jabber:client}message", "{jabber:client}presence",
+               "{jabber:client}iq")
+
+
+class StreamResumedEvent(StreamEvent):
+    """ 断线后恢复了原来的XMPP会话, 不会再有AuthorizedEvent和名册 """
+    def __init__(self, jid, resent):
+        self.jid = jid
+        self.resent = resent
+
+    def __unicode__(self):
+        return u"Stream resumed: {0}, {1} stanzas resent".format(self.jid,
+                                                                self.resent)
+
+
+class StreamManagement(StreamFeatureHandler, EventHandler, TimeoutHandler):
+    """ 客户端一侧的流管理
+    记录发出但服务器未确认的stanza, 断线重连后先尝试 <resume/> 恢复会话,
+    只重发未确认的部分; 服务器不支持或会话已过期时重新绑定资源, 重发全部
+    未确认的stanza(可能重复). 未就绪期间要发送的stanza用 `hold` 暂存
+    新会话中还未重新加入聊天室, groupchat stanza一直暂存到 `release_groupchat`
+    `ack_every`     发出多少条后请求一次确认, 另外每5秒检查一次
+    `max_unacked`   未确认及暂存stanza的上限, 超出后丢弃最旧的
+    """
+    def __init__(self, ack_every = 5, max_unacked = 1000):
+        self.logger = get_logger("stream_management")
+        self.ack_every = ack_every
+        self.max_unacked = max_unacked
+        self.binding = None         # 恢复失败时用于重新绑定资源
+        self.ready = False          # 当前流可以发送stanza
+        self.enabled = False        # 服务器已启用流管理, 计数收到的stanza
+        self.session_id = None      # 可恢复的会话
+        self.rooms_joined = False   # 当前会话已加入聊天室
+        self.jid = None
+        self.inbound = 0            # 收到的stanza数(h)
+        self.acked = 0              # 服务器确认的数量
+        self.resumes = 0
+        self.resent = 0
+        self.dropped = 0
+        self._unacked = deque()
+        self._held = deque()
+        self._held_groupchat = deque()
+        self._requested = 0         # 请求确认时未确认的数量
+        self._resuming = False
+        self._stream = None         # 正在计数发出stanza的流
+
+    def handle_stream_features(self, stream, features):
+        """ 认证后的features, 有可恢复的会话时用 <resume/> 代替资源绑定 """
+        if features.find(FEATURE_BIND) is None or \
+           features.find(FEATURE_SM) is None or self.session_id is None:
+            return None
+        element = ElementTree.Element(SM_QNP + "resume",
+                                      h = str(self.inbound),
+                                      previd = self.session_id)
+        stream.write_element(element)
+        self._resuming = True
+        self.logger.info(u"Resuming XMPP session {0}".format(self.session_id))
+        return StreamFeatureHandled("Stream resumption", mandatory = True)
+
+    @event_handler(AuthorizedEvent)
+    def handle_authorized(self, event):
+        """ 新会话: 启用流管理, 重发上一个会话未确认的stanza """
+        stream = event.stream
+        self.jid = stream.me
+        self.session_id = None
+        self.rooms_joined = False
+        self.inbound = 0
+        self.acked = 0
+        pending = list(self._unacked)
+        self._unacked.clear()
+        if stream.features is not None and \
+           stream.features.find(FEATURE_SM) is not None:
+            stream.write_element(ElementTree.Element(SM_QNP + "enable",
+                                                     resume = "true"))
+            self._track(stream)
+        if pending:
+            self.logger.warn(u"XMPP session lost, resend {0} unacked stanzas"
+                             .format(len(pending)))
+        self._ready(stream, pending)
+
+    @event_handler(DisconnectedEvent)
+    def handle_disconnected(self, event):
+        if self.ready:
+            self.logger.info(u"XMPP stream lost, {0} stanzas unacked"
+                             .format(len(self._unacked)))
+        self.ready = False
+        self.enabled = False
+        self._stream = None
+        self._resuming = False
+
+    def _track(self, stream):
+        """ 记录之后 `stream` 发出的stanza """
+        orig_send = stream._send
+
+        def _send(stanza):
+            orig_send(stanza)
+            self.sent(stanza)
+
+        stream._send = _send
+        self._stream = stream
+        self._requested = 0
+
+    def _ready(self, stream, pending):
+        self.ready = True
+        pending.extend(self._held)
+        self._held.clear()
+        for stanza in pending:
+            if self.accepts(stanza):
+                stream.send(stanza)
+                self.resent += 1
+            else:
+                self._hold(self._held_groupchat, stanza)
+
+    def accepts(self, stanza):
+        """ 现在能否发送 `stanza`, 否则应交给 `hold` """
+        return self.ready and (self.rooms_joined or
+                               stanza.stanza_type != "groupchat")
+
+    def sent(self, stanza):
+        """ 一条stanza已写入当前流 """
+        if self._stream is None:
+            return
+        self._unacked.append(stanza)
+        if len(self._unacked) > self.max_unacked:
+            # 丢掉的stanza视为已确认, 保持与服务器计数的对应
+            self._unacked.popleft()
+            self.acked = (self.acked + 1) % 2 ** 32
+            self.dropped += 1
+        if len(self._unacked) - self._requested >= self.ack_every:
+            self.request_ack()
+
+    def hold(self, stanza):
+        """ 暂存stanza, 流就绪后发送, groupchat在加入聊天室后发送 """
+        if self.ready:
+            self._hold(self._held_groupchat, stanza)
+        else:
+            self._hold(self._held, stanza)
+
+    def _hold(self, queue, stanza):
+        queue.append(stanza)
+        if len(queue) > self.max_unacked:
+            queue.popleft()
+            self.dropped += 1
+
+    def release_groupchat(self):
+        """ 已发出加入聊天室的presence, 返回暂存的groupchat stanza,
+        由调用方在presence之后发送 """
+        self.rooms_joined = True
+        stanzas = list(self._held_groupchat)
+        self._held_groupchat.clear()
+        self.resent += len(stanzas)
+        return stanzas
+
+    @property
+    def unacked(self):
+        return len(self._unacked)
+
+    @property
+    def held(self):
+        return len(self._held) + len(self._held_groupchat)
+
+    def request_ack(self):
+        if self._stream is None or not self._unacked:
+            return
+        self._requested = len(self._unacked)
+        self._stream.write_element(ElementTree.Element(SM_QNP + "r"))
+
+    @timeout_handler(5, True)
+    def check_unacked(self):
+        if len(self._unacked) > self._requested:
+            self.request_ack()
+        return 5
+
+    def _ack(self, h):
+        """ 服务器确认收到了 `h` 条, 丢掉已确认的stanza """
+        count = (h - self.acked) % 2 ** 32
+        if count > len(self._unacked):
+            self.logger.warn(u"Server acked {0} stanzas, only {1} unacked"
+                             .format(count, len(self._unacked)))
+            count = len(self._unacked)
+        for _ in xrange(count):
+            self._unacked.popleft()
+        self.acked = h
+        self._requested = max(self._requested - count, 0)
+
+    @stream_element_handler(SM_QNP + "enabled", "initiator")
+    def handle_enabled(self, stream, element):
+        self.enabled = True
+        if element.get("resume") in ("true", "1"):
+            self.session_id = element.get("id")
+        self.logger.info(u"XMPP stream management enabled, resumable: {0}"
+                         .format(self.session_id is not None))
+        return True
+
+    @stream_element_handler(SM_QNP + "r", "initiator")
+    def handle_request(self, stream, element):
+        stream.write_element(ElementTree.Element(SM_QNP + "a",
+                                                 h = str(self.inbound)))
+        return True
+
+    @stream_element_handler(SM_QNP + "a", "initiator")
+    def handle_ack(self, stream, element):
+        self._ack(int(element.get("h", 0)))
+        return True
+
+    @stream_element_handler(SM_QNP + "resumed", "initiator")
+    def handle_resumed(self, stream, element):
+        self._resuming = False
+        self._ack(int(element.get("h", 0)))
+        stream.me = self.jid
+        pending = list(self._unacked)
+        self._unacked.clear()
+        self._track(stream)
+        self.enabled = True
+        self.resumes += 1
+        self.logger.info(u"XMPP session resumed, resend {0} unacked stanzas"
+                         .format(len(pending)))
+        self._ready(stream, pending)
+        stream.event(StreamResumedEvent(self.jid, len(pending)))
+        return True
+
+    @stream_element_handler(SM_QNP + "failed", "initiator")
+    def handle_failed(self, stream, element):
+        self.session_id = None
+        if not self._resuming:
+            self.logger.warn(u"Enable XMPP stream management failed")
+            return True
+        self._resuming = False
+        self.logger.warn(u"Resume XMPP session failed, bind a new session")
+        self.binding.bind(stream, stream.settings["resource"])
+        return True
+
+    def _count_inbound(self):
+        if self.enabled:
+            self.inbound = (self.inbound + 1) % 2 ** 32
+        return False    # 继续按stanza处理
+
+    @stream_element_handler(STANZA_TAGS[0], "initiator")
+    def handle_message(self, stream, element):
+        return self._count_inbound()
+
+    @stream_element_handler(STANZA_TAGS[1], "initiator")
+    def handle_presence(self, stream, element):
+        return self._count_inbound()
+
+    @stream_element_handler(STANZA_TAGS[2], "initiator")
+    def handle_iq(self, stream, element):
+        return self._count_inbound()
+
+
+class ManagedClient(Client):
+    """ 在资源绑定之前加入流管理的 `Client`, 可以多次 `connect` """
+    def __init__(self, jid, handlers, settings = None, main_loop = None,
+                 stream_management = None):
+        if stream_management is None:
+            stream_management = StreamManagement()
+        self.stream_management = stream_management
+        Client.__init__(self, jid, handlers, settings, main_loop)
+
+    def base_handlers_factory(self):
+        handlers = Client.base_handlers_factory(self)
+        for i, handler in enumerate(handlers):
+            if isinstance(handler, ResourceBindingHandler):
+                self.stream_management.binding = handler
+                handlers.insert(i, self.stream_management)
+                break
+        return handlers
+
+    def connect(self):
+        for handler in self._base_handlers:
+            if isinstance(handler, StreamTLSHandler):
+                # 只能处理一个流, 重连前重置
+                handler.stream = None
+                handler.requested = False
+                handler.tls_socket = None
+        Client.connect(self)
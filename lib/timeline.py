@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/19 10:12:48
+#   Desc    :   启动过程的时间线
+#
+import json
+import time
+
+from .utils import get_logger, monotonic
+
+
+class Phase(object):
+    __slots__ = ("name", "start", "end", "retries", "bytes")
+
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.end = None
+        self.retries = 0
+        self.bytes = 0
+
+    def as_dict(self, origin):
+        duration = None if self.end is None else round(self.end - self.start,
+                                                       4)
+        return {"name": self.name, "start": round(self.start - origin, 4),
+                "end": None if self.end is None else round(self.end - origin,
+                                                           4),
+                "duration": duration, "retries": self.retries,
+                "bytes": self.bytes}
+
+
+class StartupTimeline(object):
+    """ 记录启动各阶段的单调时钟时间, 重试次数和传输的字节数
+    同名阶段只记录第一次 `start` 和第一次 `finish`, 上线(`go_live`)之后
+    不再记录, 用于比较各版本的冷启动耗时
+    """
+    def __init__(self, version = None):
+        self.logger = get_logger("timeline")
+        self.version = version
+        self.origin = monotonic()
+        self.started_at = time.time()
+        self.live_at = None
+        self.phases = {}
+
+    @property
+    def done(self):
+        return self.live_at is not None
+
+    def start(self, name):
+        if self.done or name in self.phases:
+            return
+        self.phases[name] = Phase(name, monotonic())
+
+    def add(self, name, retries = 0, bytes = 0):
+        """ 累加该阶段的重试次数和字节数 """
+        phase = self.phases.get(name)
+        if phase is None or self.done:
+            return
+        phase.retries += retries
+        phase.bytes += bytes
+
+    def finish(self, name):
+        phase = self.phases.get(name)
+        if phase is None or phase.end is not None or self.done:
+            return
+        phase.end = monotonic()
+
+    def mark(self, name):
+        """ 记录一个瞬间, 如第一个群开始转发 """
+        self.start(name)
+        self.finish(name)
+
+    def go_live(self, path = None):
+        """ 启动完毕, 输出时间线, `path` 不为None时同时写入文件 """
+        if self.done:
+            return
+        self.mark("go_live")
+        self.live_at = monotonic()
+        report = self.report()
+        self.logger.info(u"Startup finished in {0:.3f}s: {1}"
+                         .format(report["total"], json.dumps(report)))
+        if path:
+            try:
+                with open(path, "w") as f:
+                    json.dump(report, f, indent = 2)
+            except IOError, err:
+                self.logger.warn(u"Write startup timeline to {0} failed: {1}"
+                                 .format(path, err))
+
+    def report(self):
+        now = self.live_at if self.live_at is not None else monotonic()
+        phases = sorted(self.phases.itervalues(), key = lambda p: p.start)
+        return {"version": self.version, "started_at": self.started_at,
+                "total": round(now - self.origin, 4), "live": self.done,
+                "phases": [p.as_dict(self.origin) for p in phases]}
+
+    def format_report(self, request = None):
+        """ 控制命令, 返回JSON """
+        return json.dumps(self.report(), indent = 2)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/20 10:05:32
+#   Desc    :   单条消息的转发过程追踪
+#
+import os
+import json
+import time
+import random
+
+from .utils import get_logger
+
+
+class Trace(object):
+    """ 一条消息的追踪, 各阶段依次进行, `span` 结束一个阶段,
+    其耗时为上一阶段结束到现在 """
+    __slots__ = ("tracer", "id", "direction", "start", "stamp", "spans",
+                 "tags", "done")
+
+    def __init__(self, tracer, direction, start = None, tags = None,
+                 id = None):
+        self.tracer = tracer
+        self.id = id or "{0:016x}".format(random.getrandbits(64))
+        self.direction = direction
+        self.start = time.time() if start is None else start
+        self.stamp = self.start
+        self.spans = []
+        self.tags = tags or {}
+        self.done = False
+
+    def span(self, name, end = None):
+        end = time.time() if end is None else end
+        self.spans.append((name, self.stamp, end))
+        self.stamp = end
+
+    def copy(self, **tags):
+        """ 同一条消息发往多个目标时, 每个目标一个追踪, id相同 """
+        trace = Trace(self.tracer, self.direction, self.start,
+                      dict(self.tags, **tags), self.id)
+        trace.stamp = self.stamp
+        trace.spans = list(self.spans)
+        return trace
+
+    def finish(self, name = None):
+        """ 以阶段 `name` 结束追踪, 多次调用时只有第一次有效 """
+        if self.done:
+            return
+        if name is not None:
+            self.span(name)
+        self.done = True
+        self.tracer.finish(self)
+
+    @property
+    def total(self):
+        return self.stamp - self.start
+
+    def as_dict(self):
+        record = {"id": self.id, "direction": self.direction,
+                  "start": round(self.start, 6), "total": round(self.total, 6),
+                  "spans": [{"name": name, "start": round(start - self.start,
+                                                          6),
+                             "duration": round(end - start, 6)}
+                            for name, start, end in self.spans]}
+        record.update(self.tags)
+        return record
+
+
+class Tracer(object):
+    """ 为每条转发的消息记录各阶段的耗时, 抽样写入JSON lines文件
+    `path`          输出文件, 为None时不追踪
+    `sample_rate`   写入的比例
+    `slow`          总耗时不少于此秒数的追踪总是写入, 便于找出延迟异常的消息
+    `max_bytes`     文件超过此大小后改名为 `path`.1 重新写入
+    """
+    def __init__(self, path = None, sample_rate = 0.01, slow = 5,
+                 max_bytes = 10 * 1024 * 1024):
+        self.logger = get_logger("tracing")
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow = slow
+        self.max_bytes = max_bytes
+        self.traced = 0
+        self.written = 0
+        self._file = None
+
+    def start(self, direction, start = None, **tags):
+        """ 开始追踪, 未启用时返回None """
+        if not self.path:
+            return None
+        self.traced += 1
+        return Trace(self, direction, start, tags)
+
+    def finish(self, trace):
+        if trace.total < self.slow and random.random() >= self.sample_rate:
+            return
+        self.write(trace.as_dict())
+
+    def write(self, record):
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a")
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            if self._file.tell() >= self.max_bytes:
+                self._file.close()
+                self._file = None
+                os.rename(self.path, self.path + ".1")
+        except (IOError, OSError), err:
+            self.logger.warn(u"Write trace to {0} failed: {1}"
+                             .format(self.path, err))
+            self._file = None
+            return
+        self.written += 1
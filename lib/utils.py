@@ -7,28 +7,18 @@
 #   Desc    :   工具类函数
 from __future__ import absolute_import, division
 
+import os
+import time
 import Queue
-import logging
+import ctypes
+import ctypes.util
 import threading
 import functools
-import urllib2, urllib, cookielib
 import mimetools
 import mimetypes
 import itertools
 
-
-def get_logger(name = None, level = logging.DEBUG):
-    if not name: name = 'qxbot'
-    logger = logging.getLogger(name)
-    hdl = logging.StreamHandler()
-    fmt = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
-    hdl.setFormatter(fmt)
-    handler = hdl
-    logger.handlers = []
-    logger.addHandler(handler)
-    logger.setLevel(level) # change to DEBUG for higher verbosity
-    logger.propagate = False
-    return logger
+from .log import get_logger   # 兼容原来的导入位置
 
 class Form(object):
     def __init__(self):
@@ -81,82 +71,67 @@ class Form(object):
         return '\r\n'.join(flattened)
 
 
-class HttpHelper(object):
-    def __init__(self, url = None, form = None, method = 'GET', jar = None):
-        self.logger = get_logger()
-        self._url = url
-        self._form = form
-        self._method = method
-        if jar is None:
-            self._cookie_file = r'/tmp/cookie.txt'
-            self._cookiejar = cookielib.MozillaCookieJar(self._cookie_file)
-        else:
-            self._cookiejar = jar
-        self.http_cookie = urllib2.HTTPCookieProcessor( self._cookiejar)
-        self._opener = urllib2.build_opener(self.http_cookie)
-        if url:
-            self.make_request()
-
-    def make_request(self):
-        self.request = urllib2.Request(self._url)
-        if isinstance(self._form, Form):
-            self.add_header("Content-Type", self._form.get_content_type())
-            self.add_header("Content-Length", len(str(self._form)))
-            self.request.add_data(str(self._form))
-        elif isinstance(self._form, (dict, list, tuple)):
-            params = urllib.urlencode(self._form)
-            if self._method == "GET":
-                url = "{0}?{1}".format(self._url, params)
-                self.request = urllib2.Request(url)
-            else:
-                self.request = urllib2.Request(self._url, params)
-                self.request.add_header("Content-Type",
-                                        "application/x-www-form-urlencoded")
-
-        self.request.add_header("Accept", "*/*")
-        self.request.add_header("Connection", "keep-alive")
-        self.request.add_header("Accept-Charset", "UTF-8,*;q=0.5")
-        self.request.add_header("Accept-Encoding", "gzip,deflate,sdch")
-        self.request.add_header("Accept-Language", "zh-CN,zh;q=0.8")
-        self.add_header("User-Agent", "Mozilla/5.0 (X11; Linux x86_64)"
-                        "AppleWebKit/537.11 (KHTML, like Gecko)"
-                        " Chrome/23.0.1271.97 Safari/537.11a")
-
-    @property
-    def cookie(self):
-        self._cookiejar.save()
-        return self._cookiejar._cookies
-
-    def add_header(self, key, val):
-        self.request.add_header(key, val)
-
-    def change(self, url, form = {}, method = 'GET'):
-        self._url = url
-        self._form = form
-        self._method = method
-        self.make_request()
-        return self
-
-    def open(self):
-        try:
-            params = dict(self._form)
-        except:
-            params = self._form
-        logbody = "{0} {1} params {2!r}".format(self._method, self._url, params)
-        self.logger.debug(logbody)
-        res = self._opener.open(self.request, timeout = 3)
-        return res
-
-def upload_file(filename, path):
-    """ 上传文件
-    - `path`      文件路径
+def _load_sendfile():
+    """ Python 2 没有os.sendfile, 通过ctypes调用libc的sendfile """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+        func = libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int,
+                     ctypes.POINTER(ctypes.c_long), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+    return func
+
+_sendfile = _load_sendfile()
+
+def sendfile(out_fd, in_fd, offset, count):
+    """ 从 `in_fd` 的 `offset` 处发送最多 `count` 字节到 `out_fd`
+    返回发送的字节数, 出错时抛出OSError(socket非阻塞时可能为EAGAIN)
+    libc不可用时退化为 lseek + read + write
     """
-    form = Form()
-    filename = filename.encode("utf-8")
-    form.add_file(fieldname='uploadfile', filename=filename,
-                    fileHandle=open(path))
-    helper = HttpHelper("http://paste.linuxzen.com", form)
-    return helper.open()
+    if _sendfile is None:
+        os.lseek(in_fd, offset, os.SEEK_SET)
+        data = os.read(in_fd, min(count, 65536))
+        if not data:
+            return 0
+        return os.write(out_fd, data)
+    off = ctypes.c_long(offset)
+    sent = _sendfile(out_fd, in_fd, ctypes.byref(off), count)
+    if sent < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return sent
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+CLOCK_MONOTONIC = 1
+
+def _load_clock_gettime():
+    """ Python 2 没有time.monotonic, 通过ctypes调用clock_gettime """
+    for name in ("c", "rt"):
+        try:
+            lib = ctypes.CDLL(ctypes.util.find_library(name),
+                              use_errno = True)
+            func = lib.clock_gettime
+        except (OSError, AttributeError):
+            continue
+        func.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        func.restype = ctypes.c_int
+        return func
+    return None
+
+_clock_gettime = _load_clock_gettime()
+
+def monotonic():
+    """ 单调时钟(秒), 不受系统时间调整影响, libc不可用时退化为time.time """
+    if _clock_gettime is None:
+        return time.time()
+    ts = _timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        return time.time()
+    return ts.tv_sec + ts.tv_nsec * 1e-9
 
 class ThreadPool(object):
     """ 线程池
@@ -181,12 +156,15 @@ class ThreadPool(object):
     def worker(self):
         """ 工作线程
             使用Queue阻塞
-            因为传入的函数已经做了相应的错误处理,
-            所以在此不做进一步错误处理
+            传入的函数应自行处理错误, 未处理的异常记录日志,
+            不结束工作线程
         """
         while True:
             func = self._jobs_queue.get()
-            func()
+            try:
+                func()
+            except Exception:
+                get_logger("utils").exception(u"Thread pool job failed")
 
     def start(self):
         """ 根据线程数启动工作线程 """
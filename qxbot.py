@@ -5,29 +5,76 @@
 #   E-mail  :   wh_linux@126.com
 #   Date    :   13/03/01 11:28:40
 #   Desc    :   cold
-import Queue
+import gc
+import socket
+from functools import partial
 
 from pyxmpp2.jid import JID
-from pyxmpp2.client import Client
 from pyxmpp2.message import Message
+from pyxmpp2.presence import Presence
+from pyxmpp2.etree import ElementTree
+from pyxmpp2.stanzapayload import XMLPayload
 from pyxmpp2.settings import XMPPSettings
+from pyxmpp2.exceptions import PyXMPPIOError, DNSError
 from pyxmpp2.interfaces import EventHandler, event_handler, QUIT
-from pyxmpp2.streamevents import DisconnectedEvent,ConnectedEvent
+from pyxmpp2.streamevents import (DisconnectedEvent, ConnectedEvent,
+                                  AuthorizedEvent)
 from pyxmpp2.interfaces import XMPPFeatureHandler
 from pyxmpp2.interfaces import presence_stanza_handler, message_stanza_handler
 from pyxmpp2.ext.version import VersionProvider
 from pyxmpp2.roster import RosterReceivedEvent
+from pyxmpp2.mainloop.interfaces import IOHandler
 
 from webqq import WebQQ
-from lib.utils import get_logger
+from webqq.handlers import WebQQHandler
+from lib.log import get_logger, setup_logging
 from lib.libepoll import EpollMainLoop
+from lib.httpd import HTTPServer, HTTPResponse
+from lib.control import ControlServer
+from lib.resolver import Resolver
+from lib.config import ConfigReloader
+from lib.stanza_batch import StanzaBatcher
+from lib.stream_management import (ManagedClient, StreamManagement,
+                                   StreamResumedEvent)
+from lib.spool import MessageSpool
+from lib.flowcontrol import FlowControl, FloodControl
+from lib.image_store import ImageStore
+from lib.timeline import StartupTimeline
+from lib.metrics import Registry
+from lib.tracing import Tracer
+from lib.profiler import Profiler
+from lib.memwatch import MemoryWatch, process_rss
 from lib.message_dispatch import MessageDispatch
 from settings import XMPP_ACCOUNT, XMPP_PASSWD, QQ, BRIDGES, QQ_PWD
+from settings import (HTTPD_HOST, HTTPD_PORT, IMAGE_STORE_PATH,
+                      IMAGE_BASE_URL, IMAGE_STORE_QUOTA, CONTROL_ADDRESS,
+                      DNS_TTL, CONN_ALERT_PER_ENDPOINT, CONN_ALERT_TOTAL,
+                      CONN_ALERT_UNTRACKED, MUC_ROOMS, MUC_NICK,
+                      XMPP_BATCH_BYTES, XMPP_BATCH_DELAY, SPOOL_PATH,
+                      SPOOL_MAX_BYTES, SPOOL_MAX_AGE, SPOOL_POLICY,
+                      QQ_SEND_INTERVAL, QQ_SEND_QUEUE_SIZE,
+                      XMPP_OUTPUT_HIGH, XMPP_OUTPUT_LOW, QQ_SEND_HIGH,
+                      QQ_SEND_LOW, FLOOD_RATE, FLOOD_BURST,
+                      FLOOD_DEGRADED_BURST, XMPP_SERVER, XMPP_PORT,
+                      XMPP_RECONNECT_MIN, XMPP_RECONNECT_MAX,
+                      XMPP_SM_ACK_EVERY, XMPP_SM_MAX_UNACKED,
+                      QQ_MEMBER_CONCURRENCY, STARTUP_TIMELINE_PATH,
+                      LOOP_METRICS, LOOP_METRICS_INTERVAL, METRICS_ADDRESS,
+                      TRACE_PATH, TRACE_SAMPLE_RATE, TRACE_SLOW, PROFILE_DIR,
+                      PROFILE_INTERVAL, PROFILE_MAX_SECONDS,
+                      MEMORY_CHECK_INTERVAL, MEMORY_GROWTH_FACTOR,
+                      MEMORY_GROWTH_MIN, MEMORY_RSS_LIMIT,
+                      MEMORY_REPORT_INTERVAL, MEMORY_TRACEMALLOC_FRAMES,
+                      LOG_LEVEL, LOG_LEVELS, LOG_FILE, LOG_FORMAT,
+                      LOG_THREADED, LOG_QUEUE_SIZE, LOG_RATE_INTERVAL,
+                      LOG_RATE_BURST, WEBQQ_SERVER, QQ_POLL_TIMEOUT,
+                      QQ_POLL_MAX_DELAY)
 
 __version__ = '0.0.1 alpha'
 
 USER = XMPP_ACCOUNT
 PASSWORD = XMPP_PASSWD
+MUC_NS = "http://jabber.org/protocol/muc"
 
 class QXBot(EventHandler, XMPPFeatureHandler):
     def __init__(self):
@@ -44,23 +91,251 @@ class QXBot(EventHandler, XMPPFeatureHandler):
                             })
 
         settings["password"] = PASSWORD
+        if XMPP_SERVER:
+            settings["server"] = XMPP_SERVER
+        settings["c2s_port"] = XMPP_PORT
         version_provider = VersionProvider(settings)
         event_queue = settings["event_queue"]
         self.connected = False
+        self.quitting = False
+        self.qq_started = False
+        self.reconnect_delay = XMPP_RECONNECT_MIN
+        self._reconnect_timer = None
         #self.mainloop = TornadoMainLoop(settings)
         self.mainloop = EpollMainLoop(settings)
-        self.client = Client(my_jid, [self, version_provider],
-                             settings, self.mainloop)
+        self.stream_management = StreamManagement(XMPP_SM_ACK_EVERY,
+                                                  XMPP_SM_MAX_UNACKED)
+        self.client = ManagedClient(my_jid, [self, version_provider],
+                                    settings, self.mainloop,
+                                    self.stream_management)
         self.logger = get_logger()
+        self.batcher = StanzaBatcher(self.mainloop, self.client,
+                                     XMPP_BATCH_BYTES, XMPP_BATCH_DELAY)
+        self.batcher.stream_management = self.stream_management
+        self.image_store = ImageStore(IMAGE_STORE_PATH, IMAGE_BASE_URL,
+                                      IMAGE_STORE_QUOTA)
+        self.httpd = HTTPServer(self.mainloop, (HTTPD_HOST, HTTPD_PORT))
+        self.httpd.route("/img/", partial(self.image_store.serve,
+                                          prefix = "/img/"))
+        self.control = ControlServer(self.mainloop, CONTROL_ADDRESS)
+        self.metrics = Registry()
+        self.tracer = Tracer(TRACE_PATH, TRACE_SAMPLE_RATE, TRACE_SLOW)
+        self.metrics_httpd = None
+        if METRICS_ADDRESS:
+            self.metrics_httpd = HTTPServer(self.mainloop, METRICS_ADDRESS)
+            self.metrics_httpd.route("/metrics", self.handle_metrics)
+        self.control.register("metrics",
+                              lambda request: self.metrics.expose(),
+                              u"Prometheus格式的统计")
+        connections = self.mainloop.connections
+        connections.per_endpoint_limit = CONN_ALERT_PER_ENDPOINT
+        connections.total_limit = CONN_ALERT_TOTAL
+        connections.untracked_limit = CONN_ALERT_UNTRACKED
+        self.control.register("connections",
+                              lambda request: connections.format_report(),
+                              u"打开的连接, 按端点统计数量和存活时间")
+        if not LOOP_METRICS:
+            self.mainloop.metrics = None
+        else:
+            self.control.register("loop", self.mainloop.metrics.format_report,
+                                  u"mainloop每轮耗时, 定时器延迟和各handler"
+                                  u"的耗时")
+            self.mainloop.metrics.register(self.metrics)
+        self.profiler = Profiler(self.mainloop, PROFILE_DIR, PROFILE_INTERVAL,
+                                 PROFILE_MAX_SECONDS)
+        self.control.register("profile", self.profiler.handle_command,
+                              u"开始/停止性能分析, mode=sample(默认, 火焰图)"
+                              u"或cprofile")
+        self.resolver = Resolver(self.mainloop, ttl = DNS_TTL)
+        self.timeline = StartupTimeline(__version__)
+        self.control.register("timeline", self.timeline.format_report,
+                              u"启动各阶段的耗时(JSON)")
         self.webqq = WebQQ(QQ, QQ_PWD, event_queue, self)
-        self.msg_dispatch = MessageDispatch(self, self.webqq, BRIDGES)
-        self.xmpp_msg_queue = Queue.Queue()
+        self.webqq.http_sock.set_server(WEBQQ_SERVER)
+        self.webqq.send_interval = QQ_SEND_INTERVAL
+        self.webqq.send_queue_size = QQ_SEND_QUEUE_SIZE
+        self.webqq.poll_timeout = QQ_POLL_TIMEOUT
+        self.webqq.poll_max_delay = QQ_POLL_MAX_DELAY
+        self.webqq.member_concurrency = QQ_MEMBER_CONCURRENCY
+        self.spool = MessageSpool(SPOOL_PATH, SPOOL_MAX_BYTES, SPOOL_MAX_AGE,
+                                  SPOOL_POLICY)
+        self.muc_nick = MUC_NICK
+        self.joined_rooms = set()
+        self.msg_dispatch = MessageDispatch(self, self.webqq, BRIDGES,
+                                            MUC_ROOMS)
+        self.msg_dispatch.flood = FloodControl(FLOOD_RATE, FLOOD_BURST,
+                                               FLOOD_DEGRADED_BURST)
+        self.control.register("flood",
+                              lambda request: self.msg_dispatch.flood.report(),
+                              u"各群消息的限流统计")
+        self.flow = FlowControl(self.mainloop)
+        self.flow.add("xmpp", self.batcher.output_level, XMPP_OUTPUT_HIGH,
+                      XMPP_OUTPUT_LOW, self.webqq.resume_poll)
+        self.flow.add("qq", lambda: self.webqq.send_pending, QQ_SEND_HIGH,
+                      QQ_SEND_LOW, self.msg_dispatch.schedule_replay)
+        self.config = ConfigReloader(self)
+        self.control.register("reload", self.config.reload,
+                              u"重新加载settings.py中的桥接配置")
+        self.memory = MemoryWatch(self.mainloop, MEMORY_CHECK_INTERVAL,
+                                  MEMORY_GROWTH_FACTOR, MEMORY_GROWTH_MIN,
+                                  MEMORY_RSS_LIMIT, MEMORY_REPORT_INTERVAL)
+        self.control.register("memory", self.memory.handle_command,
+                              u"各容器的大小, 带snapshot=1时返回与上一次快照"
+                              u"相比增长的对象")
+        self.watch_memory()
+        self.register_metrics()
+
+    def watch_memory(self):
+        """ 长时间运行时可能增长的容器 """
+        watch = self.memory.watch
+        mainloop = self.mainloop
+        webqq = self.webqq
+        dispatch = self.msg_dispatch
+        sm = self.stream_management
+        for name in ("handlers", "fds", "unprepared", "timers", "callbacks"):
+            watch("mainloop." + name,
+                  partial(lambda name: mainloop.queue_sizes()[name], name))
+        watch("mainloop.connections", lambda: len(mainloop.connections))
+        watch("handler objects", lambda: sum(
+            1 for obj in gc.get_objects()
+            if isinstance(obj, (IOHandler, WebQQHandler))))
+        watch("webqq.last_msg", lambda: len(webqq.last_msg))
+        watch("webqq.group_m_map", lambda: sum(
+            len(members) for members in webqq.group_m_map.itervalues()))
+        watch("webqq.send_pending", lambda: webqq.send_pending)
+        watch("webqq.events_pending", lambda: webqq.events_pending)
+        watch("webqq.http_client.idle",
+              lambda: webqq.http_client.idle_connections)
+        watch("msg_dispatch.uin_qid_map", lambda: len(dispatch.uin_qid_map))
+        watch("msg_dispatch.qid_uin_map", lambda: len(dispatch.qid_uin_map))
+        watch("msg_dispatch.queued", lambda: dispatch.queued)
+        watch("msg_dispatch.flood", lambda: len(dispatch.flood))
+        watch("stream_management.unacked", lambda: sm.unacked)
+        watch("stream_management.held", lambda: sm.held)
+        watch("batcher.pending", lambda: self.batcher.pending)
+        watch("resolver.cached", lambda: self.resolver.cached)
+        watch("image_store", lambda: len(self.image_store))
+        watch("spool", lambda: len(self.spool))
+
+    def register_metrics(self):
+        """ 导出各组件的状态, 转发和请求的计数由各组件自己记录 """
+        metrics = self.metrics
+        connections = self.mainloop.connections
+        sm = self.stream_management
+        metrics.gauge("qxbot_up", u"是否已连接", ("side",),
+                      lambda: {("xmpp",): int(self.connected),
+                               ("qq",): int(self.webqq.connected)})
+        metrics.gauge("qxbot_xmpp_reconnect_delay_seconds",
+                      u"XMPP断线后下次重连的等待时间(退避)",
+                      source = lambda: self.reconnect_delay)
+        metrics.gauge("qxbot_xmpp_unacked_stanzas",
+                      u"服务器未确认的stanza数", source = lambda: sm.unacked)
+        metrics.counter("qxbot_xmpp_stream_stanzas_total",
+                        u"流管理恢复的会话, 重发和丢弃的stanza数", ("kind",),
+                        lambda: {("resumes",): sm.resumes,
+                                 ("resent",): sm.resent,
+                                 ("dropped",): sm.dropped})
+        metrics.gauge("qxbot_queue_depth", u"待发送的数据", ("queue",),
+                      lambda: {("xmpp_output_bytes",):
+                                    self.batcher.output_level(),
+                               ("qq_send",): self.webqq.send_pending,
+                               ("spool",): len(self.spool)})
+        metrics.gauge("qxbot_backpressure_paused",
+                      u"流量控制是否处于暂停状态", ("queue",),
+                      lambda: dict(((name,), int(mark.paused)) for name, mark
+                                   in self.flow.marks.items()))
+        metrics.counter("qxbot_backpressure_pauses_total",
+                        u"流量控制暂停的次数", ("queue",),
+                        lambda: dict(((name,), mark.pauses) for name, mark
+                                     in self.flow.marks.items()))
+        metrics.gauge("qxbot_open_connections", u"打开的连接, 按端点",
+                      ("endpoint",),
+                      lambda: dict(((endpoint,), count) for endpoint, count,
+                                   _, _ in connections.report()))
+        metrics.counter("qxbot_connections_total", u"打开和关闭的连接数",
+                        ("event",),
+                        lambda: {("opened",): connections.opened_total,
+                                 ("closed",): connections.closed_total})
+        metrics.gauge("qxbot_process_fds", u"进程打开的文件描述符数",
+                      source = lambda: connections.process_fds() or 0)
+        metrics.counter("qxbot_cache_requests_total",
+                        u"缓存的命中次数: qid为uin到QQ号, image为图片存储",
+                        ("cache", "result"),
+                        lambda: {("qid", "hit"): self.msg_dispatch.qid_hits,
+                                 ("qid", "miss"): self.msg_dispatch.qid_misses,
+                                 ("image", "hit"): self.image_store.hits,
+                                 ("image", "miss"): self.image_store.misses})
+        metrics.gauge("qxbot_image_store_bytes", u"图片存储占用的空间",
+                      source = lambda: self.image_store.size)
+        def flood():
+            values = {}
+            dispatch = self.msg_dispatch
+            for gcode, counters in dispatch.flood.counters.iteritems():
+                for name, count in counters.iteritems():
+                    values[(dispatch.group_label(gcode), name)] = count
+            return values
+        metrics.counter("qxbot_flood_messages_total",
+                        u"各群消息的限流统计", ("group", "verdict"), flood)
+        metrics.gauge("qxbot_memory_items", u"最近一次检查时各容器的大小",
+                      ("container",),
+                      lambda: dict(((name,), size) for name, size
+                                   in self.memory.last.iteritems()))
+        metrics.gauge("qxbot_memory_rss_bytes", u"进程的常驻内存",
+                      source = lambda: process_rss() or 0)
+        metrics.counter("qxbot_memory_alerts_total", u"内存增长告警的次数",
+                        source = lambda: self.memory.alerts)
+
+    def handle_metrics(self, request):
+        return HTTPResponse(200, self.metrics.expose(),
+                            content_type = self.metrics.content_type)
 
     def run(self, timeout = None):
+        if self.httpd.sock is None:
+            self.httpd.start()
+            self.control.start()
+            if self.metrics_httpd is not None:
+                self.metrics_httpd.start()
+            self.config.install_signal()
+            self.profiler.install_signal()
+            self.mainloop.connections.start()
+            self.memory.start(MEMORY_TRACEMALLOC_FRAMES)
+            if self.mainloop.metrics is not None:
+                self.mainloop.metrics.start(LOOP_METRICS_INTERVAL)
+        if not self.qq_started:
+            # QQ登录和XMPP连接同时进行, XMPP就绪前的消息由流管理暂存
+            self.qq_started = True
+            self.webqq.run()
+        self.timeline.start("xmpp_connect")
+        self.client.connect()
+        while True:
+            try:
+                self.client.run(timeout)
+            except (socket.error, PyXMPPIOError, DNSError), err:
+                # 连接失败时transport直接抛出异常, 关闭后等待重连
+                self.logger.warn(u"XMPP connection error: {0}".format(err))
+                if self.client.stream is not None:
+                    self.client.close_stream()
+                self.schedule_reconnect()
+            else:
+                break
+
+    def schedule_reconnect(self):
+        """ 断线后按退避间隔重新连接XMPP, QQ会话不受影响 """
+        if self._reconnect_timer is not None or self.quitting:
+            return
+        self.logger.info(u"Reconnect XMPP in {0} seconds"
+                         .format(self.reconnect_delay))
+        self._reconnect_timer = self.mainloop.call_later(self.reconnect_delay,
+                                                         self._reconnect)
+        self.reconnect_delay = min(self.reconnect_delay * 2,
+                                   XMPP_RECONNECT_MAX)
+
+    def _reconnect(self):
+        self._reconnect_timer = None
         self.client.connect()
-        self.client.run(timeout)
 
     def disconnect(self):
+        self.quitting = True
         self.client.disconnect()
         while True:
             try:
@@ -102,26 +377,58 @@ class QXBot(EventHandler, XMPPFeatureHandler):
 
     @message_stanza_handler()
     def handle_message(self, stanza):
-        if self.webqq.connected:
+        if self.webqq.connected and not len(self.spool) and \
+           not self.flow.blocked("qq"):
             self.msg_dispatch.dispatch_xmpp(stanza)
         else:
-            self.xmpp_msg_queue.put(stanza)
+            self.msg_dispatch.spool_xmpp(stanza)
 
     @event_handler(DisconnectedEvent)
     def handle_disconnected(self, event):
-        return QUIT
+        if event.stream is not None and event.stream is not self.stream:
+            return
+        self.connected = False
+        if self.quitting:
+            return QUIT
+        self.schedule_reconnect()
+
+    @event_handler(StreamResumedEvent)
+    def handle_stream_resumed(self, event):
+        """ 恢复了原来的会话, 名册和聊天室都还在 """
+        self.connected = True
+        self.reconnect_delay = XMPP_RECONNECT_MIN
+        if not self.stream_management.rooms_joined:
+            # 原来的会话还没来得及加入聊天室
+            self.joined_rooms = set()
+            self.join_rooms()
 
     @event_handler(ConnectedEvent)
     def handle_connected(self, event):
-        pass
+        self.timeline.finish("xmpp_connect")
+        self.timeline.start("xmpp_auth")
+
+    @event_handler(AuthorizedEvent)
+    def handle_authorized(self, event):
+        self.timeline.finish("xmpp_auth")
+        self.timeline.start("xmpp_roster")
 
     @event_handler(RosterReceivedEvent)
     def handle_roster_received(self, event):
-        """ 此处代表xmpp已经连接
-        开始连接QQ, 先将检查是否需要验证码的handler加入到mainloop
+        """ 此处代表xmpp已经连接(QQ在启动时已开始登录)
+        重连后建立了新会话时需重新加入聊天室
         """
-        self.webqq.run()
+        self.timeline.finish("xmpp_roster")
         self.connected = True
+        self.reconnect_delay = XMPP_RECONNECT_MIN
+        self.joined_rooms = set()
+        self.join_rooms()
+        self.check_go_live()
+
+    def check_go_live(self):
+        """ XMPP和QQ都已就绪且所有群都开始转发时输出启动时间线 """
+        if self.connected and self.webqq.connected and \
+           self.msg_dispatch.all_live:
+            self.timeline.go_live(STARTUP_TIMELINE_PATH)
 
     @property
     def roster(self):
@@ -133,7 +440,7 @@ class QXBot(EventHandler, XMPPFeatureHandler):
 
     @event_handler()
     def handle_all(self, event):
-        self.logger.info(u"-- {0}".format(event))
+        self.logger.debug(u"-- %s", event)
 
     def make_message(self, to, typ, body):
         """ 构造消息
@@ -147,14 +454,42 @@ class QXBot(EventHandler, XMPPFeatureHandler):
                     body = body)
         return m
 
-    def send_msg(self, to, body):
+    def join_rooms(self):
+        """ 加入配置的聊天室, 离开已从配置中删除的聊天室 """
+        rooms = self.msg_dispatch.routes.muc_rooms()
+        for room in rooms - self.joined_rooms:
+            x = ElementTree.Element("{%s}x" % MUC_NS)
+            ElementTree.SubElement(x, "{%s}history" % MUC_NS, maxstanzas = "0")
+            presence = Presence(to_jid = JID(room.local, room.domain,
+                                             self.muc_nick))
+            presence.add_payload(XMLPayload(x))
+            self.batcher.send(presence)
+            self.logger.info(u"Join room {0}".format(room))
+        for room in self.joined_rooms - rooms:
+            self.batcher.send(Presence(to_jid = JID(room.local, room.domain,
+                                                    self.muc_nick),
+                                       stanza_type = "unavailable"))
+            self.logger.info(u"Leave room {0}".format(room))
+        self.joined_rooms = rooms
+        # 断线期间暂存的聊天室消息在加入聊天室之后发送
+        for stanza in self.stream_management.release_groupchat():
+            self.batcher.send(stanza)
+
+    def send_groupchat(self, room, body, on_written = None):
+        """ 向聊天室发送消息, `room` 为聊天室的 JID """
+        self.batcher.send(self.make_message(room, "groupchat", body),
+                          on_written)
+
+    def send_msg(self, to, body, on_written = None):
         if not isinstance(to, JID):
             to = JID(to)
         msg = self.make_message(to, 'chat', body)
-        self.stream.send(msg)
+        self.batcher.send(msg, on_written)
 
 
 def main():
+        setup_logging(LOG_LEVEL, LOG_LEVELS, LOG_FILE, LOG_FORMAT, LOG_THREADED,
+                      LOG_QUEUE_SIZE, LOG_RATE_INTERVAL, LOG_RATE_BURST)
         xmpp = QXBot()
         xmpp.run()
 
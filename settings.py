@@ -19,7 +19,138 @@ XMPP_ACCOUNT = "qxbot@vim-cn.com"
 
 XMPP_PASSWD = ""
 
-# 桥接的QQ群和XMPP帐号
+# XMPP服务器地址和端口, 为None时按XMPP帐号的域名查找SRV记录
+XMPP_SERVER = None
+XMPP_PORT = 5222
+
+# XMPP断线后重连的最短和最长间隔(秒), 每次失败后间隔加倍
+XMPP_RECONNECT_MIN = 1
+XMPP_RECONNECT_MAX = 60
+
+# XMPP流管理(XEP-0198): 发出多少条stanza后请求确认, 未确认stanza的上限
+XMPP_SM_ACK_EVERY = 5
+XMPP_SM_MAX_UNACKED = 1000
+
+# 桥接的QQ群和XMPP帐号: (群号, XMPP帐号[, 方向])
+# 群号和帐号都可以是列表(多对多), 方向为 "both"(默认), "qq2xmpp" 或 "xmpp2qq"
 BRIDGES = (
     (224241247, "clubot@vim-cn.com"),   # QQ 群 -> XMPP
 )
+
+# 内置HTTP服务, 用于提供转发的图片
+HTTPD_HOST = "0.0.0.0"
+HTTPD_PORT = 8000
+
+# 图片存储目录, 对外访问的地址和最大占用空间(字节)
+IMAGE_STORE_PATH = "/tmp/qxbot/images"
+IMAGE_BASE_URL = "http://127.0.0.1:8000/img/"
+IMAGE_STORE_QUOTA = 200 * 1024 * 1024
+
+# DNS解析结果的缓存时间(秒)
+DNS_TTL = 300
+
+# 本地控制接口, (host, port) 或 UNIX socket 路径, 如 "/tmp/qxbot.sock"
+CONTROL_ADDRESS = ("127.0.0.1", 8001)
+
+# 连接数告警阈值: 单个端点, 所有连接, 未记录的文件描述符(可能泄露)
+CONN_ALERT_PER_ENDPOINT = 20
+CONN_ALERT_TOTAL = 200
+CONN_ALERT_UNTRACKED = 50
+
+# 桥接到XMPP聊天室(MUC), 格式同BRIDGES: (群号, 聊天室[, 方向])
+# 每条QQ群消息只向聊天室发送一条groupchat消息, 而不是发给每个帐号
+MUC_ROOMS = (
+    # (224241247, "qxbot@conference.vim-cn.com"),
+)
+MUC_NICK = u"qxbot"
+
+# 合并XMPP消息的写入: 缓存达到多少字节时立即发送, 最多延迟多少秒
+XMPP_BATCH_BYTES = 64 * 1024
+XMPP_BATCH_DELAY = 0
+
+# QQ未就绪时收到的XMPP消息缓存到磁盘: 目录, 最大占用(字节), 有效期(秒),
+# 超出上限时的策略 "drop-oldest" 或 "drop-newest"
+SPOOL_PATH = "/tmp/qxbot/spool"
+SPOOL_MAX_BYTES = 10 * 1024 * 1024
+SPOOL_MAX_AGE = 3600
+SPOOL_POLICY = "drop-oldest"
+
+# WebQQ接口的地址, 为None时访问QQ的服务器. 设置为本地的
+# tools/webqq_standin.py (如 "http://127.0.0.1:8090") 用于测试和性能测试
+WEBQQ_SERVER = None
+
+# 发送QQ群消息的最小间隔(秒)和排队上限
+QQ_SEND_INTERVAL = 0.5
+QQ_SEND_QUEUE_SIZE = 200
+
+# poll2最长保持约一分钟, 超过此秒数没有响应视为连接中断, 重新轮询.
+# 连续失败时重新轮询的间隔从1秒起加倍, 最长QQ_POLL_MAX_DELAY秒
+QQ_POLL_TIMEOUT = 90
+QQ_POLL_MAX_DELAY = 30
+
+# 启动时同时获取群成员的请求数, 桥接的群优先获取
+QQ_MEMBER_CONCURRENCY = 4
+
+# 启动完毕时将各阶段的耗时(JSON)写入此文件, 为None时只写入日志
+# 也可以通过控制接口的timeline命令查看
+STARTUP_TIMELINE_PATH = None
+
+# 流量控制的高低水位: 待发送的XMPP数据(字节)超过高水位时暂停轮询QQ消息,
+# QQ发送队列超过高水位时XMPP消息先写入磁盘缓存, 降到低水位后恢复
+XMPP_OUTPUT_HIGH = 256 * 1024
+XMPP_OUTPUT_LOW = 64 * 1024
+QQ_SEND_HIGH = 50
+QQ_SEND_LOW = 10
+
+# 每个群的消息预算: 正常转发的速度(条/秒)和突发条数, 超出后还可以不带图片
+# 转发的条数, 之后的消息被丢弃并汇总为 "略过N条"
+FLOOD_RATE = 0.5
+FLOOD_BURST = 10
+FLOOD_DEGRADED_BURST = 20
+
+# 统计mainloop每轮的耗时, 定时器延迟和各handler的耗时,
+# 每隔多少秒写入日志(0为不写入), 可通过控制接口的loop命令查看
+LOOP_METRICS = True
+LOOP_METRICS_INTERVAL = 600
+
+# Prometheus格式的统计接口, (host, port) 或 UNIX socket 路径, 请求 /metrics
+# 为None时只能通过控制接口的metrics命令查看
+METRICS_ADDRESS = None
+
+# 追踪每条转发的消息经过各阶段(接收, 解析, 查找, 图片, 渲染, 排队, 写出)的
+# 耗时, 抽样写入此文件(JSON lines), 为None时不追踪. 总耗时超过TRACE_SLOW秒
+# 的消息总是写入
+TRACE_PATH = None
+TRACE_SAMPLE_RATE = 0.01
+TRACE_SLOW = 5
+
+# 性能分析: 收到SIGUSR1或控制接口的profile命令时开始, 再次触发时停止,
+# 结果写入此目录. 采样间隔(秒, 按CPU时间), 最长运行多少秒后自动停止
+PROFILE_DIR = "/tmp/qxbot/profile"
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 300
+
+# 内存统计: 每隔多少秒检查各容器的大小, 增长到第一次检查时的多少倍且至少
+# 多出多少项时告警; 进程RSS超过多少字节时告警(0为不检查); 每隔多少秒把
+# 各容器的大小写入日志(0为不写入). 有tracemalloc(pytracemalloc)时记录
+# 内存分配的调用栈层数(0为不记录), 通过控制接口的 memory?snapshot=1 比较
+MEMORY_CHECK_INTERVAL = 300
+MEMORY_GROWTH_FACTOR = 2
+MEMORY_GROWTH_MIN = 1000
+MEMORY_RSS_LIMIT = 512 * 1024 * 1024
+MEMORY_REPORT_INTERVAL = 3600
+MEMORY_TRACEMALLOC_FRAMES = 0
+
+# 日志: qxbot的级别, 按logger名单独设置的级别(如 {"qxbot.libepoll": "DEBUG",
+# "pyxmpp2": "WARNING"}), 写入的文件(为None时输出到stderr, logrotate移走后
+# 自动重新打开), 格式, 是否在后台线程中写入及队列长度(满时丢弃).
+# 同一条日志每LOG_RATE_INTERVAL秒最多输出LOG_RATE_BURST次, 0为不限流
+# 级别可以通过reload在线修改
+LOG_LEVEL = "INFO"
+LOG_LEVELS = {}
+LOG_FILE = None
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+LOG_THREADED = True
+LOG_QUEUE_SIZE = 10000
+LOG_RATE_INTERVAL = 60
+LOG_RATE_BURST = 5
@@ -0,0 +1,5 @@
+# -*- coding:utf-8 -*-
+# 测试中故意触发的告警不输出
+from lib.log import setup_logging
+
+setup_logging("CRITICAL")
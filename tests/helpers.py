@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/27 09:30:18
+#   Desc    :   测试共用的替身对象
+#
+from lib.libepoll import Timer
+
+
+class Stub(object):
+    """ 只保存属性的对象 """
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class FakeLoop(object):
+    """ 只记录定时器和回调, 由测试手动触发 """
+    def __init__(self):
+        self.timers = []
+        self.callbacks = []
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(delay, callback, args)
+        self.timers.append(timer)
+        return timer
+
+    def add_callback(self, callback, *args):
+        self.callbacks.append((callback, args))
+
+    def fire_timers(self):
+        timers, self.timers = self.timers, []
+        for timer in timers:
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+    def run_callbacks(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback, args in callbacks:
+            callback(*args)
+
+
+def make_webqq(mainloop = None, **attrs):
+    """ 不连接网络的WebQQ, `attrs` 覆盖qxbot上的属性 """
+    from lib.metrics import Registry
+    from lib.resolver import Resolver
+    from webqq.webqq import WebQQ
+    mainloop = mainloop or FakeLoop()
+    qxbot = Stub(mainloop = mainloop, metrics = Registry(),
+                 resolver = Resolver(mainloop, threads = 0),
+                 timeline = Stub(start = lambda name: None,
+                                 finish = lambda name: None,
+                                 mark = lambda name: None),
+                 control = Stub(register = lambda *args: None))
+    qxbot.__dict__.update(attrs)
+    return WebQQ(1685359365, "", None, qxbot)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/26 14:20:33
+#   Desc    :   ConfigReloader
+#
+import os
+import logging
+import tempfile
+import unittest
+
+from lib.log import set_levels
+from lib.config import ConfigReloader, RESTART_KEYS, LIVE_KEYS
+from lib.flowcontrol import FloodControl, FULL, DROP
+from tests.helpers import Stub
+
+SETTINGS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "settings.py")
+
+
+class ConfigReloaderTest(unittest.TestCase):
+    def make_qxbot(self):
+        bridges = []
+        marks = {"xmpp": Stub(), "qq": Stub()}
+        return Stub(
+            connected = False, bridges = bridges,
+            msg_dispatch = Stub(routes = Stub(set_bridges = lambda b, r:
+                                              bridges.append((b, r))),
+                                flood = FloodControl()),
+            mainloop = Stub(connections = Stub()), webqq = Stub(),
+            flow = Stub(marks = marks), spool = Stub(segment_bytes = 1024),
+            resolver = Stub(), image_store = Stub(), tracer = Stub(),
+            profiler = Stub(), memory = Stub(start = lambda: None),
+            batcher = Stub(), stream_management = Stub())
+
+    def test_every_setting_is_covered(self):
+        """ 每项配置要么重新加载时生效, 要么提示需要重启 """
+        reloader = ConfigReloader(self.make_qxbot(), SETTINGS)
+        names = set(name for name in dir(reloader.current)
+                    if name.isupper() and not name.startswith("_"))
+        self.assertEqual(set(RESTART_KEYS) & set(LIVE_KEYS), set())
+        self.assertEqual(names - set(RESTART_KEYS) - set(LIVE_KEYS), set())
+
+    def test_apply(self):
+        qxbot = self.make_qxbot()
+        reloader = ConfigReloader(qxbot, SETTINGS)
+        new = reloader.load()
+        new.QQ_SEND_INTERVAL = 2
+        new.FLOOD_RATE = 0
+        new.FLOOD_BURST = 1
+        new.FLOOD_DEGRADED_BURST = 0
+        flood = qxbot.msg_dispatch.flood
+        self.assertEqual(flood.admit("g1", "a"), FULL)
+        new.QQ_SEND_HIGH = 70
+        new.DNS_TTL = 11
+        new.LOG_LEVEL = "WARNING"
+        # apply修改全局的logger级别, 测试后恢复
+        self.addCleanup(set_levels, logging.getLogger("qxbot").level, {})
+        reloader.apply(reloader.validate(new))
+        self.assertEqual(qxbot.webqq.send_interval, 2)
+        # 已有令牌桶的群也按新的预算计算
+        self.assertEqual(flood.admit("g1", "b"), FULL)
+        self.assertEqual(flood.admit("g1", "c"), DROP)
+        self.assertEqual(flood.admit("g2", "a"), FULL)
+        self.assertEqual(flood.admit("g2", "b"), DROP)
+        self.assertEqual(qxbot.flow.marks["qq"].high, 70)
+        self.assertEqual(qxbot.resolver.ttl, 11)
+        self.assertEqual(len(qxbot.bridges), 1)
+        self.assertEqual(logging.getLogger("qxbot").level, logging.WARNING)
+
+    def write_settings(self, replace):
+        """ 把修改后的settings.py写到临时文件, 返回路径 """
+        with open(SETTINGS) as f:
+            source = f.read()
+        for old, new in replace:
+            self.assertTrue(old in source)
+            source = source.replace(old, new)
+        fd, path = tempfile.mkstemp(suffix = ".py")
+        with os.fdopen(fd, "w") as f:
+            f.write(source)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_reload_is_atomic(self):
+        """ 任何一项配置缺失或格式错误时不修改运行中的组件 """
+        qxbot = self.make_qxbot()
+        for replace in [[("QQ_SEND_INTERVAL = 0.5", "")],
+                        [("FLOOD_BURST = 10", "FLOOD_BURST = '10'")],
+                        [("LOG_LEVEL = \"INFO\"", "LOG_LEVEL = \"LOUD\"")],
+                        [("QQ_SEND_LOW = 10", "QQ_SEND_LOW = 100")],
+                        [("SPOOL_POLICY = \"drop-oldest\"",
+                          "SPOOL_POLICY = \"drop-all\"")]]:
+            reloader = ConfigReloader(qxbot, SETTINGS)
+            current = reloader.current
+            reloader.path = self.write_settings(replace)
+            result = reloader.reload()
+            self.assertTrue(result.startswith(u"reload failed"), result)
+            self.assertTrue(reloader.current is current)
+            self.assertEqual(qxbot.bridges, [])
+            self.assertFalse(hasattr(qxbot.webqq, "send_interval"))
+
+    def test_reload(self):
+        qxbot = self.make_qxbot()
+        reloader = ConfigReloader(qxbot, SETTINGS)
+        reloader.path = self.write_settings([
+            ("DNS_TTL = 300", "DNS_TTL = 30"),
+            ("LOG_LEVEL = \"INFO\"", "LOG_LEVEL = \"ERROR\"")])
+        self.addCleanup(set_levels, logging.getLogger("qxbot").level, {})
+        result = reloader.reload()
+        self.assertTrue(result.startswith(u"reloaded"), result)
+        self.assertEqual(qxbot.resolver.ttl, 30)
+        self.assertEqual(reloader.current.DNS_TTL, 30)
+
+
+if __name__ == "__main__":
+    unittest.main()
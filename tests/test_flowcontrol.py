@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/26 16:05:27
+#   Desc    :   流量控制和重放缓存时的入站预算
+#
+import shutil
+import tempfile
+import unittest
+
+from lib.flowcontrol import (Watermark, FlowControl, FloodControl, FULL,
+                             DEGRADED, DROP)
+from lib.message_dispatch import MessageDispatch
+from lib.metrics import Registry
+from lib.spool import MessageSpool
+from tests.helpers import Stub, FakeLoop
+
+
+class WatermarkTest(unittest.TestCase):
+    def test_hysteresis(self):
+        """ 超过高水位暂停, 降到低水位以下才恢复 """
+        level = [0]
+        mark = Watermark("qq", lambda: level[0], 10, 3)
+        results = []
+        for value in (5, 10, 6, 3, 8):
+            level[0] = value
+            results.append(mark.update())
+        self.assertEqual(results, [(False, False), (True, True),
+                                   (True, False), (False, True),
+                                   (False, False)])
+        self.assertEqual(mark.pauses, 1)
+
+
+class FlowControlTest(unittest.TestCase):
+    def test_resume(self):
+        """ 暂停期间定时检查, 恢复时调用on_resume """
+        loop = FakeLoop()
+        flow = FlowControl(loop, interval = 0.2)
+        level = [20]
+        resumed = []
+        flow.add("xmpp", lambda: level[0], 10, 3,
+                 lambda: resumed.append(True))
+        self.assertTrue(flow.blocked("xmpp"))
+        self.assertTrue(flow.blocked("xmpp"))
+        self.assertEqual(len(loop.timers), 1)
+        level[0] = 5
+        loop.fire_timers()
+        self.assertEqual(resumed, [])
+        self.assertEqual(len(loop.timers), 1)
+        level[0] = 2
+        loop.fire_timers()
+        self.assertEqual(resumed, [True])
+        self.assertEqual(loop.timers, [])
+        self.assertFalse(flow.blocked("xmpp"))
+
+
+class FloodControlTest(unittest.TestCase):
+    def test_budget(self):
+        """ 预算内正常处理, 之后降级, 透支完丢弃 """
+        flood = FloodControl(rate = 0, burst = 2, degraded_burst = 2)
+        verdicts = [flood.admit("g1", i) for i in range(6)]
+        self.assertEqual(verdicts, [FULL, FULL, DEGRADED, DEGRADED,
+                                    DROP, DROP])
+        self.assertEqual(flood.counters["g1"][DROP], 2)
+        self.assertEqual(flood.take_skipped("g1"), 2)
+        self.assertEqual(flood.take_skipped("g1"), 0)
+
+    def test_groups_are_independent(self):
+        flood = FloodControl(rate = 0, burst = 1, degraded_burst = 0)
+        self.assertEqual(flood.admit("g1", "a"), FULL)
+        self.assertEqual(flood.admit("g1", "b"), DROP)
+        self.assertEqual(flood.admit("g2", "a"), FULL)
+
+    def test_duplicate_over_budget(self):
+        """ 超出预算后连续相同的消息只保留一条, 不消耗透支额度 """
+        flood = FloodControl(rate = 0, burst = 1, degraded_burst = 1)
+        self.assertEqual(flood.admit("g1", "spam"), FULL)
+        self.assertEqual(flood.admit("g1", "spam"), DROP)
+        self.assertEqual(flood.counters["g1"]["duplicate"], 1)
+        self.assertEqual(flood.admit("g1", "other"), DEGRADED)
+
+    def test_report(self):
+        flood = FloodControl(rate = 0, burst = 1)
+        flood.admit(12345, "a")
+        flood.count(12345, "images_skipped", 3)
+        lines = flood.report().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith(u"12345"))
+        self.assertEqual(lines[1].split()[1:], ["1", "0", "0", "0", "3"])
+
+
+class ReplayKeepsFloodStateTest(unittest.TestCase):
+    """ 重放磁盘缓存不应重置各群的预算和待发送的汇总 """
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix = "qxbot-test-spool-")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_replay(self):
+        loop = FakeLoop()
+        qxbot = Stub(metrics = Registry(), spool = MessageSpool(self.root),
+                     flow = Stub(blocked = lambda name: False))
+        webqq = Stub(mainloop = loop, send_pending = 0, send_interval = 1)
+        dispatch = MessageDispatch(qxbot, webqq, [])
+        flood = dispatch.flood
+        flood.admit("g1", "a")
+        timer = loop.call_later(10, lambda: None)
+        dispatch._summary_timers["g1"] = timer
+        dispatch._replay_spool()
+        self.assertTrue(dispatch.flood is flood)
+        self.assertEqual(flood.counters["g1"][FULL], 1)
+        self.assertTrue(dispatch._summary_timers.get("g1") is timer)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/26 11:02:15
+#   Desc    :   HTTPClient的超时和Resolver的错误处理
+#
+import socket
+import unittest
+
+from lib.resolver import Resolver
+from webqq.http_client import HTTPClient
+from webqq.http_socket import HTTPSock
+from tests.helpers import FakeLoop
+
+
+class HungResolver(object):
+    """ 解析一直不返回 """
+    def __init__(self):
+        self.pending = []
+
+    def resolve(self, host, callback):
+        self.pending.append(callback)
+
+
+class HTTPClientTimeoutTest(unittest.TestCase):
+    def test_timeout_while_resolving(self):
+        loop = FakeLoop()
+        resolver = HungResolver()
+        client = HTTPClient(loop, HTTPSock(), resolver)
+        results = []
+        request = client.http_sock.make_request("http://example.com/", None)
+        client.fetch(request, results.append, timeout = 5, retries = 0)
+        self.assertEqual(len(resolver.pending), 1)
+        self.assertEqual(results, [])
+        loop.fire_timers()
+        self.assertEqual(len(results), 1)
+        self.assertTrue(isinstance(results[0].error, socket.timeout))
+        # 超时后才返回的解析结果被忽略, 不再连接
+        resolver.pending[0](["127.0.0.1"], None)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(loop.timers, [])
+
+
+class ResolverErrorTest(unittest.TestCase):
+    def test_unexpected_error_is_reported(self):
+        loop = FakeLoop()
+        resolver = Resolver(loop, threads = 0)
+        errors = []
+        original = socket.getaddrinfo
+        def getaddrinfo(*args):
+            raise UnicodeError("label too long")
+        socket.getaddrinfo = getaddrinfo
+        try:
+            resolver.resolve("bad.example.com",
+                             lambda addrs, err: errors.append(err))
+            resolver._worker("bad.example.com")
+        finally:
+            socket.getaddrinfo = original
+        loop.run_callbacks()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(isinstance(errors[0], UnicodeError))
+        self.assertFalse("bad.example.com" in resolver._inflight)
+
+
+if __name__ == "__main__":
+    unittest.main()
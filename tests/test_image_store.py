@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/26 15:41:08
+#   Desc    :   ImageStore和HTTPServer
+#
+import os
+import shutil
+import urllib2
+import tempfile
+import unittest
+import threading
+from functools import partial
+
+from lib.libepoll import EpollMainLoop
+from lib.httpd import HTTPServer
+from lib.image_store import ImageStore
+
+
+class ImageStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix = "qxbot-test-images-")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_put_is_content_addressed(self):
+        store = ImageStore(self.root, "http://127.0.0.1/img", 1024)
+        name = store.put("GIF89a data", "gif")
+        self.assertTrue(name.endswith(".gif"))
+        self.assertEqual(store.put("GIF89a data", "gif"), name)
+        self.assertEqual((store.hits, store.misses), (1, 1))
+        self.assertEqual(store.url(name), "http://127.0.0.1/img/" + name)
+        with open(store.path(name)) as f:
+            self.assertEqual(f.read(), "GIF89a data")
+
+    def test_evict_least_recently_used(self):
+        store = ImageStore(self.root, "http://127.0.0.1/img", 250)
+        first = store.put("a" * 100)
+        second = store.put("b" * 100)
+        store.touch(first)
+        third = store.put("c" * 100)
+        self.assertEqual(store.size, 200)
+        self.assertFalse(os.path.exists(store.path(second)))
+        self.assertTrue(os.path.exists(store.path(first)))
+        self.assertTrue(os.path.exists(store.path(third)))
+
+    def test_quota_on_reload(self):
+        store = ImageStore(self.root, "http://127.0.0.1/img", 1000)
+        for c in "abcde":
+            store.put(c * 100)
+        store = ImageStore(self.root, "http://127.0.0.1/img", 300)
+        self.assertEqual(store.size, 300)
+        self.assertEqual(len(store._entries), 3)
+
+
+class ImageServeTest(unittest.TestCase):
+    """ 通过HTTPServer访问存储的图片 """
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix = "qxbot-test-images-")
+        self.store = ImageStore(self.root, "http://127.0.0.1/img", 1024)
+        self.mainloop = EpollMainLoop()
+        self.httpd = HTTPServer(self.mainloop, ("127.0.0.1", 0))
+        self.httpd.route("/img/", partial(self.store.serve, prefix = "/img/"))
+        self.httpd.start()
+        self.port = self.httpd.sock.getsockname()[1]
+
+    def tearDown(self):
+        self.httpd.sock.close()
+        shutil.rmtree(self.root)
+
+    def fetch(self, path, headers = None):
+        """ 在线程中请求, 同时运行mainloop, 返回 (状态码, 响应体) """
+        result = []
+        def worker():
+            request = urllib2.Request("http://127.0.0.1:{0}{1}".format(
+                self.port, path), headers = headers or {})
+            try:
+                resp = urllib2.urlopen(request, timeout = 5)
+                result.append((resp.getcode(), resp.read()))
+            except urllib2.HTTPError, err:
+                result.append((err.code, err.read()))
+        thread = threading.Thread(target = worker)
+        thread.start()
+        while thread.is_alive():
+            self.mainloop.loop_iteration(0.05)
+        thread.join()
+        return result[0]
+
+    def test_serve_stored_image(self):
+        name = self.store.put("GIF89a image", "gif")
+        self.assertEqual(self.fetch("/img/" + name), (200, "GIF89a image"))
+
+    def test_range(self):
+        name = self.store.put("0123456789", "gif")
+        self.assertEqual(self.fetch("/img/" + name, {"Range": "bytes=2-4"}),
+                         (206, "234"))
+
+    def test_unknown_key(self):
+        code, _ = self.fetch("/img/" + "0" * 40 + ".gif")
+        self.assertEqual(code, 404)
+        code, _ = self.fetch("/img/../settings.py")
+        self.assertEqual(code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
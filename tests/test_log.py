@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/27 10:12:05
+#   Desc    :   RateLimitFilter
+#
+import logging
+import unittest
+
+from lib.log import RateLimitFilter
+
+
+def record(msg, lineno = 10, level = logging.WARNING, *args):
+    return logging.LogRecord("qxbot.test", level, "/src/mod.py", lineno,
+                             msg, args, None)
+
+
+class RateLimitFilterTest(unittest.TestCase):
+    def test_same_call_site(self):
+        """ 同一处调用预先format出的不同消息也限流 """
+        limit = RateLimitFilter(interval = 60, burst = 2)
+        passed = [limit.filter(record(u"Poll failed: {0}".format(i)))
+                  for i in range(5)]
+        self.assertEqual(passed, [True, True, False, False, False])
+        self.assertEqual(limit.suppressed, 3)
+
+    def test_call_sites_are_independent(self):
+        limit = RateLimitFilter(interval = 60, burst = 1)
+        self.assertTrue(limit.filter(record(u"a", 10)))
+        self.assertTrue(limit.filter(record(u"a", 11)))
+        self.assertTrue(limit.filter(record(u"a", 10, logging.ERROR)))
+        self.assertFalse(limit.filter(record(u"b", 10)))
+
+    def test_report_suppressed(self):
+        limit = RateLimitFilter(interval = 60, burst = 1)
+        limit.filter(record(u"x"))
+        limit.filter(record(u"x"))
+        limit._windows.values()[0][0] -= 61    # 周期已过
+        first = record(u"Drop %s stanzas", 10, logging.WARNING, 3)
+        self.assertTrue(limit.filter(first))
+        self.assertEqual(first.getMessage(),
+                         u"Drop 3 stanzas (1 similar messages suppressed)")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/27 14:02:51
+#   Desc    :   qxbot监视的容器大小
+#
+import shutil
+import tempfile
+import unittest
+
+from qxbot import QXBot
+from lib.libepoll import EpollMainLoop
+from lib.memwatch import MemoryWatch
+from lib.message_dispatch import MessageDispatch
+from lib.image_store import ImageStore
+from lib.spool import MessageSpool
+from lib.stanza_batch import StanzaBatcher
+from lib.stream_management import StreamManagement
+from tests.helpers import Stub, make_webqq
+
+
+class WatchMemoryTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix = "qxbot-test-memwatch-")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_sizes(self):
+        """ 每个容器都通过组件的公开接口取得大小 """
+        mainloop = EpollMainLoop()
+        webqq = make_webqq(mainloop)
+        bot = Stub(mainloop = mainloop, webqq = webqq,
+                   memory = MemoryWatch(mainloop),
+                   stream_management = StreamManagement(),
+                   batcher = StanzaBatcher(mainloop, None),
+                   resolver = webqq.http_client.resolver,
+                   image_store = ImageStore(self.root + "/images",
+                                            "http://127.0.0.1/img", 1024),
+                   spool = MessageSpool(self.root + "/spool"))
+        bot.msg_dispatch = MessageDispatch(webqq.qxbot, webqq, [])
+        QXBot.watch_memory.__func__(bot)
+        self.assertTrue(len(bot.memory.containers) > 15)
+        for name, size in bot.memory.containers.iteritems():
+            self.assertTrue(isinstance(size(), (int, long)), name)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/27 11:20:44
+#   Desc    :   MessageDispatch获取群号
+#
+import unittest
+
+from pyxmpp2.jid import JID
+
+from lib.message_dispatch import MessageDispatch
+from lib.metrics import Registry
+from tests.helpers import Stub
+
+ALICE = JID("alice@example.com")
+
+
+class GetMapTest(unittest.TestCase):
+    def setUp(self):
+        self.qids = {"g1": 1001, "g2": 1002}
+        timeline = Stub(start = lambda name: None,
+                        finish = lambda name: None,
+                        mark = lambda name: None)
+        qxbot = Stub(metrics = Registry(), timeline = timeline)
+        self.webqq = Stub(group_map = {"g1": {"name": u"one"},
+                                       "g2": {"name": u"two"}},
+                          get_group_name = lambda gcode: gcode,
+                          get_qid_with_uin = lambda uin, callback:
+                              callback(self.qids.get(uin)))
+        self.dispatch = MessageDispatch(qxbot, self.webqq,
+                                        [(1001, "alice@example.com"),
+                                         (1002, "alice@example.com")])
+
+    def refresh(self):
+        done = []
+        self.dispatch.uin_qid_map.clear()       # 不使用缓存
+        self.dispatch.get_map(lambda: done.append(True))
+        self.assertEqual(done, [True])
+
+    def test_map(self):
+        self.refresh()
+        self.assertEqual(self.dispatch.qid_uin_map, {1001: "g1", 1002: "g2"})
+        self.assertEqual(self.dispatch.routes.to_xmpp("g1"), (ALICE,))
+        self.assertEqual(self.dispatch.routes.to_qq(ALICE), ("g1", "g2"))
+
+    def test_failed_lookup_keeps_mapping(self):
+        """ 获取群号失败时沿用上一次的结果, 不影响转发 """
+        self.refresh()
+        del self.qids["g1"]
+        self.refresh()
+        self.assertEqual(self.dispatch.qid_uin_map, {1001: "g1", 1002: "g2"})
+        self.assertEqual(self.dispatch.routes.to_xmpp("g1"), (ALICE,))
+
+    def test_left_group_is_removed(self):
+        self.refresh()
+        del self.qids["g2"]
+        del self.webqq.group_map["g2"]
+        self.refresh()
+        self.assertEqual(self.dispatch.qid_uin_map, {1001: "g1"})
+        self.assertEqual(self.dispatch.routes.to_qq(ALICE), ("g1",))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/26 17:02:48
+#   Desc    :   RoutingTable
+#
+import unittest
+
+from pyxmpp2.jid import JID
+
+from lib.routing import RoutingTable, parse_bridges, TO_XMPP, TO_QQ
+
+ALICE = JID("alice@example.com")
+BOB = JID("bob@example.com")
+ROOM = JID("room@conference.example.com")
+
+
+class ParseBridgesTest(unittest.TestCase):
+    def test_parse(self):
+        bridges = parse_bridges([(1001, "alice@example.com/home"),
+                                 ([1002, "1003"], ["alice@example.com",
+                                                   "bob@example.com"],
+                                  TO_QQ)])
+        self.assertEqual(bridges, [((1001,), (ALICE,), "both"),
+                                   ((1002, 1003), (ALICE, BOB), TO_QQ)])
+
+    def test_invalid(self):
+        for row in [(1001,), (1001, "alice@example.com", "sideways"),
+                    ([], "alice@example.com"), "1001"]:
+            self.assertRaises(ValueError, parse_bridges, [row])
+
+
+class RoutingTableTest(unittest.TestCase):
+    def setUp(self):
+        self.table = RoutingTable([(1001, "alice@example.com"),
+                                   (1001, "bob@example.com", TO_XMPP),
+                                   ([1002, 1003], "bob@example.com", TO_QQ)],
+                                  [(1002, "room@conference.example.com")])
+
+    def test_empty_until_gcodes_known(self):
+        self.assertEqual(self.table.to_xmpp("g1"), ())
+        self.assertEqual(self.table.to_qq(ALICE), ())
+
+    def test_routes(self):
+        table = self.table
+        table.rebuild({1001: "g1", 1002: "g2"})
+        self.assertEqual(table.to_xmpp("g1"), (ALICE, BOB))
+        self.assertEqual(table.to_xmpp("g2"), ())
+        self.assertEqual(table.to_muc("g2"), (ROOM,))
+        self.assertEqual(table.to_qq("alice@example.com/home"), ("g1",))
+        self.assertEqual(table.to_qq(BOB), ("g2",))
+        self.assertEqual(table.to_qq(ROOM), ("g2",))
+        self.assertTrue(table.is_muc(JID("room@conference.example.com/nick")))
+        self.assertFalse(table.is_muc(ALICE))
+
+    def test_rebuild_adds_gcode(self):
+        table = self.table
+        table.rebuild({1001: "g1", 1002: "g2"})
+        table.rebuild({1001: "g1", 1002: "g2", 1003: "g3"})
+        self.assertEqual(table.to_qq(BOB), ("g2", "g3"))
+
+    def test_set_bridges(self):
+        table = self.table
+        table.rebuild({1001: "g1", 1002: "g2"})
+        table.set_bridges([(1002, "alice@example.com")])
+        self.assertEqual(table.to_xmpp("g1"), ())
+        self.assertEqual(table.to_xmpp("g2"), (ALICE,))
+        self.assertEqual(table.to_muc("g2"), (ROOM,))
+
+    def test_set_bridges_invalid(self):
+        """ 格式错误时保持原来的路由 """
+        table = self.table
+        table.rebuild({1001: "g1"})
+        self.assertRaises(ValueError, table.set_bridges,
+                          [(1002, "alice@example.com")], [(1002,)])
+        self.assertRaises(ValueError, table.set_bridges, [("x", "y", "z")])
+        self.assertEqual(table.to_xmpp("g1"), (ALICE, BOB))
+        self.assertEqual(table.to_qq(ALICE), ("g1",))
+
+
+if __name__ == "__main__":
+    unittest.main()
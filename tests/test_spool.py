@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/26 10:12:40
+#   Desc    :   MessageSpool
+#
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from lib.spool import MessageSpool, DROP_OLDEST, DROP_NEWEST
+
+
+class MessageSpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix = "qxbot-test-spool-")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def spool(self, **kwargs):
+        return MessageSpool(self.root, **kwargs)
+
+    def test_pop_in_order(self):
+        spool = self.spool()
+        for i in range(5):
+            spool.append({"body": i})
+        self.assertEqual(len(spool), 5)
+        self.assertEqual([r["body"] for r in spool.pop(3)], [0, 1, 2])
+        self.assertEqual([r["body"] for r in spool.pop(10)], [3, 4])
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(spool.pop(10), [])
+
+    def test_survives_restart(self):
+        spool = self.spool(segment_bytes = 64)
+        for i in range(10):
+            spool.append({"body": i})
+        spool.pop(4)
+        spool = self.spool(segment_bytes = 64)
+        self.assertEqual(len(spool), 6)
+        self.assertEqual([r["body"] for r in spool.pop(10)], range(4, 10))
+
+    def test_skip_expired(self):
+        spool = self.spool(max_age = 60)
+        spool.append({"body": "old"})
+        spool.append({"body": "new"})
+        spool.append({"body": "newer"})
+        # 把第一条的时间改到有效期之前
+        path = os.path.join(self.root, [name for name in os.listdir(self.root)
+                                        if name.endswith(".seg")][0])
+        with open(path) as f:
+            lines = f.readlines()
+        lines[0] = '{{"body": "old", "t": {0}}}\n'.format(time.time() - 120)
+        with open(path, "w") as f:
+            f.writelines(lines)
+        spool = self.spool(max_age = 60)
+        self.assertEqual([r["body"] for r in spool.pop(10)], ["new", "newer"])
+        self.assertEqual(spool.expired, 1)
+
+    def test_drop_oldest(self):
+        spool = self.spool(max_bytes = 400, segment_bytes = 100,
+                           policy = DROP_OLDEST)
+        for i in range(40):
+            spool.append({"body": i})
+        self.assertTrue(spool.size <= 400)
+        self.assertTrue(spool.dropped > 0)
+        bodies = [r["body"] for r in spool.pop(100)]
+        self.assertEqual(bodies[-1], 39)
+        self.assertEqual(len(bodies), 40 - spool.dropped)
+
+    def test_drop_newest(self):
+        spool = self.spool(max_bytes = 400, segment_bytes = 100,
+                           policy = DROP_NEWEST)
+        results = [spool.append({"body": i}) for i in range(40)]
+        self.assertFalse(results[-1])
+        bodies = [r["body"] for r in spool.pop(100)]
+        self.assertEqual(bodies[0], 0)
+        self.assertEqual(len(bodies), results.count(True))
+
+    def test_incomplete_last_line(self):
+        """ 崩溃时写了一半的记录被截掉, 之后的记录仍能读完 """
+        spool = self.spool(segment_bytes = 64)
+        for i in range(4):
+            spool.append({"body": i})
+        last = os.path.join(self.root, sorted(
+            name for name in os.listdir(self.root)
+            if name.endswith(".seg"))[-1])
+        with open(last, "a") as f:
+            f.write('{"body": "partial", "t"')
+        spool = self.spool(segment_bytes = 64)
+        self.assertEqual(len(spool), 4)
+        spool.append({"body": 4})
+        self.assertEqual([r["body"] for r in spool.pop(10)], range(5))
+        self.assertEqual(len(spool), 0)
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, self.spool, policy = "bogus")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/27 16:02:19
+#   Desc    :   StanzaBatcher
+#
+import threading
+import unittest
+
+from pyxmpp2.exceptions import PyXMPPIOError
+
+from lib.stanza_batch import StanzaBatcher
+from tests.helpers import Stub, FakeLoop
+
+
+class FakeStanza(object):
+    def __init__(self, body, stanza_type = "chat"):
+        self.body = body
+        self.stanza_type = stanza_type
+
+    def as_xml(self):
+        return self.body
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._serializer = Stub(emit_stanza = lambda xml: u"<{0}/>".format(xml))
+        self.writes = []
+        self.error = None
+
+    def _write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.writes.append(data)
+
+
+class FakeStream(object):
+    def __init__(self, transport = None):
+        self.transport = transport
+        self.sent = []
+
+    def fix_out_stanza(self, stanza):
+        pass
+
+    def send(self, stanza):
+        self.sent.append(stanza.body)
+
+
+class StanzaBatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.transport = FakeTransport()
+        self.client = Stub(stream = FakeStream(self.transport))
+        self.batcher = StanzaBatcher(self.loop, self.client, max_bytes = 20)
+
+    def test_batch(self):
+        """ 一次分发中的stanza在下一轮循环合并写出 """
+        written = []
+        self.batcher.send(FakeStanza("a"), lambda: written.append("a"))
+        self.batcher.send(FakeStanza("b"), lambda: written.append("b"))
+        self.assertEqual(self.transport.writes, [])
+        self.assertEqual(self.batcher.pending, 2)
+        self.assertEqual(len(self.loop.timers), 1)
+        self.loop.fire_timers()
+        self.assertEqual(self.transport.writes, ["<a/><b/>"])
+        self.assertEqual(written, ["a", "b"])
+        self.assertEqual((self.batcher.batches, self.batcher.stanzas), (1, 2))
+
+    def test_max_bytes(self):
+        self.batcher.send(FakeStanza("x" * 10))
+        self.batcher.send(FakeStanza("y" * 10))
+        self.assertEqual(self.transport.writes,
+                         ["<{0}/><{1}/>".format("x" * 10, "y" * 10)])
+        # 立即写出后定时器已取消
+        self.loop.fire_timers()
+        self.assertEqual(len(self.transport.writes), 1)
+
+    def test_no_transport(self):
+        """ transport不支持时逐条发送 """
+        self.client.stream = FakeStream()
+        written = []
+        self.batcher.send(FakeStanza("a"), lambda: written.append("a"))
+        self.assertEqual(self.client.stream.sent, ["a"])
+        self.assertEqual(written, ["a"])
+
+    def test_reconnected(self):
+        """ 重新连接后丢弃发往旧流的数据 """
+        self.batcher.send(FakeStanza("old"))
+        self.client.stream = FakeStream(FakeTransport())
+        self.batcher.send(FakeStanza("new"))
+        self.loop.fire_timers()
+        self.assertEqual(self.transport.writes, [])
+        self.assertEqual(self.client.stream.transport.writes, ["<new/>"])
+
+    def test_write_error(self):
+        written = []
+        self.transport.error = PyXMPPIOError("broken pipe")
+        self.batcher.send(FakeStanza("a"), lambda: written.append("a"))
+        self.batcher.flush()
+        self.assertEqual(written, [])
+        self.assertEqual(self.batcher.pending, 0)
+
+    def test_stream_management(self):
+        """ 流管理不接受的stanza交给它暂存, 写入的记为待确认 """
+        held = []
+        sent = []
+        self.batcher.stream_management = Stub(
+            accepts = lambda stanza: stanza.stanza_type != "groupchat",
+            hold = held.append, sent = sent.append)
+        room = FakeStanza("room", "groupchat")
+        chat = FakeStanza("chat")
+        self.batcher.send(room)
+        self.batcher.send(chat)
+        self.assertEqual(held, [room])
+        self.assertEqual(sent, [chat])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/26 16:40:12
+#   Desc    :   StreamManagement(XEP-0198)
+#
+import unittest
+
+from pyxmpp2.jid import JID
+from pyxmpp2.binding import FEATURE_BIND
+from pyxmpp2.etree import ElementTree
+from pyxmpp2.streamevents import AuthorizedEvent, DisconnectedEvent
+
+from lib.stream_management import (StreamManagement, StreamResumedEvent,
+                                   SM_QNP, FEATURE_SM)
+
+
+class FakeStanza(object):
+    def __init__(self, body, stanza_type = "chat"):
+        self.body = body
+        self.stanza_type = stanza_type
+
+
+class FakeStream(object):
+    """ 记录写出的元素和发送的stanza """
+    def __init__(self, sm = True):
+        self.features = ElementTree.Element("features")
+        ElementTree.SubElement(self.features, FEATURE_BIND)
+        if sm:
+            ElementTree.SubElement(self.features, FEATURE_SM)
+        self.me = JID("bot@example.com/qxbot")
+        self.settings = {"resource": "qxbot"}
+        self.elements = []
+        self.stanzas = []
+        self.events = []
+
+    def send(self, stanza):
+        self._send(stanza)
+
+    def _send(self, stanza):
+        self.stanzas.append(stanza)
+
+    def write_element(self, element):
+        self.elements.append(element)
+
+    def event(self, event):
+        self.events.append(event)
+
+    def bodies(self):
+        return [stanza.body for stanza in self.stanzas]
+
+    def tags(self):
+        return [e.tag[len(SM_QNP):] for e in self.elements]
+
+
+class FakeBinding(object):
+    def __init__(self):
+        self.bound = []
+
+    def bind(self, stream, resource):
+        self.bound.append(resource)
+
+
+def element(name, **attrs):
+    return ElementTree.Element(SM_QNP + name, **attrs)
+
+
+class StreamManagementTest(unittest.TestCase):
+    def connect(self, sm, stream = None, resume = True):
+        """ 新会话, 服务器启用流管理 """
+        stream = stream or FakeStream()
+        event = AuthorizedEvent(stream.me)
+        event.stream = stream
+        sm.handle_authorized(event)
+        sm.handle_enabled(stream, element("enabled", id = "s1",
+                                          resume = "true" if resume else "0"))
+        return stream
+
+    def disconnect(self, sm):
+        sm.handle_disconnected(DisconnectedEvent(None))
+
+    def test_ack(self):
+        sm = StreamManagement(ack_every = 3)
+        stream = self.connect(sm)
+        self.assertEqual(stream.tags(), ["enable"])
+        for i in range(3):
+            stream.send(FakeStanza(i))
+        self.assertEqual(stream.tags(), ["enable", "r"])
+        self.assertEqual(sm.unacked, 3)
+        sm.handle_ack(stream, element("a", h = "2"))
+        self.assertEqual(sm.unacked, 1)
+        # 没有新发出的stanza时不重复请求确认
+        stream.send(FakeStanza(3))
+        self.assertEqual(stream.tags(), ["enable", "r"])
+        sm.handle_ack(stream, element("a", h = "4"))
+        self.assertEqual(sm.unacked, 0)
+
+    def test_inbound_count(self):
+        sm = StreamManagement()
+        stream = self.connect(sm)
+        sm.handle_message(stream, None)
+        sm.handle_presence(stream, None)
+        sm.handle_iq(stream, None)
+        sm.handle_request(stream, element("r"))
+        self.assertEqual(stream.elements[-1].get("h"), "3")
+
+    def test_hold_until_ready(self):
+        sm = StreamManagement()
+        sm.hold(FakeStanza("a"))
+        sm.hold(FakeStanza("b"))
+        stream = self.connect(sm)
+        self.assertEqual(stream.bodies(), ["a", "b"])
+        self.assertEqual(sm.unacked, 2)
+
+    def test_max_unacked(self):
+        """ 超出上限丢弃最旧的, 仍与服务器的计数对应 """
+        sm = StreamManagement(ack_every = 100, max_unacked = 2)
+        stream = self.connect(sm)
+        for i in range(5):
+            stream.send(FakeStanza(i))
+        self.assertEqual([x.body for x in sm._unacked], [3, 4])
+        self.assertEqual(sm.dropped, 3)
+        sm.handle_ack(stream, element("a", h = "4"))
+        self.assertEqual([x.body for x in sm._unacked], [4])
+
+    def test_resume(self):
+        sm = StreamManagement(ack_every = 100)
+        stream = self.connect(sm)
+        for i in range(4):
+            stream.send(FakeStanza(i))
+        sm.handle_message(stream, None)
+        self.disconnect(sm)
+        self.assertFalse(sm.ready)
+        sm.hold(FakeStanza("held"))
+
+        stream = FakeStream()
+        self.assertTrue(sm.handle_stream_features(stream, stream.features))
+        resume = stream.elements[-1]
+        self.assertEqual((resume.get("previd"), resume.get("h")), ("s1", "1"))
+        sm.handle_resumed(stream, element("resumed", h = "2", previd = "s1"))
+        self.assertTrue(sm.ready)
+        self.assertEqual(stream.bodies(), [2, 3, "held"])
+        self.assertEqual(sm.unacked, 3)
+        self.assertEqual(sm.resumes, 1)
+        self.assertTrue(isinstance(stream.events[-1], StreamResumedEvent))
+
+    def test_resume_failed(self):
+        """ 恢复失败时重新绑定资源, 新会话重发全部未确认的stanza """
+        sm = StreamManagement(ack_every = 100)
+        sm.binding = FakeBinding()
+        stream = self.connect(sm)
+        stream.send(FakeStanza("a"))
+        self.disconnect(sm)
+
+        stream = FakeStream()
+        sm.handle_stream_features(stream, stream.features)
+        sm.handle_failed(stream, element("failed"))
+        self.assertEqual(sm.binding.bound, ["qxbot"])
+        self.assertEqual(sm.session_id, None)
+        self.connect(sm, stream)
+        self.assertEqual(stream.bodies(), ["a"])
+        self.assertEqual(sm.resent, 1)
+
+    def test_no_resume_without_session(self):
+        sm = StreamManagement()
+        stream = self.connect(sm, resume = False)
+        self.disconnect(sm)
+        stream = FakeStream()
+        self.assertEqual(sm.handle_stream_features(stream, stream.features),
+                         None)
+        self.assertEqual(stream.elements, [])
+
+    def test_groupchat_held_until_rooms_joined(self):
+        """ 新会话中groupchat等重新加入聊天室之后再发送 """
+        sm = StreamManagement(ack_every = 100)
+        stream = self.connect(sm)
+        self.assertFalse(sm.accepts(FakeStanza("room", "groupchat")))
+        self.assertEqual(sm.release_groupchat(), [])
+        stream.send(FakeStanza("before", "groupchat"))
+        stream.send(FakeStanza("chat"))
+        self.disconnect(sm)
+        sm.hold(FakeStanza("outage", "groupchat"))
+        sm.hold(FakeStanza("outage-chat"))
+
+        stream = self.connect(sm, resume = False)
+        self.assertEqual(stream.bodies(), ["chat", "outage-chat"])
+        self.assertTrue(sm.accepts(FakeStanza("chat")))
+        groupchat = FakeStanza("early", "groupchat")
+        self.assertFalse(sm.accepts(groupchat))
+        sm.hold(groupchat)
+        released = sm.release_groupchat()
+        self.assertEqual([x.body for x in released],
+                         ["before", "outage", "early"])
+        self.assertTrue(sm.accepts(groupchat))
+
+    def test_groupchat_resumed(self):
+        """ 恢复会话时仍在聊天室中, groupchat直接重发 """
+        sm = StreamManagement(ack_every = 100)
+        stream = self.connect(sm)
+        sm.release_groupchat()
+        stream.send(FakeStanza("room", "groupchat"))
+        self.disconnect(sm)
+        stream = FakeStream()
+        sm.handle_stream_features(stream, stream.features)
+        sm.handle_resumed(stream, element("resumed", h = "0", previd = "s1"))
+        self.assertEqual(stream.bodies(), ["room"])
+
+
+if __name__ == "__main__":
+    unittest.main()
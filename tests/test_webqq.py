@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/27 15:10:36
+#   Desc    :   WebQQ会话失效后重新登录
+#
+import unittest
+
+from webqq.handlers.poll import PollHandler
+from webqq.handlers.group_msg import GroupMsgHandler
+from tests.helpers import Stub, FakeLoop, make_webqq
+
+
+class FakeHTTPClient(object):
+    """ 只记录请求, 由测试给出响应 """
+    def __init__(self):
+        self.resolver = Stub(prefetch = lambda hosts: None)
+        self.requests = []
+
+    def fetch(self, request, callback, **kwargs):
+        self.requests.append(callback)
+
+    def handlers(self, cls):
+        return [callback.__self__ for callback in self.requests
+                if isinstance(callback.__self__, cls)]
+
+    def respond(self, handler, data = None, error = None, code = 200):
+        """ 给出响应, 之后handler不再算作未完成的请求 """
+        self.requests.remove(handler._on_response)
+        handler._on_response(Stub(json = data, error = error, code = code,
+                                  retries = 0, body = "", first_byte = None))
+
+
+class ReloginTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        dispatch = Stub(schedule_replay = lambda: None,
+                        sent_to_qq = lambda gcode, received: None)
+        self.webqq = make_webqq(self.loop,
+                                flow = Stub(blocked = lambda name: False),
+                                msg_dispatch = dispatch,
+                                check_go_live = lambda: None)
+        self.client = self.webqq.http_client = FakeHTTPClient()
+        self.webqq.psessionid = "s1"
+        self.webqq.group_map = {"g1": {"gid": 1}}
+        self.webqq.connected = True
+        self.webqq.polled = True
+
+    def poll(self):
+        handler = PollHandler.acquire(self.webqq)
+        handler.run()
+        return handler
+
+    def test_poll_expired(self):
+        self.client.respond(self.poll(), {"retcode": 121})
+        webqq = self.webqq
+        self.assertTrue(webqq.relogging)
+        self.assertFalse(webqq.connected)
+        self.assertFalse(webqq.polled)
+        # 重新登录从检查开始, 不再轮询
+        self.assertEqual(len(self.client.requests), 1)
+        self.assertEqual(self.client.handlers(PollHandler), [])
+        # 重新登录期间再次失效不重复登录
+        webqq.session_expired(103)
+        self.assertEqual(len(self.client.requests), 1)
+
+    def test_stale_poll(self):
+        """ 重新登录后才返回的旧会话的轮询不触发再次登录 """
+        handler = self.poll()
+        self.webqq.psessionid = "s2"
+        self.client.respond(handler, {"retcode": 121})
+        self.assertFalse(self.webqq.relogging)
+        self.assertTrue(self.webqq.polled)
+        polls = self.client.handlers(PollHandler)
+        self.assertEqual(len(polls), 1)
+        self.assertEqual(polls[0]._key[1], "s2")
+
+    def test_send_expired(self):
+        """ 发送返回121: 消息放回队列头部, 重新登录前暂停发送 """
+        webqq = self.webqq
+        webqq.send_qq_group_msg("g1", u"first")
+        webqq.send_qq_group_msg("g1", u"second")
+        sent = self.client.handlers(GroupMsgHandler)
+        self.assertEqual([h.content for h in sent], [u"first"])
+        self.client.respond(sent[0], {"retcode": 121})
+        self.assertTrue(webqq.relogging)
+        self.assertEqual(webqq.send_pending, 2)
+        self.loop.fire_timers()
+        self.assertEqual(len(self.client.handlers(GroupMsgHandler)), 0)
+
+        webqq.psessionid = "s2"
+        webqq.handle_map_ready()
+        self.assertFalse(webqq.relogging)
+        self.assertTrue(webqq.connected)
+        sent = self.client.handlers(GroupMsgHandler)
+        self.assertEqual([h.content for h in sent], [u"first"])
+        self.assertEqual(webqq.send_pending, 1)
+        self.loop.fire_timers()
+        sent = self.client.handlers(GroupMsgHandler)
+        self.assertEqual([h.content for h in sent], [u"first", u"second"])
+
+    def test_poll_backoff(self):
+        webqq = self.webqq
+        webqq.poll_max_delay = 10
+        self.assertEqual([webqq.poll_failed(502) for _ in range(6)],
+                         [1, 2, 4, 8, 10, 10])
+        webqq.poll_succeeded()
+        self.assertEqual(webqq.poll_failed(IOError()), 1)
+
+    def test_poll_error_retries_later(self):
+        """ 轮询失败后按退避的时间重新轮询 """
+        self.client.respond(self.poll(), error = IOError("reset"))
+        self.assertEqual([timer.deadline for timer in self.loop.timers], [1])
+        self.loop.fire_timers()
+        self.client.respond(self.client.handlers(PollHandler)[0], code = 502)
+        self.assertEqual([timer.deadline for timer in self.loop.timers], [2])
+        self.assertFalse(self.webqq.relogging)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/22 15:36:08
+#   Desc    :   端到端性能测试
+#
+""" 在本进程中运行WebQQ和XMPP的替身服务器, 在子进程中运行连接到它们的
+qxbot, 向两个方向以固定速度发送消息, 统计吞吐量和端到端延迟
+
+    python tools/bench.py --groups 10 --rate 20 --duration 60
+
+`--rate` 每个方向每秒发送的消息数, 轮流发到各群; 第i个群桥接到
+peer<i>@localhost. 延迟从消息进入替身服务器(QQ群产生消息/XMPP帐号发出
+消息)算起, 到另一侧的替身服务器收到为止. 结束后等待 `--drain` 秒,
+仍未收到的消息计为丢失. `--json` 把结果写入文件, 便于比较各版本
+QQ发送间隔(QQ_SEND_INTERVAL)限制了XMPP到QQ方向的吞吐量,
+可用 `--send-interval` 修改
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import tempfile
+import optparse
+import threading
+import subprocess
+
+import webqq_standin
+import xmpp_standin
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_ACCOUNT = "qxbot@localhost"
+PEER = "peer{0}@localhost"
+QQ_TO_XMPP = "qq_to_xmpp"
+XMPP_TO_QQ = "xmpp_to_qq"
+TOKEN = re.compile(r"bench-(\w)(\d+)-")
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def percentile(values, p):
+    """ `values` 已排序 """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Direction(object):
+    """ 一个方向上发出和收到的消息 """
+    def __init__(self, name):
+        self.name = name
+        self.sent = {}              # 序号 -> 发出时间
+        self.latencies = []
+        self.received = {}          # 序号 -> 第一次收到的时间
+        self.duplicated = 0
+        self.first_sent = None
+        self.last_received = None
+
+    def send(self, seq, now):
+        self.sent[seq] = now
+        if self.first_sent is None:
+            self.first_sent = now
+
+    def receive(self, seq, now):
+        if seq not in self.sent:
+            return
+        if seq in self.received:
+            self.duplicated += 1
+            return
+        self.received[seq] = now
+        self.latencies.append(now - self.sent[seq])
+        self.last_received = now
+
+    @property
+    def done(self):
+        return len(self.received) >= len(self.sent)
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        elapsed = None
+        if self.last_received is not None:
+            elapsed = self.last_received - self.first_sent
+        def ms(value):
+            return None if value is None else round(value * 1000, 2)
+        return {"sent": len(self.sent), "received": len(self.received),
+                "lost": len(self.sent) - len(self.received),
+                "duplicated": self.duplicated,
+                "throughput": round(len(self.received) / elapsed, 2)
+                              if elapsed else None,
+                "p50_ms": ms(percentile(latencies, 50)),
+                "p90_ms": ms(percentile(latencies, 90)),
+                "p99_ms": ms(percentile(latencies, 99)),
+                "max_ms": ms(latencies[-1] if latencies else None)}
+
+
+class Bench(object):
+    script = os.path.abspath(__file__)      # 以 --bot 运行qxbot的脚本
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.directions = {}
+        if options.direction in ("both", "qq2xmpp"):
+            self.directions[QQ_TO_XMPP] = Direction(QQ_TO_XMPP)
+        if options.direction in ("both", "xmpp2qq"):
+            self.directions[XMPP_TO_QQ] = Direction(XMPP_TO_QQ)
+        self.ready = {}             # 方向 -> 已收到预热消息的群
+        self.workdir = tempfile.mkdtemp(prefix = "qxbot-bench-")
+        self.bot = None
+        self.threads = []
+
+        qq_options, _ = webqq_standin.make_parser().parse_args([])
+        qq_options.port = 0
+        for key in ("groups", "members", "latency", "chunked", "gzip",
+                    "images"):
+            setattr(qq_options, key, getattr(options, key))
+        self.qq = webqq_standin.WebQQStandin(qq_options)
+        self.qq.on_message = self.got_qq
+        self.xmpp = xmpp_standin.StandinServer(optparse.Values({
+            "host": "127.0.0.1", "port": free_port(), "drop_every": 0,
+            "no_resume": False, "echo": False}))
+        self.xmpp.on_message = self.got_xmpp
+
+    # 替身服务器线程中调用
+    def got_qq(self, index, text, now):
+        self._got(XMPP_TO_QQ, index, text, now)
+
+    def got_xmpp(self, to, body, now):
+        match = re.match(r"peer(\d+)@", to or "")
+        self._got(QQ_TO_XMPP, int(match.group(1)) if match else None, body,
+                  now)
+
+    def _got(self, direction, index, text, now):
+        match = TOKEN.search(text or u"")
+        if match is None:
+            return
+        kind, seq = match.group(1), int(match.group(2))
+        with self.lock:
+            if kind == "w":
+                self.ready.setdefault(direction, set()).add(index)
+            elif direction in self.directions:
+                self.directions[direction].receive(seq, now)
+
+    def send(self, direction, index, text):
+        if direction == QQ_TO_XMPP:
+            images = 1 if random.random() < self.options.images else 0
+            self.qq.inject(index, text, images)
+        else:
+            self.xmpp.inject(PEER.format(index) + "/bench", text)
+
+    # qxbot子进程
+    def bot_settings(self):
+        options = self.options
+        bridges = [(webqq_standin.QID_BASE + i, PEER.format(i))
+                   for i in range(options.groups)]
+        config = {"QQ": webqq_standin.SELF_UIN, "QQ_PWD": "bench",
+                  "XMPP_ACCOUNT": BOT_ACCOUNT, "XMPP_PASSWD": "bench",
+                  "XMPP_SERVER": "127.0.0.1", "XMPP_PORT": self.xmpp.options.port,
+                  "XMPP_RECONNECT_MAX": 1,
+                  "WEBQQ_SERVER": "http://127.0.0.1:{0}".format(self.qq.port),
+                  "BRIDGES": bridges, "MUC_ROOMS": [],
+                  "HTTPD_HOST": "127.0.0.1", "HTTPD_PORT": free_port(),
+                  "CONTROL_ADDRESS": os.path.join(self.workdir, "control"),
+                  "IMAGE_STORE_PATH": os.path.join(self.workdir, "images"),
+                  "SPOOL_PATH": os.path.join(self.workdir, "spool"),
+                  "STARTUP_TIMELINE_PATH": os.path.join(self.workdir,
+                                                        "timeline.json"),
+                  "FLOOD_RATE": 1e6, "FLOOD_BURST": 1e6,
+                  "QQ_SEND_QUEUE_SIZE": 100000, "QQ_SEND_HIGH": 100000,
+                  "QQ_SEND_LOW": 50000, "LOG_LEVEL": options.log_level,
+                  "LOOP_METRICS_INTERVAL": 0, "MEMORY_CHECK_INTERVAL": 0}
+        if options.send_interval is not None:
+            config["QQ_SEND_INTERVAL"] = options.send_interval
+        return config
+
+    def start_bot(self):
+        log = open(os.path.join(self.workdir, "qxbot.log"), "w")
+        self.bot = subprocess.Popen([sys.executable, self.script, "--bot",
+                                     json.dumps(self.bot_settings())],
+                                    stdout = log, stderr = log)
+
+    def stop_bot(self):
+        if self.bot is not None and self.bot.poll() is None:
+            self.bot.terminate()
+            self.bot.wait()
+
+    # 测试过程
+    def warmup(self):
+        """ 每个群在每个方向上都收到预热消息后才开始计时 """
+        groups = set(range(self.options.groups))
+        deadline = time.time() + self.options.warmup
+        while time.time() < deadline:
+            if self.bot.poll() is not None:
+                raise RuntimeError("qxbot exited with {0}, see {1}".format(
+                    self.bot.returncode, self.workdir))
+            with self.lock:
+                waiting = [(d, i) for d in self.directions for i in groups
+                           if i not in self.ready.get(d, ())]
+            if not waiting:
+                return
+            for direction, index in waiting:
+                self.send(direction, index, u"bench-w{0}-".format(index))
+            time.sleep(2)
+        raise RuntimeError("Warm up timed out, see {0}".format(self.workdir))
+
+    def generate(self):
+        options = self.options
+        start = time.time()
+        total = int(options.rate * options.duration)
+        for seq in xrange(total):
+            delay = start + seq / options.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            index = seq % options.groups
+            for name, direction in self.directions.items():
+                now = time.time()
+                with self.lock:
+                    direction.send(seq, now)
+                self.send(name, index, u"bench-{0}{1}- {2}".format(
+                    name[0], seq, u"x" * options.length))
+
+    def drain(self):
+        deadline = time.time() + self.options.drain
+        while time.time() < deadline:
+            with self.lock:
+                if all(d.done for d in self.directions.values()):
+                    return
+            time.sleep(0.1)
+
+    def start(self):
+        """ 启动替身服务器和qxbot """
+        self.threads = [threading.Thread(target = server.run)
+                        for server in (self.qq, self.xmpp)]
+        for thread in self.threads:
+            thread.setDaemon(True)
+            thread.start()
+        self.start_bot()
+
+    def stop(self):
+        self.stop_bot()
+        self.qq.stop()
+        self.xmpp.stop()
+        for thread in self.threads:
+            thread.join(5)
+
+    def run(self):
+        self.start()
+        try:
+            started = time.time()
+            self.warmup()
+            ready = time.time() - started
+            self.generate()
+            self.drain()
+        finally:
+            self.stop()
+        with self.lock:
+            result = dict((name, d.report())
+                          for name, d in self.directions.items())
+        result["ready_seconds"] = round(ready, 3)
+        result["options"] = vars(self.options)
+        return result
+
+
+def format_report(result):
+    columns = ("sent", "received", "lost", "duplicated", "throughput",
+               "p50_ms", "p90_ms", "p99_ms", "max_ms")
+    lines = ["ready after {0}s".format(result["ready_seconds"]),
+             "{0:<12}".format("") + "".join("{0:>11}".format(c)
+                                            for c in columns)]
+    for name in (QQ_TO_XMPP, XMPP_TO_QQ):
+        if name in result:
+            lines.append("{0:<12}".format(name) + "".join(
+                "{0:>11}".format(result[name][c]) for c in columns))
+    return "\n".join(lines)
+
+
+def run_bot(config):
+    """ 子进程: 修改配置后运行qxbot """
+    sys.path.insert(0, ROOT)
+    import settings
+    for key, value in json.loads(config).iteritems():
+        setattr(settings, key, value)
+    import qxbot
+    qxbot.main()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--groups", type = "int", default = 4,
+                      help = u"群的数量")
+    parser.add_option("--members", type = "int", default = 20)
+    parser.add_option("--rate", type = "float", default = 5,
+                      help = u"每个方向每秒发送的消息数")
+    parser.add_option("--duration", type = "float", default = 30,
+                      help = u"发送多少秒")
+    parser.add_option("--direction", default = "both",
+                      choices = ("both", "qq2xmpp", "xmpp2qq"))
+    parser.add_option("--length", type = "int", default = 32,
+                      help = u"消息长度")
+    parser.add_option("--images", type = "float", default = 0,
+                      help = u"QQ消息中带图片的比例")
+    parser.add_option("--latency", type = "float", default = 0,
+                      help = u"WebQQ替身每个响应延迟的秒数")
+    parser.add_option("--chunked", action = "store_true")
+    parser.add_option("--gzip", action = "store_true")
+    parser.add_option("--send-interval", type = "float", default = None,
+                      help = u"qxbot发送QQ群消息的间隔, 默认用settings.py中的")
+    parser.add_option("--warmup", type = "float", default = 120,
+                      help = u"等待qxbot就绪的最长时间")
+    parser.add_option("--drain", type = "float", default = 10,
+                      help = u"发送完毕后等待多少秒")
+    parser.add_option("--log-level", default = "WARNING",
+                      help = u"qxbot的日志级别")
+    parser.add_option("--json", help = u"结果写入此文件")
+    parser.add_option("--bot", help = optparse.SUPPRESS_HELP)
+    options, _ = parser.parse_args()
+    if options.bot:
+        run_bot(options.bot)
+        return
+    bench = Bench(options)
+    result = bench.run()
+    print format_report(result)
+    print "qxbot log: {0}".format(os.path.join(bench.workdir, "qxbot.log"))
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(result, f, indent = 2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/25 14:08:52
+#   Desc    :   故障恢复测试
+#
+""" 在 `bench.py` 的环境(替身服务器 + qxbot子进程)中持续两个方向低速发送
+消息, 依次向WebQQ替身注入故障, 测量qxbot察觉故障和恢复转发的时间
+
+    python tools/recovery.py
+    python tools/recovery.py --scenario expire_121 --scenario poll_stall
+
+每个场景的结果:
+    detect      故障发生到qxbot重新发起请求(重新轮询, 重新发送或重新登录)
+    recover     故障发生后发出的消息第一条到达另一侧的时间, 按方向
+    lost        故障前后发出, 恢复后 `--settle` 秒仍未到达的消息, 按方向
+    duplicated  重复到达的消息, 按方向
+poll_stall的察觉时间取决于QQ_POLL_TIMEOUT, 用 `--poll-timeout` 缩短
+"""
+import os
+import sys
+import json
+import time
+import socket
+import optparse
+import itertools
+import threading
+
+import bench
+import webqq_standin
+
+DNS_DELAY_ENV = "QXBOT_DNS_DELAY_FILE"
+
+# (名称, 说明, 注入的故障, DNS延迟)
+SCENARIOS = (
+    ("poll_reset", u"poll2响应发送一半后RST", ("reset@poll2",), 0),
+    ("poll_truncate", u"poll2的chunked响应不完整", ("truncate@poll2",), 0),
+    ("poll_stall", u"poll2不响应", ("stall@poll2",), 0),
+    ("poll_5xx", u"poll2连续3次502", ("status@poll2?code=502&count=3",), 0),
+    ("poll_116", u"poll2返回116更新ptwebqq",
+     ("retcode@poll2?retcode=116",), 0),
+    ("send_5xx", u"发送群消息连续2次503",
+     ("status@send_qun_msg2?code=503&count=2",), 0),
+    ("send_reset", u"发送群消息的响应发送一半后RST",
+     ("reset@send_qun_msg2",), 0),
+    ("expire_121", u"会话失效, 返回121", ("expire@*?retcode=121",), 0),
+    ("expire_103", u"会话失效, 返回103", ("expire@*?retcode=103",), 0),
+    ("slow_dns", u"DNS解析需5秒时poll2连接被RST", ("reset@poll2",), 5),
+)
+
+
+class Recovery(bench.Bench):
+    script = os.path.abspath(__file__)
+
+    def __init__(self, options):
+        bench.Bench.__init__(self, options)
+        self.qq.options.poll_timeout = options.standin_poll_timeout
+        self.dns_file = os.path.join(self.workdir, "dns_delay")
+        self.seq = itertools.count()
+        self.sending = False
+
+    def bot_settings(self):
+        config = bench.Bench.bot_settings(self)
+        # 用域名连接替身, DNS缓存很快过期, slow_dns场景才会触发解析
+        config.update({
+            "WEBQQ_SERVER": "http://localhost:{0}".format(self.qq.port),
+            "DNS_TTL": 1, "QQ_POLL_TIMEOUT": self.options.poll_timeout})
+        return config
+
+    def start_bot(self):
+        self.set_dns_delay(0)
+        os.environ[DNS_DELAY_ENV] = self.dns_file
+        bench.Bench.start_bot(self)
+
+    def set_dns_delay(self, delay):
+        with open(self.dns_file, "w") as f:
+            f.write(str(delay))
+
+    def traffic(self):
+        """ 每个方向每秒发送 `--rate` 条, 轮流发到各群 """
+        interval = 1.0 / self.options.rate
+        next_at = time.time()
+        while self.sending:
+            seq = next(self.seq)
+            index = seq % self.options.groups
+            for name, direction in self.directions.items():
+                with self.lock:
+                    direction.send(seq, time.time())
+                self.send(name, index, u"bench-{0}{1}- recovery".format(
+                    name[0], seq))
+            next_at += interval
+            delay = next_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def recovered_at(self, direction, since):
+        """ `since` 之后发出的消息第一条到达的时间 """
+        times = [direction.received[seq]
+                 for seq, sent in direction.sent.iteritems()
+                 if sent >= since and seq in direction.received]
+        return min(times) if times else None
+
+    def run_scenario(self, scenario):
+        name, desc, specs, dns_delay = scenario
+        options = self.options
+        result = {"scenario": name, "description": desc, "fired": False}
+        with self.lock:
+            duplicated = dict((n, d.duplicated)
+                              for n, d in self.directions.items())
+        self.set_dns_delay(dns_delay)
+        injected = time.time()
+        faults = [self.qq.add_fault(webqq_standin.Fault.parse(spec))
+                  for spec in specs]
+        fault = faults[0]
+        deadline = injected + options.timeout
+        try:
+            while fault.fired_at is None and time.time() < deadline:
+                time.sleep(0.1)
+            if fault.fired_at is None:
+                return result
+            fired_at = fault.fired_at
+            result["fired"] = True
+            recovered = {}
+            while time.time() < deadline and \
+                  len(recovered) < len(self.directions):
+                with self.lock:
+                    for key, direction in self.directions.items():
+                        if key not in recovered:
+                            at = self.recovered_at(direction, fired_at)
+                            if at is not None:
+                                recovered[key] = at
+                time.sleep(0.1)
+            end = max(recovered.values() or [time.time()])
+        finally:
+            self.qq.call(self.qq.clear_faults)
+            self.set_dns_delay(0)
+        time.sleep(options.settle)
+
+        def seconds(value):
+            return None if value is None else round(value, 3)
+        result["detect"] = seconds(fault.detected - fired_at
+                                   if fault.detected else None)
+        result["recover"], result["lost"], result["duplicated"] = {}, {}, {}
+        with self.lock:
+            for key, direction in self.directions.items():
+                at = recovered.get(key)
+                result["recover"][key] = seconds(at - fired_at
+                                                 if at else None)
+                result["lost"][key] = sum(
+                    1 for seq, sent in direction.sent.iteritems()
+                    if injected - 1 <= sent <= end and
+                       seq not in direction.received)
+                result["duplicated"][key] = (direction.duplicated -
+                                             duplicated[key])
+        return result
+
+    def run(self):
+        options = self.options
+        names = options.scenario or [s[0] for s in SCENARIOS]
+        scenarios = [s for s in SCENARIOS if s[0] in names]
+        results = []
+        self.start()
+        try:
+            started = time.time()
+            self.warmup()
+            ready = time.time() - started
+            self.sending = True
+            sender = threading.Thread(target = self.traffic)
+            sender.setDaemon(True)
+            sender.start()
+            time.sleep(options.gap)
+            for scenario in scenarios:
+                if self.bot.poll() is not None:
+                    raise RuntimeError("qxbot exited with {0}, see {1}".format(
+                        self.bot.returncode, self.workdir))
+                results.append(self.run_scenario(scenario))
+                sys.stderr.write(format_row(results[-1]) + "\n")
+                time.sleep(options.gap)
+            self.sending = False
+            sender.join(5)
+        finally:
+            self.sending = False
+            self.stop()
+        return {"ready_seconds": round(ready, 3), "scenarios": results,
+                "options": vars(options)}
+
+
+def format_row(result):
+    def value(v):
+        return "-" if v is None else v
+    if not result["fired"]:
+        return "{0:<14}{1:>10}".format(result["scenario"], "not fired")
+    row = [result["detect"]]
+    for key in ("recover", "lost", "duplicated"):
+        row.extend(result[key].get(name) for name in (bench.QQ_TO_XMPP,
+                                                      bench.XMPP_TO_QQ))
+    return "{0:<14}".format(result["scenario"]) + "".join(
+        "{0:>10}".format(value(v)) for v in row)
+
+
+def format_report(result):
+    lines = ["ready after {0}s".format(result["ready_seconds"]),
+             "{0:<14}{1:>10}{2:>20}{3:>20}{4:>20}".format(
+                 "", "detect", "recover(s)", "lost", "duplicated"),
+             "{0:<14}{1:>10}".format("", "(s)") +
+             "{0:>10}{1:>10}".format("q2x", "x2q") * 3]
+    lines.extend(format_row(r) for r in result["scenarios"])
+    return "\n".join(lines)
+
+
+def install_slow_dns(path):
+    """ 子进程: 每次getaddrinfo前等待 `path` 中的秒数, 模拟DNS服务器响应慢 """
+    getaddrinfo = socket.getaddrinfo
+    def slow_getaddrinfo(*args, **kwargs):
+        try:
+            with open(path) as f:
+                delay = float(f.read() or 0)
+        except (IOError, ValueError):
+            delay = 0
+        if delay:
+            time.sleep(delay)
+        return getaddrinfo(*args, **kwargs)
+    socket.getaddrinfo = slow_getaddrinfo
+
+
+def run_bot(config):
+    path = os.environ.get(DNS_DELAY_ENV)
+    if path:
+        install_slow_dns(path)
+    bench.run_bot(config)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--scenario", action = "append", default = [],
+                      help = u"只运行指定的场景, 可重复: " +
+                             u", ".join(s[0] for s in SCENARIOS))
+    parser.add_option("--groups", type = "int", default = 2,
+                      help = u"群的数量")
+    parser.add_option("--members", type = "int", default = 5)
+    parser.add_option("--rate", type = "float", default = 5,
+                      help = u"每个方向每秒发送的消息数")
+    parser.add_option("--length", type = "int", default = 16)
+    parser.add_option("--images", type = "float", default = 0)
+    parser.add_option("--chunked", action = "store_true")
+    parser.add_option("--gzip", action = "store_true")
+    parser.add_option("--send-interval", type = "float", default = 0.05,
+                      help = u"qxbot发送QQ群消息的间隔")
+    parser.add_option("--poll-timeout", type = "float", default = 10,
+                      help = u"qxbot的QQ_POLL_TIMEOUT")
+    parser.add_option("--standin-poll-timeout", type = "float", default = 5,
+                      help = u"没有消息时替身的poll2保持多少秒, "
+                             u"应小于 --poll-timeout")
+    parser.add_option("--timeout", type = "float", default = 60,
+                      help = u"每个场景等待恢复的最长时间")
+    parser.add_option("--settle", type = "float", default = 5,
+                      help = u"恢复后等待多少秒再统计丢失的消息")
+    parser.add_option("--gap", type = "float", default = 3,
+                      help = u"场景之间间隔的秒数")
+    parser.add_option("--warmup", type = "float", default = 120,
+                      help = u"等待qxbot就绪的最长时间")
+    parser.add_option("--log-level", default = "WARNING",
+                      help = u"qxbot的日志级别")
+    parser.add_option("--json", help = u"结果写入此文件")
+    parser.add_option("--bot", help = optparse.SUPPRESS_HELP)
+    options, _ = parser.parse_args()
+    if options.bot:
+        run_bot(options.bot)
+        return
+    # bench.Bench 需要的其他选项
+    options.direction, options.latency = "both", 0
+    recovery = Recovery(options)
+    result = recovery.run()
+    print format_report(result)
+    print "qxbot log: {0}".format(os.path.join(recovery.workdir, "qxbot.log"))
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(result, f, indent = 2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,670 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/22 10:14:36
+#   Desc    :   本地测试用的WebQQ接口
+#
+""" 实现qxbot用到的WebQQ接口: 登录(check, ptlogin2/login, channel/login2),
+群列表, 群成员, 群号, 长轮询(poll2), 发送群消息, 心跳和群图片,
+用于在没有QQ的情况下测试和性能测试
+
+    python tools/webqq_standin.py --port 8090 --groups 10 --rate 20
+
+settings.py中设置 WEBQQ_SERVER = "http://127.0.0.1:8090", 第i个群(从0开始)
+的群号为 10000 + i, 如 BRIDGES = ((10000, "peer0@localhost"),)
+`--rate` 每秒生成多少条群消息(轮流发到各群), `--images` 带图片的消息比例,
+`--latency` 每个响应延迟的秒数, `--chunked` 以chunked编码分块发送响应,
+`--gzip` 压缩响应. 退出(Ctrl-C或SIGTERM)时打印生成和收到的消息数
+
+`--fault` 注入故障, 可重复, 格式为 "类型@接口名?参数", 如
+
+    --fault "reset@poll2?after=30" --fault "expire@*?retcode=103&after=60"
+
+也可在运行中请求 /standin/fault?kind=status&name=send_qun_msg2&code=502,
+/standin/clear 清除所有故障, /standin/faults 查看各故障的触发时间
+类型见 `Fault`, 参数:
+    count   对之后多少个请求生效, 0为直到清除, 默认1
+    after   多少秒后生效
+    code    status的HTTP状态码, 默认500
+    retcode retcode和expire返回的retcode, 默认121
+    delay   slow延迟的秒数, 默认5
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import heapq
+import Queue
+import random
+import signal
+import socket
+import select
+import struct
+import optparse
+import urlparse
+import itertools
+
+GCODE_BASE = 1000       # 群的gcode(uin)
+GID_BASE = 2000         # 群的gid, 发送群消息时使用
+QID_BASE = 10000        # 群号
+MEMBER_BASE = 100000    # 群成员的uin
+SELF_UIN = 1685359365
+
+# 1x1的GIF, 作为群图片
+PICTURE = ("GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9"
+           "\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00"
+           "\x02\x02D\x01\x00;")
+
+REASONS = {200: "OK", 404: "Not Found", 500: "Internal Server Error",
+           502: "Bad Gateway", 503: "Service Unavailable",
+           504: "Gateway Timeout"}
+
+
+def gcode(index):
+    return GCODE_BASE + index
+
+
+def group_index(value, base):
+    """ gcode/gid/群号 -> 群的序号 """
+    try:
+        return int(value) - base
+    except (TypeError, ValueError):
+        return None
+
+
+class Request(object):
+    def __init__(self, method, target, headers, body):
+        self.method = method
+        parse = urlparse.urlparse(target)
+        self.path = parse.path
+        self.headers = headers
+        self.query = dict(urlparse.parse_qsl(parse.query))
+        self.form = dict(urlparse.parse_qsl(body)) if body else {}
+        self.keep_alive = headers.get("connection", "").lower() != "close"
+
+    @property
+    def name(self):
+        """ 接口名, 路径的最后一段 """
+        return self.path.rstrip("/").rsplit("/", 1)[-1]
+
+    def param(self, name, default = None):
+        return self.form.get(name, self.query.get(name, default))
+
+
+class Fault(object):
+    """ 对接口 `name` ("*"为所有接口)的请求注入的故障
+    reset       发送一半响应后以RST关闭连接
+    truncate    以chunked编码发送一半响应后关闭连接
+    stall       不响应, 连接保持打开
+    status      返回 `code` 状态码
+    retcode     返回 {"retcode": `retcode`}, 116时附带新的ptwebqq
+    slow        延迟 `delay` 秒后处理
+    expire      立即使当前会话失效, 之后带旧psessionid的poll2和
+                send_qun_msg2返回 `retcode`, 直到重新登录
+    `fired_at` 第一次触发的时间, `detected` 之后第一个发往 `detect` 接口
+    的请求的时间(qxbot察觉故障后重新发起的请求), expire为check
+    """
+    KINDS = ("reset", "truncate", "stall", "status", "retcode", "slow",
+             "expire")
+
+    def __init__(self, kind, name = "*", count = 1, after = 0, code = 500,
+                 retcode = 121, delay = 5, detect = None):
+        if kind not in self.KINDS:
+            raise ValueError("unknown fault {0}".format(kind))
+        self.kind = kind
+        self.name = name
+        self.count = count
+        self.after = after
+        self.code = code
+        self.retcode = retcode
+        self.delay = delay
+        if detect is None:
+            detect = "check" if kind == "expire" else name
+        self.detect = detect
+        self.fired = 0
+        self.fired_at = None
+        self.detected = None
+        self.cleared = False
+
+    @classmethod
+    def parse(cls, spec):
+        """ "类型@接口名?参数" """
+        kind, _, rest = spec.partition("@")
+        name, _, query = rest.partition("?")
+        params = dict(urlparse.parse_qsl(query))
+        params["kind"], params["name"] = kind, name or "*"
+        return cls.from_params(params)
+
+    @classmethod
+    def from_params(cls, params):
+        kwargs = {}
+        for key, convert in (("kind", str), ("name", str), ("count", int),
+                             ("after", float), ("code", int),
+                             ("retcode", int), ("delay", float),
+                             ("detect", str)):
+            if params.get(key) is not None:
+                kwargs[key] = convert(params[key])
+        return cls(**kwargs)
+
+    @property
+    def active(self):
+        return not self.cleared and (not self.count or
+                                     self.fired < self.count)
+
+    def matches(self, name):
+        return self.active and self.name in ("*", name)
+
+    def fire(self, now = None):
+        self.fired += 1
+        if self.fired_at is None:
+            self.fired_at = now or time.time()
+
+    def status(self):
+        return {"kind": self.kind, "name": self.name, "count": self.count,
+                "fired": self.fired, "fired_at": self.fired_at,
+                "detected": self.detected}
+
+
+class Connection(object):
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.buf = ""
+        self.closed = False
+        self.poll_timer = None      # 等待消息的poll2的超时
+        self.fault = None           # 下一个响应的故障(reset, truncate)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def handle_read(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error:
+            data = ""
+        if not data:
+            return False
+        self.buf += data
+        while True:
+            request = self._parse()
+            if request is None:
+                return True
+            self.server.handle(self, request)
+
+    def _parse(self):
+        pos = self.buf.find("\r\n\r\n")
+        if pos < 0:
+            return None
+        lines = self.buf[:pos].split("\r\n")
+        headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if len(self.buf) < pos + 4 + length:
+            return None
+        body = self.buf[pos + 4:pos + 4 + length]
+        self.buf = self.buf[pos + 4 + length:]
+        method, target = lines[0].split(" ")[:2]
+        return Request(method, target, headers, body)
+
+    def write(self, data):
+        if self.closed:
+            return
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            self.server.close(self)
+
+    def reset(self):
+        """ 以RST关闭连接 """
+        if not self.closed:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                 struct.pack("ii", 1, 0))
+        self.server.close(self)
+
+
+class WebQQStandin(object):
+    """ 单线程, select实现, 所有响应都在本线程中发送
+    其他线程通过 `inject` 发送群消息, `add_fault` 注入故障, `stop` 结束
+    `run` """
+    def __init__(self, options):
+        self.options = options
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((options.host, options.port))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+        self.conns = {}
+        self.polls = []             # 等待消息的poll2连接
+        self.pending = []           # 等待poll2取走的消息
+        self.msg_seq = itertools.count(1)
+        self.timers = []
+        self.timer_seq = itertools.count()
+        self.running = True
+        self.generated = 0
+        self.delivered = 0
+        self.received = {}          # 收到的群消息内容 -> 次数
+        self.requests = {}          # 接口名 -> 请求数
+        self.faults = []
+        self.psessionid = None      # 当前有效的会话, login2时更换
+        self.expire_retcode = 121   # 会话失效时返回的retcode
+        self.on_message = None      # 收到群消息时以 (群序号, 内容, 时间) 调用
+        self._incoming = Queue.Queue()
+        self._wake_r, self._wake_w = os.pipe()
+        if options.rate:
+            self.call_later(1.0 / options.rate, self.generate)
+        for spec in getattr(options, "fault", None) or ():
+            self._add_fault(Fault.parse(spec))
+
+    # 定时器
+    def call_later(self, delay, callback, *args):
+        timer = [time.time() + delay, next(self.timer_seq), callback, args]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    @staticmethod
+    def cancel(timer):
+        if timer is not None:
+            timer[2] = None
+
+    def _run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.timers)
+            if callback is not None:
+                callback(*args)
+
+    def _timeout(self):
+        while self.timers and self.timers[0][2] is None:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return 0.5
+        return max(0, min(0.5, self.timers[0][0] - time.time()))
+
+    # 其他线程调用
+    def call(self, callback, *args):
+        """ 在本线程中调用 """
+        self._incoming.put((callback, args))
+        os.write(self._wake_w, "x")
+
+    def inject(self, index, text, images = 0):
+        """ 在第 `index` 个群中产生一条消息 """
+        self.call(self.add_message, index, text, images)
+
+    def add_fault(self, fault):
+        """ 注入故障, 返回 `fault`, 可从其属性读取触发和察觉的时间 """
+        self.call(self._add_fault, fault)
+        return fault
+
+    def stop(self):
+        self.running = False
+        os.write(self._wake_w, "x")
+
+    # 消息
+    def generate(self):
+        """ 按 `--rate` 轮流在各群中产生消息 """
+        options = self.options
+        index = self.generated % options.groups
+        text = u"msg {0} {1}".format(self.generated,
+                                     u"x" * max(0, options.length - 16))
+        images = 1 if random.random() < options.images else 0
+        self.add_message(index, text, images)
+        self.deliver()
+        self.call_later(1.0 / options.rate, self.generate)
+
+    def add_message(self, index, text, images = 0):
+        seq = next(self.msg_seq)
+        content = [["font", {"size": 10, "color": "000000",
+                             "style": [0, 0, 0], "name": u"宋体"}], text]
+        for i in range(images):
+            content.append(["cface", {"name": "{0}-{1}.gif".format(seq, i),
+                                      "file_id": seq, "key": "standin",
+                                      "server": "127.0.0.1:80"}])
+        member = random.randrange(self.options.members)
+        self.pending.append({
+            "poll_type": "group_message",
+            "value": {"msg_id": seq, "from_uin": GID_BASE + index,
+                      "to_uin": SELF_UIN, "msg_id2": seq, "msg_type": 43,
+                      "reply_ip": 0, "group_code": gcode(index),
+                      "send_uin": MEMBER_BASE + index * 1000 + member,
+                      "seq": seq, "time": int(time.time()),
+                      "info_seq": QID_BASE + index, "content": content}})
+        self.generated += 1
+
+    def deliver(self):
+        """ 有等待的poll2时把所有未取走的消息返回给它 """
+        while self.pending and self.polls:
+            conn = self.polls.pop(0)
+            self.cancel(conn.poll_timer)
+            conn.poll_timer = None
+            messages, self.pending = self.pending, []
+            self.delivered += len(messages)
+            self.reply_json(conn, {"retcode": 0, "result": messages})
+
+    def _drain_incoming(self):
+        os.read(self._wake_r, 4096)
+        while True:
+            try:
+                callback, args = self._incoming.get_nowait()
+            except Queue.Empty:
+                break
+            callback(*args)
+        self.deliver()
+
+    # 故障
+    def _add_fault(self, fault):
+        if fault.after:
+            after, fault.after = fault.after, 0
+            self.call_later(after, self._add_fault, fault)
+            return
+        if fault.kind == "expire":
+            self.expire(fault)
+        else:
+            self.faults.append(fault)
+
+    def expire(self, fault):
+        """ 会话失效, 等待中的poll2立即返回 """
+        fault.fire()
+        self.psessionid = None
+        self.expire_retcode = fault.retcode
+        self.faults.append(fault)
+        for conn in self.polls[:]:
+            self.polls.remove(conn)
+            self.cancel(conn.poll_timer)
+            conn.poll_timer = None
+            self.reply_json(conn, {"retcode": fault.retcode, "errmsg": ""})
+
+    def clear_faults(self):
+        for fault in self.faults:
+            fault.cleared = True
+
+    def _detect(self, name, now):
+        for fault in self.faults:
+            if fault.detected is None and fault.fired_at is not None and \
+               fault.detect == name and now > fault.fired_at:
+                fault.detected = now
+
+    def apply_fault(self, conn, request):
+        """ 对请求应用故障, 返回True表示已处理 """
+        name = request.name
+        for fault in self.faults:
+            if fault.kind != "expire" and fault.matches(name):
+                break
+        else:
+            return False
+        if fault.kind in ("reset", "truncate"):
+            # 在发送响应时生效, 故障时间从那时算起
+            fault.fired += 1
+            conn.fault = fault
+            return False
+        fault.fire()
+        if fault.kind == "stall":
+            return True
+        if fault.kind == "status":
+            self.reply(conn, "standin fault", code = fault.code)
+        elif fault.kind == "retcode":
+            data = {"retcode": fault.retcode, "errmsg": ""}
+            if fault.retcode == 116:
+                data["p"] = "{0:032x}".format(random.getrandbits(128))
+            self.reply_json(conn, data)
+        else:
+            self.call_later(fault.delay, self.dispatch, conn, request)
+        return True
+
+    def session_valid(self, conn, psessionid):
+        """ psessionid已失效时返回retcode """
+        if psessionid == self.psessionid:
+            return True
+        self.reply_json(conn, {"retcode": self.expire_retcode, "errmsg": ""})
+        return False
+
+    # HTTP
+    def reply(self, conn, body, content_type = "text/plain; charset=utf-8",
+              code = 200, headers = ()):
+        if isinstance(body, unicode):
+            body = body.encode("utf-8")
+        if self.options.latency:
+            self.call_later(self.options.latency, self.send_response, conn,
+                            body, content_type, code, headers)
+        else:
+            self.send_response(conn, body, content_type, code, headers)
+
+    def reply_json(self, conn, data, headers = ()):
+        self.reply(conn, json.dumps(data), "application/json; charset=utf-8",
+                   headers = headers)
+
+    def send_response(self, conn, body, content_type, code = 200,
+                      headers = ()):
+        options = self.options
+        head = ["HTTP/1.1 {0} {1}".format(code, REASONS.get(code, "")),
+                "Content-Type: " + content_type,
+                "Connection: keep-alive"]
+        head.extend(headers)
+        if options.gzip:
+            compress = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compress.compress(body) + compress.flush()
+            head.append("Content-Encoding: gzip")
+        if options.chunked:
+            head.append("Transfer-Encoding: chunked")
+            size = options.chunk_size
+            chunks = ["{0:x}\r\n{1}\r\n".format(len(body[i:i + size]),
+                                                body[i:i + size])
+                      for i in range(0, len(body), size)]
+            data = "".join(chunks) + "0\r\n\r\n"
+        else:
+            head.append("Content-Length: {0}".format(len(body)))
+            data = body
+        fault, conn.fault = conn.fault, None
+        if fault is not None:
+            self.send_broken(conn, fault, head, body, data)
+            return
+        conn.write("\r\n".join(head) + "\r\n\r\n" + data)
+
+    def send_broken(self, conn, fault, head, body, data):
+        """ 发送一半响应后中断连接 """
+        fault.fired_at = fault.fired_at or time.time()
+        if fault.kind == "truncate" and not self.options.chunked:
+            head = [h for h in head if not h.startswith("Content-Length")]
+            head.append("Transfer-Encoding: chunked")
+            data = "{0:x}\r\n{1}\r\n".format(len(body), body)
+        conn.write("\r\n".join(head) + "\r\n\r\n" + data[:len(data) // 2])
+        if fault.kind == "reset":
+            conn.reset()
+        else:
+            self.close(conn)
+
+    def handle(self, conn, request):
+        name = request.name
+        self.requests[name] = self.requests.get(name, 0) + 1
+        if self.faults:
+            self._detect(name, time.time())
+            if self.apply_fault(conn, request):
+                return
+        self.dispatch(conn, request)
+
+    def dispatch(self, conn, request):
+        if conn.closed:
+            return
+        method = getattr(self, "handle_" + request.name, None)
+        if method is None:
+            self.reply(conn, "not found", code = 404)
+            return
+        method(conn, request)
+
+    def handle_check(self, conn, request):
+        self.reply(conn, "ptui_checkVC('0','!QXB','\\x00\\x00\\x00\\x00"
+                         "\\x64\\x74\\x8b\\x05');")
+
+    def handle_login(self, conn, request):
+        cookies = ["Set-Cookie: {0}={1}; PATH=/; DOMAIN=qq.com"
+                   .format(key, value) for key, value in
+                   (("ptwebqq", "{0:032x}".format(random.getrandbits(128))),
+                    ("skey", "@standin"), ("uin", "o{0}".format(SELF_UIN)))]
+        self.reply(conn, u"ptuiCB('0','0','http://www.qq.com','0',"
+                         u"'登录成功！', 'standin');", headers = cookies)
+
+    def handle_login2(self, conn, request):
+        self.psessionid = "standin{0:032x}".format(random.getrandbits(128))
+        self.reply_json(conn, {"retcode": 0, "result": {
+            "uin": SELF_UIN, "cip": 0, "index": 1075, "port": 43332,
+            "status": "online", "vfwebqq": "standin_vfwebqq",
+            "psessionid": self.psessionid, "user_state": 0, "f": 0}})
+
+    def handle_get_group_name_list_mask2(self, conn, request):
+        groups = [{"gid": GID_BASE + i, "code": gcode(i), "flag": 0,
+                   "name": u"群{0}".format(i)}
+                  for i in range(self.options.groups)]
+        self.reply_json(conn, {"retcode": 0, "result": {
+            "gnamelist": groups, "gmasklist": [], "gmarklist": []}})
+
+    def handle_get_group_info_ext2(self, conn, request):
+        index = group_index(request.param("gcode"), GCODE_BASE) or 0
+        members = [{"uin": MEMBER_BASE + index * 1000 + i,
+                    "nick": u"user{0}".format(i),
+                    "gender": ("male", "female")[i % 2]}
+                   for i in range(self.options.members)]
+        self.reply_json(conn, {"retcode": 0, "result": {
+            "minfo": members, "cards": [],
+            "ginfo": {"gid": GID_BASE + index, "code": gcode(index),
+                      "name": u"群{0}".format(index)}}})
+
+    def handle_get_friend_uin2(self, conn, request):
+        index = group_index(request.param("tuin"), GCODE_BASE) or 0
+        self.reply_json(conn, {"retcode": 0, "result": {
+            "uiuin": "", "account": QID_BASE + index,
+            "uin": gcode(index)}})
+
+    def handle_poll2(self, conn, request):
+        if not self.session_valid(conn, request.param("psessionid")):
+            return
+        self.polls.append(conn)
+        conn.poll_timer = self.call_later(self.options.poll_timeout,
+                                          self.poll_timeout, conn)
+        self.deliver()
+
+    def poll_timeout(self, conn):
+        conn.poll_timer = None
+        if conn in self.polls:
+            self.polls.remove(conn)
+            self.reply_json(conn, {"retcode": 102, "errmsg": ""})
+
+    def handle_send_qun_msg2(self, conn, request):
+        try:
+            r = json.loads(request.param("r"))
+            text = json.loads(r["content"])[0]
+        except (TypeError, ValueError, KeyError, IndexError):
+            self.reply_json(conn, {"retcode": 100001})
+            return
+        if not self.session_valid(conn, r.get("psessionid")):
+            return
+        self.received[text] = self.received.get(text, 0) + 1
+        if self.on_message is not None:
+            self.on_message(group_index(r.get("group_uin"), GID_BASE), text,
+                            time.time())
+        self.reply_json(conn, {"retcode": 0, "result": "ok"})
+
+    def handle_get_msg_tip(self, conn, request):
+        self.reply_json(conn, {"retcode": 0, "result": {}})
+
+    def handle_get_group_pic(self, conn, request):
+        self.reply(conn, PICTURE, "image/gif")
+
+    # 控制接口, 路径为 /standin/<命令>
+    def handle_fault(self, conn, request):
+        params = dict(request.query, **request.form)
+        try:
+            fault = Fault.from_params(params)
+        except (TypeError, ValueError), err:
+            self.reply_json(conn, {"error": str(err)})
+            return
+        self._add_fault(fault)
+        self.reply_json(conn, fault.status())
+
+    def handle_clear(self, conn, request):
+        self.clear_faults()
+        self.reply_json(conn, {"faults": len(self.faults)})
+
+    def handle_faults(self, conn, request):
+        self.reply_json(conn, [fault.status() for fault in self.faults])
+
+    # 连接
+    def close(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        self.conns.pop(conn.fileno(), None)
+        if conn in self.polls:
+            self.polls.remove(conn)
+        self.cancel(conn.poll_timer)
+        conn.sock.close()
+
+    def run(self):
+        while self.running:
+            socks = [self.sock, self._wake_r] + self.conns.values()
+            readable, _, _ = select.select(socks, [], [], self._timeout())
+            for sock in readable:
+                if sock is self.sock:
+                    client, _ = self.sock.accept()
+                    self.conns[client.fileno()] = Connection(self, client)
+                elif sock is self._wake_r:
+                    self._drain_incoming()
+                elif not sock.closed and not sock.handle_read():
+                    self.close(sock)
+            self._run_timers()
+
+    def report(self):
+        total = sum(self.received.itervalues())
+        duplicated = sum(n - 1 for n in self.received.itervalues())
+        sys.stderr.write("generated: {0}, delivered: {1}, received: {2}, "
+                         "duplicated: {3}\nrequests: {4}\n"
+                         .format(self.generated, self.delivered, total,
+                                 duplicated, json.dumps(self.requests,
+                                                        sort_keys = True)))
+
+
+def make_parser():
+    parser = optparse.OptionParser()
+    parser.add_option("--host", default = "127.0.0.1")
+    parser.add_option("--port", type = "int", default = 8090)
+    parser.add_option("--groups", type = "int", default = 1,
+                      help = u"群的数量")
+    parser.add_option("--members", type = "int", default = 20,
+                      help = u"每个群的成员数")
+    parser.add_option("--rate", type = "float", default = 0,
+                      help = u"每秒生成多少条群消息")
+    parser.add_option("--length", type = "int", default = 32,
+                      help = u"生成的消息长度")
+    parser.add_option("--images", type = "float", default = 0,
+                      help = u"带图片的消息比例")
+    parser.add_option("--latency", type = "float", default = 0,
+                      help = u"每个响应延迟的秒数")
+    parser.add_option("--poll-timeout", type = "float", default = 30,
+                      help = u"没有消息时poll2保持多少秒")
+    parser.add_option("--chunked", action = "store_true",
+                      help = u"以chunked编码发送响应")
+    parser.add_option("--chunk-size", type = "int", default = 512)
+    parser.add_option("--gzip", action = "store_true",
+                      help = u"gzip压缩响应")
+    parser.add_option("--fault", action = "append", default = [],
+                      help = u"注入故障, 如 reset@poll2?after=30")
+    return parser
+
+
+def main():
+    options, _ = make_parser().parse_args()
+    server = WebQQStandin(options)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/18 17:05:12
+#   Desc    :   本地测试用的最小XMPP服务器
+#
+""" 只实现qxbot用到的部分: SASL PLAIN(接受任意密码), 资源绑定, 会话,
+空名册, 流管理(XEP-0198)和消息回显, 用于在本地测试断线恢复和性能
+
+    python tools/xmpp_standin.py --port 5222 --drop-every 30
+
+settings.py中设置 XMPP_SERVER = "127.0.0.1" 连接到此服务器
+`--drop-every` 每隔N秒断开客户端连接, `--no-resume` 拒绝恢复会话,
+`--echo` 把收到的消息原样发回.
+退出(Ctrl-C或SIGTERM)时打印收到的消息数和重复数
+"""
+import os
+import sys
+import time
+import uuid
+import Queue
+import signal
+import socket
+import select
+import optparse
+import xml.parsers.expat
+from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr
+
+STREAM_NS = "http://etherx.jabber.org/streams"
+SASL_NS = "urn:ietf:params:xml:ns:xmpp-sasl"
+BIND_NS = "urn:ietf:params:xml:ns:xmpp-bind"
+SESSION_NS = "urn:ietf:params:xml:ns:xmpp-session"
+SM_NS = "urn:xmpp:sm:3"
+CLIENT_NS = "jabber:client"
+STANZAS = ("message", "presence", "iq")
+
+
+class StreamParser(object):
+    """ 增量解析XMPP流, 每个一级元素解析完后调用 `on_element` """
+    def __init__(self, on_start, on_element):
+        self.on_start = on_start
+        self.on_element = on_element
+        self.parser = xml.parsers.expat.ParserCreate("utf-8", " ")
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._data
+        self.depth = 0
+        self.builder = None
+
+    @staticmethod
+    def _qname(name):
+        if " " in name:
+            return "{%s}%s" % tuple(name.split(" ", 1))
+        return name
+
+    def feed(self, data):
+        self.parser.Parse(data, False)
+
+    def _start(self, name, attrs):
+        self.depth += 1
+        attrs = dict((self._qname(k), v) for k, v in attrs.items())
+        if self.depth == 1:
+            self.on_start(self._qname(name), attrs)
+            return
+        if self.depth == 2:
+            self.builder = ElementTree.TreeBuilder()
+        self.builder.start(self._qname(name), attrs)
+
+    def _end(self, name):
+        self.depth -= 1
+        if self.depth == 0:
+            raise EOFError("stream closed")
+        self.builder.end(self._qname(name))
+        if self.depth == 1:
+            self.on_element(self.builder.close())
+            self.builder = None
+
+    def _data(self, data):
+        if self.builder is not None:
+            self.builder.data(data)
+
+
+class Session(object):
+    """ 可恢复的流管理会话 """
+    def __init__(self, jid):
+        self.id = uuid.uuid4().hex
+        self.jid = jid
+        self.inbound = 0
+        self.acked = 0
+        self.unacked = []
+
+
+class Connection(object):
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.out = []
+        self.opened = time.time()
+        self.authenticated = None
+        self.jid = None
+        self.session = None
+        self.new_parser()
+
+    def new_parser(self):
+        self.parser = StreamParser(self.stream_start, self.element)
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self.out.append(data)
+
+    def send_element(self, element):
+        self.write(ElementTree.tostring(element))
+
+    def send_stanza(self, stanza):
+        self.send_element(stanza)
+        if self.session is not None:
+            self.session.unacked.append(stanza)
+
+    def stream_start(self, name, attrs):
+        self.write(u"<?xml version='1.0'?><stream:stream xmlns='{0}' "
+                   u"xmlns:stream='{1}' id='{2}' from={3} version='1.0'>"
+                   .format(CLIENT_NS, STREAM_NS, uuid.uuid4().hex,
+                           quoteattr(attrs.get("to", "localhost"))))
+        if self.authenticated is None:
+            self.write(u"<stream:features><mechanisms xmlns='{0}'>"
+                       u"<mechanism>PLAIN</mechanism></mechanisms>"
+                       u"</stream:features>".format(SASL_NS))
+        else:
+            sm = u"<sm xmlns='{0}'/>".format(SM_NS)
+            self.write(u"<stream:features><bind xmlns='{0}'/>"
+                       u"<session xmlns='{1}'/>{2}</stream:features>"
+                       .format(BIND_NS, SESSION_NS, sm))
+
+    def element(self, element):
+        tag = element.tag
+        if tag == "{%s}auth" % SASL_NS:
+            data = (element.text or "").decode("base64").split("\0")
+            self.authenticated = data[1] if len(data) > 1 else "user"
+            self.write(u"<success xmlns='{0}'/>".format(SASL_NS))
+            self.new_parser()
+            raise StopIteration     # 重新开始解析
+        elif tag.startswith("{%s}" % SM_NS):
+            self.sm_element(tag.split("}")[1], element)
+        elif tag.split("}")[1] in STANZAS:
+            if self.session is not None:
+                self.session.inbound += 1
+            self.stanza(tag.split("}")[1], element)
+
+    def sm_element(self, name, element):
+        if name == "enable":
+            self.session = Session(self.jid)
+            self.server.sessions[self.session.id] = self.session
+            resume = "false" if self.server.options.no_resume else "true"
+            self.write(u"<enabled xmlns='{0}' id='{1}' resume='{2}'/>"
+                       .format(SM_NS, self.session.id, resume))
+        elif name == "r":
+            self.write(u"<a xmlns='{0}' h='{1}'/>"
+                       .format(SM_NS, self.session.inbound))
+        elif name == "a":
+            self.ack(int(element.get("h")))
+        elif name == "resume":
+            session = self.server.sessions.get(element.get("previd"))
+            if session is None or self.server.options.no_resume:
+                self.write(u"<failed xmlns='{0}'><item-not-found xmlns="
+                           u"'urn:ietf:params:xml:ns:xmpp-stanzas'/>"
+                           u"</failed>".format(SM_NS))
+                return
+            self.session = session
+            self.jid = session.jid
+            self.ack(int(element.get("h")))
+            self.server.resumes += 1
+            self.write(u"<resumed xmlns='{0}' previd='{1}' h='{2}'/>"
+                       .format(SM_NS, session.id, session.inbound))
+            pending, session.unacked = session.unacked, []
+            for stanza in pending:
+                self.send_stanza(stanza)
+
+    def ack(self, h):
+        session = self.session
+        del session.unacked[:h - session.acked]
+        session.acked = h
+
+    def stanza(self, name, element):
+        if name == "iq":
+            self.iq(element)
+        elif name == "message":
+            body = element.find("{%s}body" % CLIENT_NS)
+            if body is None:
+                return
+            self.server.got_message(body.text or u"", element.get("to", ""))
+            if self.server.options.echo:
+                reply = ElementTree.Element("message", type = "chat")
+                reply.set("to", self.jid)
+                reply.set("from", element.get("to", ""))
+                ElementTree.SubElement(reply, "body").text = body.text
+                self.send_stanza(reply)
+
+    def iq(self, element):
+        result = ElementTree.Element("iq", type = "result",
+                                     id = element.get("id", ""))
+        bind = element.find("{%s}bind" % BIND_NS)
+        if bind is not None:
+            resource = bind.findtext("{%s}resource" % BIND_NS) or "standin"
+            self.jid = u"{0}/{1}".format(self.authenticated, resource)
+            node = ElementTree.SubElement(result, "{%s}bind" % BIND_NS)
+            ElementTree.SubElement(node, "{%s}jid" % BIND_NS).text = self.jid
+        elif element.find("{jabber:iq:roster}query") is not None:
+            ElementTree.SubElement(result, "{jabber:iq:roster}query")
+        elif element.get("type") not in ("get", "set"):
+            return
+        self.send_stanza(result)
+
+    def handle_read(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error:
+            data = ""
+        if not data:
+            return False
+        while data:
+            try:
+                self.parser.feed(data)
+                data = ""
+            except StopIteration:
+                data = ""       # SASL成功后客户端会重新发送流头
+            except EOFError:
+                self.write(u"</stream:stream>")
+                return False
+        return True
+
+    def flush(self):
+        if self.out:
+            data = "".join(self.out)
+            self.out = []
+            try:
+                self.sock.sendall(data)
+            except socket.error:
+                return False
+        return True
+
+
+class StandinServer(object):
+    def __init__(self, options):
+        self.options = options
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((options.host, options.port))
+        self.sock.listen(16)
+        self.conns = {}
+        self.sessions = {}
+        self.messages = {}
+        self.resumes = 0
+        self.drops = 0
+        self.running = True
+        self.on_message = None      # 收到消息时以 (接收人, 内容, 时间) 调用
+        self._incoming = Queue.Queue()
+        self._wake_r, self._wake_w = os.pipe()
+
+    def got_message(self, body, to = u""):
+        self.messages[body] = self.messages.get(body, 0) + 1
+        if self.on_message is not None:
+            self.on_message(to, body, time.time())
+
+    def inject(self, from_jid, body):
+        """ 其他线程调用: 以 `from_jid` 向已登录的客户端发送消息 """
+        self._incoming.put((from_jid, body))
+        os.write(self._wake_w, "x")
+
+    def stop(self):
+        self.running = False
+        os.write(self._wake_w, "x")
+
+    def _drain_incoming(self):
+        os.read(self._wake_r, 4096)
+        conns = [c for c in self.conns.values() if c.jid is not None]
+        while True:
+            try:
+                from_jid, body = self._incoming.get_nowait()
+            except Queue.Empty:
+                break
+            for conn in conns:
+                message = ElementTree.Element("message", type = "chat")
+                message.set("to", conn.jid)
+                message.set("from", from_jid)
+                ElementTree.SubElement(message, "body").text = body
+                conn.send_stanza(message)
+        for conn in conns:
+            if not conn.flush():
+                self.close(conn)
+
+    def close(self, conn):
+        self.conns.pop(conn.sock.fileno(), None)
+        conn.sock.close()
+
+    def run(self):
+        last_drop = time.time()
+        while self.running:
+            socks = [self.sock, self._wake_r] + [c.sock for c
+                                                 in self.conns.values()]
+            readable, _, _ = select.select(socks, [], [], 0.5)
+            for sock in readable:
+                if sock is self._wake_r:
+                    self._drain_incoming()
+                    continue
+                if sock is self.sock:
+                    client, _ = self.sock.accept()
+                    self.conns[client.fileno()] = Connection(self, client)
+                    continue
+                conn = self.conns.get(sock.fileno())
+                if conn is None:
+                    continue        # 本轮中已关闭
+                if not conn.handle_read() or not conn.flush():
+                    conn.flush()
+                    self.close(conn)
+            drop_every = self.options.drop_every
+            if drop_every and time.time() - last_drop >= drop_every:
+                last_drop = time.time()
+                for conn in self.conns.values():
+                    self.drops += 1
+                    sys.stderr.write("drop connection\n")
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                    self.close(conn)
+
+    def report(self):
+        total = sum(self.messages.itervalues())
+        duplicated = sum(n - 1 for n in self.messages.itervalues())
+        sys.stderr.write("messages: {0}, distinct: {1}, duplicated: {2}, "
+                         "drops: {3}, resumes: {4}\n"
+                         .format(total, len(self.messages), duplicated,
+                                 self.drops, self.resumes))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--host", default = "127.0.0.1")
+    parser.add_option("--port", type = "int", default = 5222)
+    parser.add_option("--drop-every", type = "float", default = 0,
+                      help = u"每隔多少秒断开客户端连接")
+    parser.add_option("--no-resume", action = "store_true",
+                      help = u"不允许恢复会话")
+    parser.add_option("--echo", action = "store_true",
+                      help = u"把收到的消息发回")
+    options, _ = parser.parse_args()
+    server = StandinServer(options)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,75 +6,97 @@
 #   Date    :   13/03/08 11:04:50
 #   Desc    :   WebQQ Base Handler
 #
-import threading
+import time
+
 from ..http_socket import HTTPSock
-from pyxmpp2.mainloop.interfaces import IOHandler, HandlerReady
+from ..webqqevents import RetryEvent
+
 
+class WebQQHandler(object):
+    """ WebQQ接口请求的基类
+    子类在 `setup` 中构造 `self.req`, 在 `handle_response` 中处理
+    `HTTPClient` 返回的 `HTTPResult`
 
-class WebQQHandler(IOHandler):
+    `pool_size` 大于0的子类(轮询, 心跳等频繁创建的handler)通过 `acquire`
+    获取, 请求处理完毕后自动放回对象池复用. 子类需定义 `__slots__`
+    `phase` 不为None的handler记入启动时间线, 由WebQQ在成功时结束该阶段
+    """
+    __slots__ = ("webqq", "req", "args", "kwargs", "method", "started")
     http_sock = HTTPSock()
+    timeout = 10        # 单次请求超时
+    retries = 2         # HTTPClient 内部的重试次数
+    retry_delay = 5     # 重试都失败后, 延迟多久重新创建handler
+    pool_size = 0
+    _pool = None
+    phase = None        # 启动时间线中的阶段名
+
     def __init__(self, webqq, req = None, *args, **kwargs):
+        self._reset(webqq, req, args, kwargs)
+
+    def _reset(self, webqq, req, args, kwargs):
         self.req = req
-        self._readable = False
-        self._writable = True
         self.webqq = webqq
-        self.lock = threading.RLock()
-        self._cond = threading.Condition(self.lock)
+        self.args = args
+        self.kwargs = kwargs
         self.setup(*args, **kwargs)
 
-    def fileno(self):
-        with self.lock:
-            if self.sock is not None:
-                return self.sock.fileno()
-
-        return None
-
-    def is_readable(self):
-        return self.sock is not None and self._readable
-
-    def wait_for_readability(self):
-        with self.lock:
-            while True:
-                if self.sock is None or not self._readable:
-                    return False
-                else:
-                    return True
-            self._cond.wait()
-
-
-    def is_writable(self):
-        with self.lock:
-            return self.sock and self.data and self._writable
-
-    def wait_for_writability(self):
-        with self.lock:
-            while True:
-                if self.sock and self.data and self._writable:
-                    return True
-                else:
-                    return False
-            self._cond.wait()
-
-    def prepare(self):
-        return HandlerReady()
-
-    def handle_read(self):
+    @classmethod
+    def acquire(cls, webqq, req = None, *args, **kwargs):
+        """ 从对象池取出handler并重新初始化, 池为空时新建 """
+        if cls._pool:
+            handler = cls._pool.pop()
+            handler._reset(webqq, req, args, kwargs)
+            return handler
+        return cls(webqq, req, *args, **kwargs)
+
+    def release(self):
+        """ 放回对象池, 之后不可再使用该handler """
+        pool = self._pool
+        if pool is not None and len(pool) < self.pool_size:
+            self.req = None
+            self.args = ()
+            self.kwargs = {}
+            pool.append(self)
+
+    def setup(self):
         pass
 
-    def handle_hup(self):
-        with self.lock:
-            pass
-
-    def handle_write(self):
+    def timeline_phase(self):
+        return self.phase
+
+    def run(self, delay = 0):
+        """ 通过webqq的HTTPClient发送请求 """
+        phase = self.timeline_phase()
+        if phase is not None:
+            self.webqq.timeline.start(phase)
+        self.started = time.time() + delay
+        self.webqq.http_client.fetch(self.req, self._on_response,
+                                     timeout = self.timeout,
+                                     retries = self.retries, delay = delay)
+        return self
+
+    def _on_response(self, resp):
+        phase = self.timeline_phase()
+        if phase is not None:
+            self.webqq.timeline.add(phase, resp.retries, len(resp.body or ""))
+        name = self.__class__.__name__
+        self.webqq.request_time.observe(time.time() - self.started, (name,))
+        if resp.retries:
+            self.webqq.retry_count.inc((name, "http"), resp.retries)
+        try:
+            self.handle_response(resp)
+        finally:
+            self.release()
+
+    def handle_response(self, resp):
         pass
 
-    def handle_err(self):
-        with self.lock:
-            self.sock.close()
-
-    def handle_nval(self):
-        if self.sock is None:
-            return
-
-    def close(self):
-        self.sock.close()
+    def retry(self, err = None):
+        """ 稍后用相同的请求重新创建handler """
+        phase = self.timeline_phase()
+        if phase is not None:
+            self.webqq.timeline.add(phase, retries = 1)
+        self.webqq.retry_count.inc((self.__class__.__name__, "handler"))
+        self.webqq.event(RetryEvent(self.__class__, self.req, self, err,
+                                    *self.args, **self.kwargs),
+                         self.retry_delay)
@@ -16,6 +16,8 @@ class BeforeLoginHandler(WebQQHandler):
     先检查是否需要验证码,不需要验证码则首先执行一次登录
     然后获取Cookie里的ptwebqq,skey保存在实例里,供后面的接口调用
     """
+    __slots__ = ()
+    phase = "before_login"
     def setup(self, password = None):
         self.method = "GET"
         if not self.req:
@@ -39,16 +41,10 @@ class BeforeLoginHandler(WebQQHandler):
                                 "oginproxy.html&f_url=loginerroralert&stron"
                                 "g_login=1&login_state=10&t=20130221001")
 
-        self.sock, self.data = self.http_sock.make_http_sock_data(self.req)
-
-    def handle_write(self):
-        self.sock.sendall(self.data)
-        self._readable = True
-        self._writable = False
-
-    def handle_read(self):
-        self._readable = False
-        resp = self.http_sock.make_response(self.sock, self.req, self.method)
-        self.webqq.blogin_data = resp.read().decode("utf-8")
-        self.webqq.event(BeforeLoginEvent(self.webqq.blogin_data, self))
+    def handle_response(self, resp):
+        if resp.error:
+            self.retry(resp.error)
+            return
+        self.webqq.blogin_data = resp.body.decode("utf-8")
         eval("self.webqq."+self.webqq.blogin_data.rstrip().rstrip(";"))
+        self.webqq.event(BeforeLoginEvent(self.webqq.blogin_data, self))
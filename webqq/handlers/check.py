@@ -17,6 +17,8 @@ class CheckHandler(WebQQHandler):
         ptui_checkVC('0','!PTH','\x00\x00\x00\x00\x64\x74\x8b\x05');
         第一个参数表示状态码, 0 不需要验证, 第二个为验证码, 第三个为uin
     """
+    __slots__ = ()
+    phase = "check"
     def setup(self):
         url = "http://check.ptlogin2.qq.com/check"
         params = {"uin":self.webqq.qid, "appid":self.webqq.aid,
@@ -24,15 +26,10 @@ class CheckHandler(WebQQHandler):
         self.method = "GET"
         if not self.req:
             self.req = self.http_sock.make_request(url, params, self.method)
-        self.sock, self.data = self.http_sock.make_http_sock_data(self.req)
 
-    def handle_read(self):
-        self._readable = False
-        resp = self.http_sock.make_response(self.sock, self.req, self.method)
-        self.webqq.check_data = resp.read()
+    def handle_response(self, resp):
+        if resp.error:
+            self.retry(resp.error)
+            return
+        self.webqq.check_data = resp.body
         self.webqq.event(CheckedEvent(self.webqq.check_data, self))
-
-    def handle_write(self):
-        self.sock.sendall(self.data)
-        self._writable = False
-        self._readable = True
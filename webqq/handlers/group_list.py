@@ -6,12 +6,13 @@
 #   Date    :   13/03/08 11:34:11
 #   Desc    :   组列表
 #
-import json
-import socket
 from .base import WebQQHandler
-from ..webqqevents import RetryEvent, GroupListEvent
+from ..webqqevents import GroupListEvent
 
 class GroupListHandler(WebQQHandler):
+    __slots__ = ("delay",)
+    phase = "group_list"
+
     def setup(self, delay = 0):
         self.delay = delay
         self.method = "POST"
@@ -22,30 +23,14 @@ class GroupListHandler(WebQQHandler):
             self.req.add_header("Origin", "http://s.web2.qq.com")
             self.req.add_header("Referer", "http://s.web2.qq.com/proxy.ht"
                                     "ml?v=20110412001&callback=1&id=1")
-        try:
-            self.sock, self.data = self.http_sock.make_http_sock_data(self.req)
-        except socket.error:
-            self.webqq.event(RetryEvent(GroupListHandler, self.req, self))
-            self.sock = None
-            self.data = None
-            self._writable = False
-
-    def handle_write(self):
-        self._writable = False
-        try:
-            self.sock.sendall(self.data)
-        except socket.error:
-            self.webqq.event(RetryEvent(GroupListHandler, self.req, self))
-        else:
-            self._readable = True
 
-    def handle_read(self):
-        self._readable = False
+    def run(self):
+        """ 延迟 `delay` 秒后获取, 用于定时刷新群列表 """
+        return WebQQHandler.run(self, self.delay)
 
-        try:
-            resp = self.http_sock.make_response(self.sock, self.req, self.method)
-            tmp = resp.read()
-            data = json.loads(tmp)
-            self.webqq.event(GroupListEvent(self, data), self.delay)
-        except ValueError:
-            pass
+    def handle_response(self, resp):
+        data = resp.json
+        if data is None:
+            self.retry(resp.error)
+            return
+        self.webqq.event(GroupListEvent(self, data))
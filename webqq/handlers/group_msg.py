@@ -7,14 +7,20 @@
 #   Desc    :   组消息
 #
 import json
-import socket
 from .base import WebQQHandler
-from ..webqqevents import RetryEvent, RemoveEvent
+from .poll import SESSION_EXPIRED
 
 class GroupMsgHandler(WebQQHandler):
-    def setup(self, group_uin = None, content = None):
+    __slots__ = ("group_uin", "content", "received", "trace")
+    pool_size = 16
+    _pool = []
+
+    def setup(self, group_uin = None, content = None, received = None,
+              trace = None):
         self.group_uin = group_uin
         self.content = content
+        self.received = received
+        self.trace = trace
         self.method = "POST"
         if not self.req:
             assert group_uin
@@ -34,23 +40,30 @@ class GroupMsgHandler(WebQQHandler):
             self.req = self.http_sock.make_request(url, params, self.method)
             self.req.add_header("Referer", "http://d.web2.qq.com/proxy.html")
 
-        try:
-            self.sock, self.data = self.http_sock.make_http_sock_data(self.req)
-        except socket.error:
-            self.webqq.event(RetryEvent(GroupMsgHandler, self.req, self,
-                                       self.group_uin, self.content))
-            self._writable = False
-            self.sock = None
-            self.data = None
+    def run(self, delay = 0):
+        """ 与上一条发送到该群的消息相同时不再发送 """
+        if self.content == self.webqq.last_msg.get(self.group_uin):
+            self.release()
+            return self
+        self.webqq.last_msg[self.group_uin] = self.content
+        return WebQQHandler.run(self, delay)
 
-    def handle_write(self):
-        self._writable = False
-        if self.content != self.webqq.last_msg.get(self.group_uin)  :
-            self.webqq.last_msg[self.group_uin] = self.content
-            try:
-                self.sock.sendall(self.data)
-            except socket.error:
-                self.webqq.event(RetryEvent(GroupMsgHandler, self.req, self,
-                                           self.group_uin, self.content))
-            else:
-                self.webqq.event(RemoveEvent(self))
+    def handle_response(self, resp):
+        data = resp.json
+        if resp.error or not isinstance(data, dict):
+            # 网络错误或服务器错误(5xx)
+            self.webqq.group_msg_sent(self.group_uin, None, self.received)
+            self.webqq.last_msg.pop(self.group_uin, None)
+            self.retry(resp.error or resp.code)
+            return
+        retcode = data.get("retcode")
+        if retcode in SESSION_EXPIRED:
+            # 请求中的psessionid已失效, 重新登录后用新会话发送
+            self.webqq.group_msg_sent(self.group_uin, retcode, self.received)
+            self.webqq.last_msg.pop(self.group_uin, None)
+            self.webqq.requeue_group_msg(self.group_uin, self.content,
+                                         self.received, self.trace)
+            self.webqq.session_expired(retcode)
+            return
+        self.webqq.group_msg_sent(self.group_uin, retcode, self.received,
+                                  self.trace)
@@ -6,14 +6,16 @@
 #   Date    :   13/03/08 11:25:11
 #   Desc    :   WebQQ心跳
 #
-import socket
 from .base import WebQQHandler
-from ..webqqevents import RetryEvent, WebQQHeartbeatEvent
+from ..webqqevents import WebQQHeartbeatEvent
 
 class HeartbeatHandler(WebQQHandler):
     """ 心跳 """
+    __slots__ = ("delay",)
+    pool_size = 1
+    _pool = []
+
     def setup(self, delay = 0):
-        self._readable = False
         self.delay = delay
         self.method = "GET"
 
@@ -23,25 +25,10 @@ class HeartbeatHandler(WebQQHandler):
                         ("rc", self.webqq.rc), ("lv", 2),
                     ("t", int(self.webqq.hb_last_time * 1000))]
             self.req = self.http_sock.make_request(url, params, self.method)
-        try:
-            self.sock, self.data = self.http_sock.make_http_sock_data(self.req)
-        except socket.error, err:
-            self.webqq.event(RetryEvent(HeartbeatHandler, self.req, self, err))
-            self._writable = False
-            self.sock = None
-            self.data = None
-
-    def handle_write(self):
-        self._writable = False
-        try:
-            self.sock.sendall(self.data)
-        except socket.error, err:
-            self.webqq.event(RetryEvent(HeartbeatHandler, self.req, self, err))
-        self.webqq.event(WebQQHeartbeatEvent(self), self.delay)
 
-    def is_readable(self):
-        return False
+    def run(self):
+        return WebQQHandler.run(self, self.delay)
 
-    def is_writable(self):
-        with self.lock:
-            return self.sock and self.data and self._writable
+    def handle_response(self, resp):
+        """ 无论成功与否都继续下一次心跳 """
+        self.webqq.event(WebQQHeartbeatEvent(self))
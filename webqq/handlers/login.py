@@ -6,7 +6,6 @@
 #   Date    :   13/03/08 11:23:10
 #   Desc    :   登录处理器
 #
-import json
 from .base import WebQQHandler
 from ..webqqevents import WebQQLoginedEvent
 
@@ -21,6 +20,8 @@ class LoginHandler(WebQQHandler):
             u'vfwebqq': u'', u'port': 43332}}
         保存result中的psessionid和vfwebqq供后面接口调用
     """
+    __slots__ = ()
+    phase = "login2"
     def setup(self):
         self.method = "POST"
         if not self.req:
@@ -36,18 +37,12 @@ class LoginHandler(WebQQHandler):
             self.req.add_header("Referer", "http://d.web2.qq.com/proxy.html?"
                                 "v=20110331002&callback=1&id=3")
             self.req.add_header("Origin", "http://d.web2.qq.com")
-        self.sock, self.data = self.http_sock.make_http_sock_data(self.req)
 
-    def handle_write(self):
-        self._writable = False
-        self.sock.sendall(self.data)
-        self._readable = True
-
-    def handle_read(self):
-        self._readable = False
-        resp = self.http_sock.make_response(self.sock, self.req, self.method)
-        tmp = resp.read()
-        data = json.loads(tmp)
+    def handle_response(self, resp):
+        data = resp.json
+        if data is None:
+            self.retry(resp.error)
+            return
         self.webqq.vfwebqq = data.get("result", {}).get("vfwebqq")
         self.webqq.psessionid = data.get("result", {}).get("psessionid")
         self.webqq.event(WebQQLoginedEvent(self))
@@ -6,18 +6,38 @@
 #   Date    :   13/03/08 11:28:36
 #   Desc    :   获取消息
 #
-import json
-import socket
-import httplib
+import time
+
 from .base import WebQQHandler
-from ..webqqevents import RetryEvent, WebQQPollEvent, WebQQMessageEvent
-from ..webqqevents import ReconnectEvent
+from ..webqqevents import WebQQPollEvent, WebQQMessageEvent
+
+SESSION_EXPIRED = (103, 121)    # 会话失效, 需要重新登录
+PTWEBQQ_CHANGED = 116           # ptwebqq更新, 新值在 "p" 中
 
 class PollHandler(WebQQHandler ):
-    """ 获取消息 """
+    """ 获取消息
+    poll2是长轮询, 服务器最长会保持连接约一分钟, 超过 `WebQQ.poll_timeout`
+    没有响应视为连接中断. 失败时不在HTTPClient中重试(超时会被重复计算),
+    由 `WebQQ.poll_failed` 按连续失败次数退避后重新轮询
+    """
+    __slots__ = ("_key", "_cached_req")
+    retries = 0
+    retry_delay = 1     # 连续失败时从此值起加倍
+    pool_size = 1
+    _pool = []
+
+    @property
+    def timeout(self):
+        return self.webqq.poll_timeout
+
     def setup(self):
         self.method = "POST"
         if not self.req:
+            # 同一会话中轮询的请求都相同, 复用上次构造的请求
+            key = (self.webqq.clientid, self.webqq.psessionid)
+            if getattr(self, "_key", None) == key:
+                self.req = self._cached_req
+                return
             url = "http://d.web2.qq.com/channel/poll2"
             params = [("r", '{"clientid":"%s", "psessionid":"%s",'
                     '"key":0, "ids":[]}' % (self.webqq.clientid,
@@ -27,43 +47,29 @@ class PollHandler(WebQQHandler ):
             self.req = self.http_sock.make_request(url, params, self.method)
             self.req.add_header("Referer", "http://d.web2.qq.com/proxy.html?v="
                                 "20110331002&callback=1&id=2")
-        try:
-            self.sock, self.data = self.http_sock.make_http_sock_data(self.req)
-        except socket.error:
-            self.webqq.event(RetryEvent(PollHandler, self.req, self))
-            self._writable = False
-            self.sock = None
-            self.data = None
-
-
-    def handle_write(self):
-        self._writable = False
-        try:
-            self.sock.sendall(self.data)
-        except socket.error:
-            self.webqq.event(RetryEvent(PollHandler, self.req, self))
-        else:
-            self._readable = True
-
-    def handle_read(self):
-        try:
-            resp = self.http_sock.make_response(self.sock, self.req, self.method)
-            tmp = resp.read()
-            data = json.loads(tmp)
-            if data:
-                self._readable = False
-                #if data.get("retcode") == 121:
-                #    self.webqq.event(ReconnectEvent(self))
-                self.webqq.event(WebQQPollEvent(self))
-                self.webqq.event(WebQQMessageEvent(data, self))
-        except ValueError:
-            pass
-        except socket.error:
-            self.webqq.event(WebQQPollEvent(self))
-        except httplib.BadStatusLine:
-            pass
-
-    def is_writable(self):
-        with self.lock:
-            return self.sock and self.data and self._writable
+            self._key = key
+            self._cached_req = self.req
 
+    def handle_response(self, resp):
+        received = time.time()
+        data = resp.json
+        # 重新登录后仍未返回的旧会话的轮询
+        stale = self._key[1] != self.webqq.psessionid
+        if resp.error or not isinstance(data, dict):
+            # 网络错误, 服务器错误(5xx)或响应不完整, 稍后继续轮询
+            self.webqq.event(WebQQPollEvent(self),
+                             self.webqq.poll_failed(resp.error or resp.code))
+            return
+        retcode = data.get("retcode")
+        if retcode in SESSION_EXPIRED and not stale:
+            # 停止轮询, 重新登录后由 `handle_webqq_logined` 重新开始
+            self.webqq.polled = False
+            self.webqq.session_expired(retcode)
+            return
+        self.webqq.poll_succeeded()
+        if retcode == PTWEBQQ_CHANGED and data.get("p"):
+            self.webqq.ptwebqq = data.get("p")
+        self.webqq.event(WebQQPollEvent(self))
+        if retcode not in SESSION_EXPIRED:
+            timing = (resp.first_byte or received, received, time.time())
+            self.webqq.event(WebQQMessageEvent(data, self, timing))
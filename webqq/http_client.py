@@ -0,0 +1,634 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   13/03/13 15:02:47
+#   Desc    :   基于EpollMainLoop的异步HTTP客户端
+#
+import os
+import ssl
+import json
+import time
+import zlib
+import errno
+import socket
+import httplib
+import urlparse
+from functools import partial
+from cStringIO import StringIO
+
+from lib.libepoll import SocketIOHandler
+from lib.resolver import Resolver
+from lib.utils import get_logger
+
+_BLOCKING_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK)
+_SSL_WANT = (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class HTTPResult(object):
+    """ `HTTPClient.fetch` 的结果, 出错时 `error` 不为None """
+    __slots__ = ("request", "url", "code", "headers", "body", "error",
+                 "retries", "redirects", "first_byte", "_json")
+
+    def __init__(self, request, code = None, headers = None, body = "",
+                 error = None):
+        self.request = request
+        self.url = request.get_full_url()
+        self.code = code
+        self.headers = headers
+        self.body = body
+        self.error = error
+        self.retries = 0
+        self.redirects = 0
+        self.first_byte = None      # 收到响应第一个字节的时间
+        self._json = None
+
+    @property
+    def json(self):
+        """ 将响应体解析为JSON, 无法解析时返回None """
+        if self._json is None and self.body:
+            try:
+                self._json = json.loads(self.body)
+            except ValueError:
+                pass
+        return self._json
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def read(self):
+        return self.body
+
+    def __repr__(self):
+        return "<HTTPResult {0} {1} error={2!r}>".format(self.code, self.url,
+                                                         self.error)
+
+
+def decode_body(body, encoding):
+    encoding = (encoding or "").strip().lower()
+    if encoding == "gzip":
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+class ResponseParser(object):
+    """ 增量解析HTTP响应, 支持Content-Length, chunked和读到连接关闭 """
+    __slots__ = ("buf", "code", "reason", "headers", "keep_alive", "done",
+                 "received", "first_byte", "_parts", "_mode", "_remaining",
+                 "_chunk")
+
+    def __init__(self):
+        self.buf = ""
+        self.code = None
+        self.reason = None
+        self.headers = None
+        self.keep_alive = False
+        self.done = False
+        self.received = 0
+        self.first_byte = None
+        self._parts = []
+        self._mode = None
+        self._remaining = 0
+        self._chunk = None   # None: 等待长度行, >0: 数据, 0: 等待CRLF, -1: trailer
+
+    def feed(self, data):
+        if not self.received:
+            self.first_byte = time.time()
+        self.received += len(data)
+        self.buf += data
+        if self.headers is None and not self._parse_head():
+            return
+        getattr(self, "_feed_" + self._mode)()
+
+    def _parse_head(self):
+        pos = self.buf.find("\r\n\r\n")
+        if pos < 0:
+            return False
+        status, _, header_text = self.buf[:pos].partition("\r\n")
+        self.buf = self.buf[pos + 4:]
+        parts = status.split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise httplib.BadStatusLine(status)
+        version = parts[0]
+        self.code = int(parts[1])
+        self.reason = parts[2] if len(parts) > 2 else ""
+        self.headers = httplib.HTTPMessage(StringIO(header_text + "\r\n\r\n"))
+        te = self.headers.getheader("transfer-encoding", "")
+        length = self.headers.getheader("content-length")
+        if self.code in (204, 304) or 100 <= self.code < 200:
+            self._mode = "length"
+        elif "chunked" in te.lower():
+            self._mode = "chunked"
+        elif length is not None:
+            self._mode = "length"
+            self._remaining = int(length)
+        else:
+            self._mode = "close"
+        conn = self.headers.getheader("connection", "").lower()
+        self.keep_alive = (self._mode != "close" and conn != "close" and
+                           (version == "HTTP/1.1" or conn == "keep-alive"))
+        return True
+
+    def _feed_length(self):
+        take = self.buf[:self._remaining]
+        self.buf = self.buf[len(take):]
+        self._parts.append(take)
+        self._remaining -= len(take)
+        if self._remaining <= 0:
+            self.done = True
+
+    def _feed_close(self):
+        self._parts.append(self.buf)
+        self.buf = ""
+
+    def _feed_chunked(self):
+        while not self.done:
+            if self._chunk is None:
+                pos = self.buf.find("\r\n")
+                if pos < 0:
+                    return
+                size = int(self.buf[:pos].split(";")[0].strip(), 16)
+                self.buf = self.buf[pos + 2:]
+                self._chunk = size if size else -1
+            elif self._chunk > 0:
+                take = self.buf[:self._chunk]
+                if not take:
+                    return
+                self.buf = self.buf[len(take):]
+                self._parts.append(take)
+                self._chunk -= len(take)
+            elif self._chunk == 0:
+                if len(self.buf) < 2:
+                    return
+                self.buf = self.buf[2:]
+                self._chunk = None
+            else:
+                if self.buf.startswith("\r\n"):
+                    self.done = True
+                elif self.buf.find("\r\n\r\n") >= 0:
+                    self.done = True
+                else:
+                    return
+
+    def feed_eof(self):
+        """ 连接关闭, 返回响应是否完整 """
+        if self._mode == "close":
+            self.done = True
+        return self.done
+
+    @property
+    def body(self):
+        return decode_body("".join(self._parts),
+                           self.headers.getheader("content-encoding"))
+
+
+class HTTPConnection(SocketIOHandler):
+    """ 到一个 (scheme, host, port) 的连接, 同一时间只处理一个请求
+    请求完成后如果可以保持连接则放回 `HTTPClient` 的连接池
+    """
+    def __init__(self, client, key):
+        SocketIOHandler.__init__(self, client.mainloop)
+        self.client = client
+        self.key = key
+        self.task = None
+        self.parser = None
+        self.addr = None
+        self.requests = 0
+        self.created = time.time()
+        self.last_used = self.created
+        self._connected = False
+        self._handshaking = False
+        self._want_write = False
+        self._wbuf = ""
+        self._addrs = []
+
+    @property
+    def connected(self):
+        return self._connected
+
+    def connect(self, addrs):
+        """ 非阻塞地依次连接 `addrs` 中的地址, 都失败时抛出socket.error """
+        self._addrs = list(addrs)
+        self._connect_next()
+
+    def _connect_next(self):
+        _, host, port = self.key
+        while self._addrs:
+            self.addr = self._addrs.pop(0)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            err = sock.connect_ex((self.addr, port))
+            if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self.sock = sock
+                self.track(u"{0}://{1}:{2}".format(*self.key))
+                self.mainloop.add_handler(self)
+                return
+            sock.close()
+            self.client.resolver.failed(host, self.addr)
+            if not self._addrs:
+                raise socket.error(err, os.strerror(err))
+
+    def _failover(self, err):
+        """ 连接失败时尝试下一个地址, 没有可用地址时返回False """
+        self.client.resolver.failed(self.key[1], self.addr)
+        if not self._addrs:
+            return False
+        self.client.logger.warn(u"Connect {0}({1}) failed: {2}, try next "
+                                u"address".format(self.key[1], self.addr, err))
+        # 先关闭旧的socket, 下一轮循环再连接, 避免本轮剩余的事件作用到新socket上
+        SocketIOHandler.close(self)
+        self.mainloop.add_callback(self._reconnect)
+        return True
+
+    def _reconnect(self):
+        if self.task is None:
+            return      # 已超时
+        try:
+            self._connect_next()
+        except socket.error, err:
+            self.abort(err)
+
+    def send(self, task, data):
+        self.task = task
+        self.parser = ResponseParser()
+        self.requests += 1
+        self._wbuf = data
+        self.mainloop.add_handler(self)     # 重新配置关注的事件
+
+    def is_readable(self):
+        return self.sock is not None and self._connected
+
+    def is_writable(self):
+        if self.sock is None:
+            return False
+        if not self._connected:
+            return True
+        if self._handshaking:
+            return self._want_write
+        return bool(self._wbuf)
+
+    def handle_write(self):
+        if not self._connected:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                err = socket.error(err, os.strerror(err))
+                if not self._failover(err):
+                    self.abort(err)
+                return
+            try:
+                self.sock.getpeername()
+            except socket.error, err:
+                if err.args[0] == errno.ENOTCONN:
+                    return      # 仍在连接中
+                raise
+            self._connected = True
+            if self.key[0] == "https":
+                self.sock = ssl.wrap_socket(self.sock,
+                                            do_handshake_on_connect = False)
+                self._handshaking = True
+        if self._handshaking and not self._handshake():
+            return
+        self._flush()
+
+    def _handshake(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLError, err:
+            if err.args[0] in _SSL_WANT:
+                self._want_write = err.args[0] == ssl.SSL_ERROR_WANT_WRITE
+            else:
+                self.abort(err)
+            return False
+        except socket.error, err:
+            self.abort(err)
+            return False
+        self._handshaking = False
+        return True
+
+    def _flush(self):
+        while self._wbuf:
+            try:
+                sent = self.sock.send(self._wbuf)
+            except ssl.SSLError, err:
+                if err.args[0] in _SSL_WANT:
+                    return
+                self.abort(err)
+                return
+            except socket.error, err:
+                if err.args[0] in _BLOCKING_ERRORS + (errno.EINTR,):
+                    return
+                self.abort(err)
+                return
+            self._wbuf = self._wbuf[sent:]
+
+    def handle_read(self):
+        if not self._connected:
+            # 连接失败时epoll也会报告可读, 统一在handle_write中检查
+            self.handle_write()
+            return
+        if self._handshaking:
+            if self._handshake():
+                self._flush()
+            return
+        while self.sock is not None:
+            try:
+                data = self.sock.recv(16384)
+            except ssl.SSLError, err:
+                if err.args[0] in _SSL_WANT:
+                    return
+                self.abort(err)
+                return
+            except socket.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                if err.args[0] in _BLOCKING_ERRORS:
+                    return
+                self.abort(err)
+                return
+            if not data:
+                self._handle_eof()
+                return
+            if self.task is None:
+                # 空闲连接上收到数据, 不可再复用
+                self.close()
+                return
+            try:
+                self.parser.feed(data)
+            except (ValueError, httplib.HTTPException, zlib.error), err:
+                self.abort(err)
+                return
+            if self.parser.done:
+                self.client._finish(self)
+                return
+
+    def _handle_eof(self):
+        if self.task is None:
+            self.close()
+        elif self.parser.feed_eof():
+            self.client._finish(self)
+        else:
+            stale = self.requests > 1 and not self.parser.received
+            self.abort(socket.error(errno.ECONNRESET,
+                                    "Connection closed by peer"), stale)
+
+    def handle_hup(self):
+        if self.sock is not None and not self._connected:
+            self.handle_write()
+            return
+        if self.sock is not None:
+            self.handle_read()
+        if self.sock is not None and self.task is None:
+            self.close()
+
+    def handle_err(self):
+        if self.sock is not None and not self._connected:
+            self.handle_write()
+            return
+        if self.task is not None:
+            self.abort(socket.error(errno.ECONNRESET, "Socket error"))
+        else:
+            self.close()
+
+    def abort(self, err, stale = False):
+        """ 关闭连接, 将错误交给 `HTTPClient` """
+        task = self.task
+        self.task = None
+        self.close()
+        if task is not None:
+            self.client._fail(task, err, stale)
+
+    def close(self):
+        self.client._discard(self)
+        SocketIOHandler.close(self)
+
+
+class _Task(object):
+    """ 一次fetch的状态 """
+    __slots__ = ("request", "callback", "timeout", "retries",
+                 "follow_redirects", "attempts", "redirects", "timer", "conn")
+
+    def __init__(self, request, callback, timeout, retries, follow_redirects):
+        self.request = request
+        self.callback = callback
+        self.timeout = timeout
+        self.retries = retries
+        self.follow_redirects = follow_redirects
+        self.attempts = 0
+        self.redirects = 0
+        self.timer = None
+        self.conn = None
+
+
+class HTTPClient(object):
+    """ 运行在EpollMainLoop上的异步HTTP客户端
+
+    `fetch(request, callback)` 发送urllib2.Request, 完成后以 `HTTPResult`
+    调用callback. 支持连接复用, 超时, 重试, 重定向, gzip/deflate和chunked
+    """
+    max_redirects = 5
+    retry_delay = 1
+
+    def __init__(self, mainloop, http_sock, resolver = None, max_idle = 4,
+                 idle_timeout = 30):
+        self.logger = get_logger("http_client")
+        self.mainloop = mainloop
+        self.http_sock = http_sock
+        self.resolver = resolver if resolver else Resolver(mainloop)
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle = {}          # key -> [HTTPConnection]
+        self._sweep_timer = None
+
+    @property
+    def idle_connections(self):
+        """ 连接池中空闲的连接数 """
+        return sum(len(conns) for conns in self._idle.itervalues())
+
+    def fetch(self, request, callback, timeout = 10, retries = 2,
+              follow_redirects = True, delay = 0):
+        """ 异步发送请求
+        `request`   urllib2.Request, 通常由 `HTTPSock.make_request` 构造
+        `callback`  接收 `HTTPResult`
+        `timeout`   单次请求的超时(秒)
+        `retries`   网络错误和超时的重试次数
+        `delay`     延迟发送(秒)
+        """
+        task = _Task(request, callback, timeout, retries, follow_redirects)
+        if delay:
+            self.mainloop.call_later(delay, self._start, task)
+        else:
+            self._start(task)
+        return task
+
+    def _start(self, task):
+        task.attempts += 1
+        self.http_sock.add_cookie_header(task.request)
+        try:
+            key, data = self.http_sock.make_http_data(task.request)
+        except (ValueError, AttributeError), err:
+            self._fail(task, err)
+            return
+        # 超时从这里开始计算, 包括域名解析, 解析卡住时也能超时
+        task.timer = self.mainloop.call_later(task.timeout, self._timeout,
+                                              task)
+        conn = self._get_idle(key)
+        if conn is not None:
+            self._send(task, conn, data)
+        else:
+            self.resolver.resolve(key[1], partial(self._connect, task,
+                                                  task.timer, key, data))
+
+    def _connect(self, task, timer, key, data, addrs, err):
+        """ 域名解析完成, `timer` 不是task当前的定时器时说明这次尝试已经
+        超时, 忽略解析结果 """
+        if task.timer is not timer:
+            return
+        if err is not None or not addrs:
+            self._fail(task, err or socket.error("No address for "
+                                                 "{0}".format(key[1])))
+            return
+        conn = HTTPConnection(self, key)
+        try:
+            conn.connect(addrs)
+        except socket.error, err:
+            self._fail(task, err)
+            return
+        self._send(task, conn, data)
+
+    def _send(self, task, conn, data):
+        task.conn = conn
+        conn.send(task, data)
+
+    def _get_idle(self, key):
+        now = time.time()
+        idle = self._idle.get(key, [])
+        while idle:
+            conn = idle.pop()
+            if now - conn.last_used < self.idle_timeout:
+                return conn
+            conn.close()
+        return None
+
+    def _release(self, conn):
+        conn.task = None
+        conn.parser = None
+        conn.last_used = time.time()
+        idle = self._idle.setdefault(conn.key, [])
+        idle.append(conn)
+        while len(idle) > self.max_idle:
+            idle.pop(0).close()
+        if self._sweep_timer is None:
+            self._sweep_timer = self.mainloop.call_later(self.idle_timeout,
+                                                         self._sweep)
+
+    def _sweep(self):
+        """ 定时关闭连接池中超过 `idle_timeout` 的连接 """
+        self._sweep_timer = None
+        deadline = time.time() - self.idle_timeout
+        for key, idle in self._idle.items():
+            for conn in [c for c in idle if c.last_used <= deadline]:
+                conn.close()
+            if not idle:
+                del self._idle[key]
+        if self._idle:
+            self._sweep_timer = self.mainloop.call_later(self.idle_timeout,
+                                                         self._sweep)
+
+    def _discard(self, conn):
+        idle = self._idle.get(conn.key)
+        if idle and conn in idle:
+            idle.remove(conn)
+
+    def _timeout(self, task):
+        conn = task.conn
+        if conn is not None and conn.task is task:
+            if not conn.connected:
+                self.resolver.failed(conn.key[1], conn.addr)
+            conn.task = None
+            conn.close()
+        task.timer = None
+        self._fail(task, socket.timeout("timed out"))
+
+    def _finish(self, conn):
+        task, parser = conn.task, conn.parser
+        if task.timer is not None:
+            task.timer.cancel()
+            task.timer = None
+        task.conn = None
+        if parser.keep_alive:
+            self._release(conn)
+        else:
+            conn.task = None
+            conn.close()
+        try:
+            body = parser.body
+        except zlib.error, err:
+            self._fail(task, err)
+            return
+        result = HTTPResult(task.request, parser.code, parser.headers, body)
+        self.http_sock.extract_cookies(result, task.request)
+        location = parser.headers.getheader("location")
+        if (task.follow_redirects and parser.code in REDIRECT_CODES and
+                location and task.redirects < self.max_redirects):
+            task.redirects += 1
+            task.attempts -= 1
+            task.request = self._redirect_request(task.request, parser.code,
+                                                  location)
+            self._start(task)
+            return
+        result.retries = task.attempts - 1
+        result.redirects = task.redirects
+        result.first_byte = parser.first_byte
+        self._callback(task, result)
+
+    def _redirect_request(self, request, code, location):
+        url = urlparse.urljoin(request.get_full_url(), location)
+        new = self.http_sock.make_request(url, None)
+        for key, value in request.headers.items():
+            if key.lower() not in ("host", "cookie", "content-type",
+                                   "content-length"):
+                new.add_header(key, value)
+        if code in (307, 308) and request.has_data():
+            new.add_data(request.get_data())
+            new.add_header("Content-Type", request.headers.get(
+                "Content-type", "application/x-www-form-urlencoded"))
+        return new
+
+    def _fail(self, task, err, stale = False):
+        if task.timer is not None:
+            task.timer.cancel()
+            task.timer = None
+        task.conn = None
+        if stale:
+            # 复用的连接已被服务器关闭, 立即用新连接重发, 不计入重试
+            task.attempts -= 1
+            self._start(task)
+            return
+        if task.attempts <= task.retries:
+            self.logger.warn(u"Fetch {0} failed: {1}, retry {2}/{3}"
+                             .format(task.request.get_full_url(), err,
+                                     task.attempts, task.retries))
+            self.mainloop.call_later(self.retry_delay * task.attempts,
+                                     self._start, task)
+            return
+        self.logger.warn(u"Fetch {0} failed: {1}"
+                         .format(task.request.get_full_url(), err))
+        result = HTTPResult(task.request, error = err)
+        result.retries = task.attempts - 1
+        self._callback(task, result)
+
+    def _callback(self, task, result):
+        try:
+            task.callback(result)
+        except Exception, err:
+            self.logger.exception(u"Fetch callback error: {0}".format(err))
@@ -6,8 +6,6 @@
 #   Date    :   13/03/04 09:58:26
 #   Desc    :   Http Socket 实现
 #
-import ssl
-import socket
 import urllib
 import urllib2
 import httplib
@@ -17,11 +15,24 @@ import cookielib
 from lib.utils import Form
 
 class HTTPSock(object):
-    """ 构建支持Cookie的HTTP socket
-    供可复用的I/O模型调用"""
+    """ 构建支持Cookie的HTTP请求数据
+    供可复用的I/O模型(HTTPClient)调用"""
     def __init__(self):
         cookiefile = tempfile.mktemp()
         self.cookiejar = cookielib.MozillaCookieJar(cookiefile)
+        self.server = None      # (scheme, host, port), 见 `set_server`
+
+    def set_server(self, url):
+        """ 所有请求都连接到 `url` (如本地的 tools/webqq_standin.py),
+        请求的Host头和Cookie仍按原来的地址, 为None时恢复 """
+        if not url:
+            self.server = None
+            return
+        parse = urlparse.urlparse(url)
+        host, port = urllib.splitport(parse.netloc)
+        port = port if port else getattr(httplib, parse.scheme.upper() +
+                                         "_PORT")
+        self.server = (parse.scheme, host, int(port))
 
     def make_request(self, url, form, method = "GET"):
         """ 根据url 参数 构建 urllib2.Request """
@@ -39,28 +50,22 @@ class HTTPSock(object):
                 request = urllib2.Request(url, params)
                 request.add_header("Content-Type", "application/x-www-form-urlencoded")
 
-        self.cookiejar.add_cookie_header(request)
-        request.headers.update(request.unredirected_hdrs)
+        self.add_cookie_header(request)
         return request
 
-    def make_response(self, sock, req, method):
-        """ 根据socket和urlib2.Request 构建Response """
-        r = httplib.HTTPResponse(sock, 0, strict = 0, method = method, buffering=True)
-        r.begin()
-
-        r.recv = r.read
-        fp = socket._fileobject(r, close=True)
+    def add_cookie_header(self, request):
+        """ 发送前根据当前Cookie更新请求头 """
+        self.cookiejar.add_cookie_header(request)
+        request.headers.update(request.unredirected_hdrs)
 
-        resp = urllib.addinfourl(fp, r.msg, req.get_full_url())
-        resp.code = r.status
-        resp.msg = r.reason
+    def extract_cookies(self, resp, req):
+        """ 从响应中保存Cookie, `resp` 需提供 info() """
         self.cookiejar.extract_cookies(resp, req)
         self.cookiejar.save()
-        return resp
-
 
-    def make_http_sock_data(self, request):
-        """ 根据urllib2.Request 构建socket和用于发送的HTTP源数据 """
+    def make_http_data(self, request):
+        """ 根据urllib2.Request 返回连接地址 (scheme, host, port)
+        和用于发送的HTTP源数据 """
         url = request.get_full_url()
         headers = request.headers
         data = request.get_data()
@@ -69,23 +74,9 @@ class HTTPSock(object):
         typ = parse.scheme
         port = port if port else getattr(httplib, typ.upper() + "_PORT")
         data =  self.get_http_source(parse, data, headers)
-        if hasattr(self, "do_" + typ):
-            return getattr(self, "do_"+typ)(host, port), data
-
-    def do_http(self, host, port):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(3)
-        sock.connect((host, int(port)))
-        sock.setblocking(0)
-        return sock
-
-    def do_https(self, host, port, keyfile = None, certfile = None):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(3)
-        sock.connect((host, int(port)))
-        sock = ssl.wrap_socket(sock, keyfile, certfile)
-        sock.setblocking(0)
-        return sock
+        if self.server is not None:
+            return self.server, data
+        return (typ, host, int(port)), data
 
     def get_http_source(self, parse, data, headers):
         path = parse.path
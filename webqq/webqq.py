@@ -6,34 +6,50 @@
 #   Date    :   13/02/28 11:23:49
 #   Desc    :   Web QQ API
 #
+import os
 import time
-import json
 import Queue
 import random
 import tempfile
-import threading
 from hashlib import md5
 from functools import partial
-from pyxmpp2.interfaces import event_handler, EventHandler
+from collections import deque
+from pyxmpp2.interfaces import event_handler
 
-from lib.utils import HttpHelper, get_logger, upload_file
+from lib.utils import get_logger
+from lib.httpd import file_response
+from lib.metrics import LATENCY_BUCKETS
 
 from .webqqevents import (CheckedEvent, WebQQLoginedEvent, BeforeLoginEvent,
                          WebQQHeartbeatEvent, WebQQMessageEvent, RetryEvent,
-                         WebQQPollEvent, RemoveEvent, GroupListEvent,
+                         WebQQPollEvent, GroupListEvent,
                          WebQQRosterUpdatedEvent, GroupMembersEvent,
                           ReconnectEvent)
 from .handlers import (CheckHandler, BeforeLoginHandler, LoginHandler,
                        HeartbeatHandler, PollHandler, GroupMsgHandler,
                        GroupListHandler, GroupMembersHandler, WebQQHandler)
+from .http_client import HTTPClient
 
 
-class WebQQ(EventHandler):
+class WebQQ(object):
     """ WebQQ
     :param :qid QQ号
-    :param :event_queue pyxmpp2时间队列"""
+    :param :event_queue pyxmpp2时间队列
+
+    WebQQ事件由 `event` 根据 `@event_handler` 预先生成的分发表直接调用
+    处理方法, 只有通过 `subscribe` 订阅的事件才会放入pyxmpp2的事件队列"""
+    captcha_timeout = 600       # 等待输入验证码的时间, 超时后重新获取
+    send_interval = 0.5         # 发送群消息的最小间隔(秒)
+    send_queue_size = 200       # 等待发送的群消息上限, 超出时丢弃最旧的
+    member_concurrency = 4      # 同时获取群成员的请求数
+    poll_timeout = 90           # 轮询超过此时间没有响应视为连接中断
+    poll_max_delay = 30         # 轮询连续失败时退避的最长间隔
+    # 用到的接口域名, 启动时预先解析
+    HOSTS = ("check.ptlogin2.qq.com", "ssl.ptlogin2.qq.com",
+             "ssl.captcha.qq.com", "d.web2.qq.com", "s.web2.qq.com",
+             "web.qq.com", "web2.qq.com")
     def __init__(self, qid, pwd, event_queue, qxbot):
-        self.logger = get_logger()
+        self.logger = get_logger("webqq")
         self.qid = qid
         self.__pwd = pwd
         self.aid = 1003903
@@ -44,6 +60,7 @@ class WebQQ(EventHandler):
         self.uin_qid_map = {}    # uin 到 qq号的映射
         self.check_code = None
         self.skey = None
+        self.logined = False
         self.ptwebqq = None
         self.require_check = False
         self.QUIT = False
@@ -55,65 +72,162 @@ class WebQQ(EventHandler):
         self.start_time = time.time()
         self.hb_last_time = self.start_time
         self.poll_last_time = self.start_time
-        self._helper = HttpHelper()
         self.connected = False
         self.polled = False
         self.heartbeated = False
+        self.relogging = False          # 会话失效, 正在重新登录
+        self._relogin_started = None
+        self._poll_failures = 0         # 轮询连续失败的次数
         self.group_lst_updated = False
+        self._member_queue = deque()    # 等待获取成员的群gcode
+        self._member_inflight = 0
         self.qxbot = qxbot
         self.mainloop = qxbot.mainloop
-        self.mainloop.add_handler(self)
+        self.timeline = qxbot.timeline
+        self._dispatch_table = self._build_dispatch_table()
+        self._subscribed = set()
+        self._pending_events = deque()
+        self._dispatching = False
+        self._send_queue = deque()
+        self._poll_paused = False
+        self._send_timer = None
         self.http_sock = WebQQHandler.http_sock
+        self.http_client = HTTPClient(self.mainloop, self.http_sock,
+                                      qxbot.resolver)
+        self.captcha_path = os.path.join(tempfile.gettempdir(),
+                                         "qxbot_captcha_{0}.jpg".format(qid))
+        self.captcha_pending = False
+        self._captcha_timer = None
+        metrics = qxbot.metrics
+        self.request_time = metrics.histogram(
+            "qxbot_webqq_request_seconds",
+            u"WebQQ接口请求的往返时间(含重试), 按handler类",
+            ("handler",), bounds = LATENCY_BUCKETS)
+        self.retry_count = metrics.counter(
+            "qxbot_webqq_retries_total",
+            u"WebQQ请求的重试次数, http为HTTPClient内部重试, "
+            u"handler为重新创建handler", ("handler", "kind"))
+        self.send_result = metrics.counter(
+            "qxbot_qq_send_total", u"发送群消息的结果, 按retcode",
+            ("retcode",))
+        self.poll_errors = metrics.counter(
+            "qxbot_webqq_poll_errors_total",
+            u"轮询失败的次数, 按错误类型或HTTP状态码", ("kind",))
+        self.session_expired_count = metrics.counter(
+            "qxbot_webqq_session_expired_total",
+            u"会话失效需重新登录的次数, 按retcode", ("retcode",))
+        self.relogin_time = metrics.histogram(
+            "qxbot_webqq_relogin_seconds",
+            u"从发现会话失效到重新开始向QQ群发送消息的时间", (),
+            bounds = LATENCY_BUCKETS)
+        qxbot.control.register("captcha", self.handle_captcha_command,
+                               u"查看验证码图片, 带code参数时提交验证码")
+
+    def _build_dispatch_table(self):
+        """ 事件类 -> 处理该事件的方法 """
+        table = {}
+        for name, value in type(self).__dict__.iteritems():
+            event_class = getattr(value, "_pyxmpp_event_handled", None)
+            if event_class is not None:
+                table[event_class] = getattr(self, name)
+        return table
+
+    def subscribe(self, *event_classes):
+        """ 让这些事件在WebQQ处理后继续放入pyxmpp2的事件队列,
+        供其他 `EventHandler` 处理 """
+        self._subscribed.update(event_classes)
 
     def event(self, event, delay = 0):
-        """ timeout可以延迟将事件放入事件队列 """
+        """ 分发事件, delay可以延迟分发 """
         if delay:
-            target = partial(self.put_delay_event, self.event_queue, event, delay)
-            t = threading.Thread(target = target)
-            t.setDaemon(True)
-            t.start()
-        else:
+            self.mainloop.call_later(delay, self.event, event)
+            return
+        # 在处理方法中产生的事件排队, 等当前事件处理完再分发, 避免重入
+        self._pending_events.append(event)
+        if self._dispatching:
+            return
+        self._dispatching = True
+        try:
+            while self._pending_events:
+                self._dispatch(self._pending_events.popleft())
+        finally:
+            self._dispatching = False
+
+    def _dispatch(self, event):
+        cls = event.__class__
+        self.logger.debug(u"-- %s", event)
+        method = self._dispatch_table.get(cls)
+        if method is not None:
+            try:
+                method(event)
+            except Exception:
+                self.logger.exception(u"Error while handling {0}"
+                                      .format(cls.__name__))
+        if cls in self._subscribed:
             self.event_queue.put(event)
 
-    def put_delay_event(self, queue,event, delay):
-        """ 应当放入线程中 """
-        time.sleep(delay)
-        queue.put(event)
-
     def ptui_checkVC(self, r, vcode, uin):
         """ 处理检查的回调 返回三个值 """
         if int(r) == 0:
             self.logger.info("Check Ok")
-            self.check_code = vcode
+            self.require_check = False
         else:
             self.logger.warn("Check Error")
-            self.check_code = self.get_check_img(vcode)
             self.require_check = True
+        self.check_code = vcode
+        self._huin = uin
         return r, self.check_code, uin
 
     def get_check_img(self, vcode):
-        """ 获取验证图片 """
+        """ 获取验证图片保存到本地, 等待通过控制接口提交验证码
+        等待期间mainloop照常运行 """
         url = "https://ssl.captcha.qq.com/getimage"
         params = [("aid", self.aid), ("r", random.random()),
                   ("uin", self.qid)]
-        helper = HttpHelper(url, params, jar = self.http_sock.cookiejar)
-        res = helper.open()
-        path = tempfile.mktemp()
-        fp = open(path, 'wb')
-        fp.write(res.read())
-        fp.close()
-        res = upload_file("check.jpg", path)
-        print res.geturl()
-        check_code = None
-        while not check_code:
-            check_code = raw_input("打开上面连接输出图片上的验证码: ")
-        return check_code.strip()
+        req = self.http_sock.make_request(url, params)
+        self.http_client.fetch(req, self._on_check_img)
+
+    def _on_check_img(self, resp):
+        if resp.error:
+            self.logger.warn(u"Get check image error: {0}".format(resp.error))
+            self.event(ReconnectEvent(None), 5)
+            return
+        with open(self.captcha_path, 'wb') as fp:
+            fp.write(resp.body)
+        self.captcha_pending = True
+        self._captcha_timer = self.mainloop.call_later(self.captcha_timeout,
+                                                       self._captcha_expired)
+        self.logger.warn(u"Captcha required, image saved to {0}, view it "
+                         u"with the control command 'captcha' and submit "
+                         u"with 'captcha?code=XXXX'".format(self.captcha_path))
+
+    def _captcha_expired(self):
+        self._captcha_timer = None
+        if self.captcha_pending:
+            self.captcha_pending = False
+            self.logger.warn(u"Captcha expired, checking again")
+            self.run()
+
+    def handle_captcha_command(self, request):
+        """ 控制接口: 不带参数返回验证码图片, 带code参数时提交验证码 """
+        if not self.captcha_pending:
+            return u"No captcha required"
+        code = request.form.get("code", "").strip()
+        if not code:
+            return file_response(self.captcha_path, request, "image/jpeg")
+        self.captcha_pending = False
+        if self._captcha_timer is not None:
+            self._captcha_timer.cancel()
+            self._captcha_timer = None
+        self.check_code = code
+        self.timeline.finish("captcha")
+        self.before_login()
+        return u"Captcha submitted"
 
     def handle_pwd(self, password):
-        """ 根据检查返回结果,调用回调生成密码和保存验证码 """
-        r, self._vcode, huin = eval("self." + self.check_data.rstrip(";"))
-        pwd = md5(md5(password).digest() + huin).hexdigest().upper()
-        return md5(pwd + self._vcode).hexdigest().upper()
+        """ 根据检查返回结果和验证码生成密码 """
+        pwd = md5(md5(password).digest() + self._huin).hexdigest().upper()
+        return md5(pwd + self.check_code).hexdigest().upper()
 
     def ptuiCB(self, scode, r, url, status, msg, nickname = None):
         """ 模拟JS登录之前的回调, 保存昵称 """
@@ -123,41 +237,46 @@ class WebQQ(EventHandler):
             self.ptwebqq = self.http_sock.cookie['.qq.com']['/']['ptwebqq'].value
             self.logined = True
         else:
-            self.logger.warn("Get ptwebqq Error")
+            self.logger.warn(u"Get ptwebqq Error: {0}".format(msg))
+            self.logined = False
         if nickname:
             self.nickname = nickname
 
-    def get_qid_with_uin(self, uin):
-        """ 根据uin获取QQ号 """
+    def get_qid_with_uin(self, uin, callback):
+        """ 根据uin获取QQ号, 以QQ号(失败时为None)调用callback """
         url = "http://s.web2.qq.com/api/get_friend_uin2"
         params = [("tuin", uin), ("verifysession", ""),("type",4),
                   ("code", ""), ("vfwebqq", self.vfwebqq),
                   ("t", time.time())]
-        self._helper.change(url, params)
-        self._helper.add_header("Referer", "http://d.web2.qq.com/proxy."
-                                "html?v=20110331002&callback=1&id=3")
-        res = self._helper.open()
-        data = res.read()
-        if data:
-            info = json.loads(data)
-            if info.get("retcode") == 0:
-                return info.get("result", {}).get("account")
-
-    def get_group_msg_img(self, uin, info):
-        """ 获取消息中的图片 """
+        req = self.http_sock.make_request(url, params)
+        req.add_header("Referer", "http://d.web2.qq.com/proxy."
+                       "html?v=20110331002&callback=1&id=3")
+        self.http_client.fetch(req, partial(self._on_qid, uin, callback))
+
+    def _on_qid(self, uin, callback, resp):
+        self.timeline.add("qid:{0}".format(uin), resp.retries,
+                          len(resp.body or ""))
+        info = resp.json
+        qid = None
+        if info and info.get("retcode") == 0:
+            qid = info.get("result", {}).get("account")
+        callback(qid)
+
+    def get_group_msg_img(self, gcode, uin, info, callback):
+        """ 获取消息中的图片, 以 `HTTPResult` 调用callback """
         name = info.get("name")
         file_id = info.get("file_id")
         key = info.get("key")
         server = info.get("server")
         ip, port = server.split(":")
-        gid = self.group_map.get(uin, {}).get("gid")
+        gid = self.group_map.get(gcode, {}).get("gid")
         url = "http://web2.qq.com/cgi-bin/get_group_pic"
         params = [("type", 0), ("gid", gid), ("uin", uin),("rip", ip),
                   ("rport", port), ("fid", file_id), ("pic", name),
                   ("vfwebqq", self.vfwebqq), ("t", time.time())]
-        helper = HttpHelper(url, params)
-        helper.add_header("Referer", "http://web2.qq.com/")
-        return helper.open()
+        req = self.http_sock.make_request(url, params)
+        req.add_header("Referer", "http://web2.qq.com/")
+        self.http_client.fetch(req, callback)
 
     def get_group_name(self, gcode):
         """ 根据gcode获取群名 """
@@ -167,33 +286,49 @@ class WebQQ(EventHandler):
         return self.group_m_map.get(gcode, {}).get(uin, {}).get("nick")
 
     def run(self):
-        checkhandler = CheckHandler(self)
-        self.mainloop.add_handler(checkhandler)
+        if self.http_sock.server is None:
+            self.http_client.resolver.prefetch(self.HOSTS)
+        CheckHandler(self).run()
+
+    def before_login(self):
+        BeforeLoginHandler(self, password = self.__pwd).run()
 
     @event_handler(CheckedEvent)
     def handle_webqq_checked(self, event):
-        """ 第一步已经完毕, 删除掉检查的handler, 将登录前handler加入mainloop"""
-        bloginhandler = BeforeLoginHandler(self, password = self.__pwd)
-        self.mainloop.remove_handler(event.handler)
-        self.mainloop.add_handler(bloginhandler)
+        """ 第一步已经完毕, 需要验证码时先获取验证码, 然后开始登录前的操作 """
+        eval("self." + self.check_data.strip().rstrip(";"))
+        self.timeline.finish("check")
+        if self.require_check:
+            self.timeline.start("captcha")
+            self.get_check_img(self.check_code)
+        else:
+            self.before_login()
 
     @event_handler(BeforeLoginEvent)
     def handle_webqq_blogin(self, event):
-        """ 登录前完毕开始真正的登录 """
-        loginhandler = LoginHandler(self)
-        self.mainloop.remove_handler(event.handler)
-        self.mainloop.add_handler(loginhandler)
+        """ 登录前完毕开始真正的登录, 失败(如验证码错误)时重新检查 """
+        if not self.logined:
+            self.event(ReconnectEvent(event.handler), 5)
+            return
+        self.timeline.finish("before_login")
+        LoginHandler(self).run()
 
     @event_handler(WebQQLoginedEvent)
     def handle_webqq_logined(self, event):
-        """ 登录后将获取群列表的handler放入mainloop """
-        self.mainloop.remove_handler(event.handler)
-        self.mainloop.add_handler(GroupListHandler(self))
+        """ 登录后同时开始获取群列表, 轮询消息和心跳
+        群的数据就绪前收到的消息由 `MessageDispatch` 按群缓存 """
+        self.timeline.finish("login2")
+        GroupListHandler(self).run()
+        if not self.polled:
+            self.polled = True
+            PollHandler.acquire(self).run()
+        if not self.heartbeated:
+            self.heartbeated = True
+            HeartbeatHandler.acquire(self).run()
 
     @event_handler(GroupListEvent)
     def handle_webqq_group_list(self, event):
         """ 获取群列表后"""
-        self.mainloop.remove_handler(event.handler)
         data = event.data
         group_map = {}
         if data.get("retcode") == 0:
@@ -203,22 +338,36 @@ class WebQQ(EventHandler):
                 group_map[gcode] = group
 
         self.group_map = group_map
-        self.group_lst_updated = False   # 开放添加GroupListHandler
-        i = 1
-        for gcode in group_map:
-            if i == len(group_map):
-                self.mainloop.add_handler(
-                    GroupMembersHandler(self, gcode = gcode, done = True))
-            else:
-                self.mainloop.add_handler(
-                    GroupMembersHandler(self, gcode = gcode, done = False))
-
-            i += 1
+        if event.handler.delay:
+            # 定时刷新完成, 开放添加GroupListHandler. 重新登录时获取的
+            # 群列表不再添加, 避免同时有两个定时刷新
+            self.group_lst_updated = False
+        self.timeline.finish("group_list")
+        # 群号映射和群成员同时获取, 每个群都就绪后单独开始转发
+        self.qxbot.msg_dispatch.get_map(self.handle_map_ready,
+                                        self.handle_group_mapped)
+        self._member_queue = deque(group_map)
+        if not group_map:
+            self.event(WebQQRosterUpdatedEvent(event.handler))
+        self._fetch_members()
+
+    def handle_group_mapped(self, gcode):
+        """ 已知群号, 桥接的群优先获取成员 """
+        if self.qxbot.msg_dispatch.is_bridged(gcode) and \
+           gcode in self._member_queue:
+            self._member_queue.remove(gcode)
+            self._member_queue.appendleft(gcode)
+
+    def _fetch_members(self):
+        while self._member_queue and \
+              self._member_inflight < self.member_concurrency:
+            self._member_inflight += 1
+            GroupMembersHandler(self, gcode = self._member_queue.popleft()
+                                ).run()
 
     @event_handler(GroupMembersEvent)
     def handle_group_members(self, event):
         """ 获取所有群成员 """
-        self.mainloop.remove_handler(event.handler)
         members = event.data.get("result", {}).get("minfo", [])
         self.group_m_map[event.gcode] = {}
         for m in members:
@@ -228,74 +377,153 @@ class WebQQ(EventHandler):
         for card in cards:
             uin = card.get("muin")
             group_name = card.get("card")
-            self.group_m_map[event.gcode][uin]["nick"] = group_name
+            if uin in self.group_m_map[event.gcode]:
+                self.group_m_map[event.gcode][uin]["nick"] = group_name
 
+        self.timeline.finish("group_info:{0}".format(event.gcode))
+        self.qxbot.msg_dispatch.members_ready(event.gcode)
+        self._member_inflight -= 1
+        self._fetch_members()
+        if not self._member_queue and not self._member_inflight:
+            self.event(WebQQRosterUpdatedEvent(event.handler))
+
+    @event_handler(WebQQRosterUpdatedEvent)
+    def handle_webqq_roster(self, event):
+        """ 群成员都获取完毕后, 定时刷新群列表 """
         # 防止重复添加GroupListHandler
         if not self.group_lst_updated:
             self.group_lst_updated = True
-            self.mainloop.add_handler(GroupListHandler(self, delay = 300))
+            GroupListHandler(self, delay = 300).run()
 
-    @event_handler(WebQQRosterUpdatedEvent)
-    def handle_webqq_roster(self, event):
-        """ 群成员都获取完毕后开启,Poll获取消息和心跳 """
-        self.mainloop.remove_handler(event.handler)
-        self.qxbot.msg_dispatch.get_map()
-        if not self.polled:
-            self.polled = True
-            self.mainloop.add_handler(PollHandler(self))
-        if not self.heartbeated:
-            self.heartbeated = True
-            hb = HeartbeatHandler(self)
-            self.mainloop.add_handler(hb)
-        while True:
-            try:
-                stanza = self.qxbot.xmpp_msg_queue.get_nowait()
-                self.qxbot.msg_dispatch.dispatch_xmpp(stanza)
-            except Queue.Empty:
-                break
+    def handle_map_ready(self):
+        """ 所有群号都已获取, 可以向QQ群发送消息了,
+        开始重放QQ就绪前缓存的XMPP消息 """
         self.connected = True
+        if self.relogging:
+            self.relogging = False
+            elapsed = time.time() - self._relogin_started
+            self.relogin_time.observe(elapsed)
+            self.logger.info(u"WebQQ session restored in {0:.2f}s"
+                             .format(elapsed))
+            if self._send_timer is None:
+                self._send_next()
+        self.qxbot.msg_dispatch.schedule_replay()
+        self.qxbot.check_go_live()
 
     @event_handler(WebQQHeartbeatEvent)
     def handle_webqq_hb(self, event):
-        """ 心跳完毕后, 延迟60秒在此触发此事件 重复心跳 """
-        self.mainloop.remove_handler(event.handler)
-        self.hb_handler = HeartbeatHandler(self, delay = 60)
-        self.mainloop.add_handler(self.hb_handler)
+        """ 心跳完毕后, 延迟60秒重复心跳 """
+        HeartbeatHandler.acquire(self, delay = 60).run()
 
     @event_handler(WebQQPollEvent)
     def handle_webqq_poll(self, event):
-        """ 延迟1秒重复触发此事件, 轮询获取消息 """
-        self.mainloop.remove_handler(event.handler)
-        self.mainloop.add_handler(PollHandler(self))
+        """ 重复触发此事件, 轮询获取消息
+        XMPP积压过多时暂停轮询, 由 `resume_poll` 恢复 """
+        if self.qxbot.flow.blocked("xmpp"):
+            self._poll_paused = True
+            return
+        PollHandler.acquire(self).run()
+
+    def resume_poll(self):
+        if self._poll_paused:
+            self._poll_paused = False
+            PollHandler.acquire(self).run()
 
     @event_handler(WebQQMessageEvent)
     def handle_webqq_msg(self, event):
         """ 有消息到达, 处理消息 """
-        self.qxbot.msg_dispatch.dispatch_qq(event.message)
+        self.qxbot.msg_dispatch.dispatch_qq(event.message, event.timing)
 
     @event_handler(RetryEvent)
     def handle_retry(self, event):
-        """ 有handler触发异常, 需重试 """
-        self.mainloop.remove_handler(event.handler)
-        handler = event.cls(self, event.req, *event.args, **event.kwargs)
-        self.mainloop.add_handler(handler)
-
-    @event_handler(RemoveEvent)
-    def handle_remove(self, event):
-        """ 触发此事件, 移除handler """
-        self.mainloop.remove_handler(event.handler)
+        """ 有handler请求失败, 需重试 """
+        handler = event.cls.acquire(self, event.req, *event.args,
+                                    **event.kwargs)
+        handler.run()
 
     @event_handler(ReconnectEvent)
     def handle_reconnect(self, event):
-        self.mainloop.remove_handler(event.handler)
-        self.mainloop.remove_handler(self.hb_handler)
         self.run()
 
-    def send_qq_group_msg(self, group_uin, content):
-        """ 发送qq群消息 """
-        handler = GroupMsgHandler(self, group_uin = group_uin,
-                                  content = content)
-        self.mainloop.add_handler(handler)
+    def poll_failed(self, err):
+        """ 轮询失败, `err` 为网络错误或HTTP状态码, 返回重新轮询前
+        等待的秒数: 连续失败时从 `retry_delay` 起加倍, 最长 `poll_max_delay`
+        """
+        if isinstance(err, Exception):
+            kind = err.__class__.__name__
+        else:
+            kind = "invalid" if err == 200 else str(err)
+        self.poll_errors.inc((kind,))
+        delay = min(PollHandler.retry_delay * 2 ** self._poll_failures,
+                    self.poll_max_delay)
+        self._poll_failures += 1
+        self.logger.warn(u"Poll failed: %s, retry in %ss", err, delay)
+        return delay
+
+    def poll_succeeded(self):
+        if self._poll_failures:
+            self.logger.info(u"Poll recovered after {0} failures"
+                             .format(self._poll_failures))
+            self._poll_failures = 0
+
+    def session_expired(self, retcode):
+        """ 轮询或发送消息返回会话失效(103, 121), 重新登录
+        重新登录期间XMPP消息写入spool, 群消息暂停发送, 群数据就绪后恢复 """
+        if self.relogging:
+            return
+        self.logger.warn(u"WebQQ session expired (retcode {0}), login again"
+                         .format(retcode))
+        self.session_expired_count.inc((retcode,))
+        self.relogging = True
+        self._relogin_started = time.time()
+        self.connected = False
+        self.event(ReconnectEvent(None))
+
+    def group_msg_sent(self, group_uin, retcode, received, trace = None):
+        """ 群消息发送完毕, `retcode` 为None表示网络错误 """
+        self.send_result.inc(("error" if retcode is None else retcode,))
+        if retcode is not None and trace is not None:
+            trace.tags["retcode"] = retcode
+            trace.finish("write")
+        if retcode == 0:
+            self.qxbot.msg_dispatch.sent_to_qq(group_uin, received)
+
+    def requeue_group_msg(self, group_uin, content, received = None,
+                          trace = None):
+        """ 会话失效未发出的消息放回队列头部, 重新登录后最先发送 """
+        self._send_queue.appendleft((group_uin, content, received, trace))
+
+    @property
+    def send_pending(self):
+        return len(self._send_queue)
+
+    @property
+    def events_pending(self):
+        return len(self._pending_events)
+
+    def send_qq_group_msg(self, group_uin, content, received = None,
+                          trace = None):
+        """ 发送qq群消息, 排队按 `send_interval` 的间隔发送
+        `received` 为收到消息的时间, 用于统计转发延迟, `trace` 为追踪 """
+        if len(self._send_queue) >= self.send_queue_size:
+            self._send_queue.popleft()
+            self.logger.warn(u"QQ send queue full, drop oldest message")
+        self._send_queue.append((group_uin, content, received, trace))
+        if self._send_timer is None:
+            self._send_next()
+
+    def _send_next(self):
+        self._send_timer = None
+        if not self._send_queue or self.relogging:
+            return
+        group_uin, content, received, trace = self._send_queue.popleft()
+        if trace is not None:
+            trace.span("enqueue")
+        GroupMsgHandler.acquire(self, group_uin = group_uin,
+                                content = content, received = received,
+                                trace = trace).run()
+        self._send_timer = self.mainloop.call_later(self.send_interval,
+                                                    self._send_next)
 
 if __name__ == "__main__":
     from ..qxbot import QXBot
@@ -9,11 +9,20 @@
 
 from pyxmpp2.mainloop.interfaces import  Event
 
-class WebQQEvent(Event):
-    webqq = None
-    handler = None
+class WebQQEvent(object):
+    """ WebQQ事件的基类, 由 `WebQQ.event` 直接分发给WebQQ上的处理方法,
+    被订阅的事件再放入pyxmpp2的事件队列.
+    不继承 `Event` (它没有 __slots__), 而是注册为其虚拟子类
+    """
+    __slots__ = ("handler",)
+
+    def __unicode__(self):
+        return self.__class__.__name__
+
+Event.register(WebQQEvent)
 
 class CheckedEvent(WebQQEvent):
+    __slots__ = ("check_data",)
     def __init__(self, check_data, handler):
         self.check_data = check_data
         self.handler = handler
@@ -23,6 +32,7 @@ class CheckedEvent(WebQQEvent):
 
 
 class BeforeLoginEvent(WebQQEvent):
+    __slots__ = ("back_data",)
     def __init__(self, back_data, handler):
         self.back_data = back_data
         self.handler = handler
@@ -32,6 +42,7 @@ class BeforeLoginEvent(WebQQEvent):
 
 
 class WebQQLoginedEvent(WebQQEvent):
+    __slots__ = ()
     def __init__(self, handler):
         self.handler = handler
 
@@ -40,6 +51,7 @@ class WebQQLoginedEvent(WebQQEvent):
 
 
 class WebQQHeartbeatEvent(WebQQEvent):
+    __slots__ = ()
     def __init__(self, handler):
         self.handler = handler
 
@@ -48,6 +60,7 @@ class WebQQHeartbeatEvent(WebQQEvent):
 
 
 class WebQQPollEvent(WebQQEvent):
+    __slots__ = ()
     def __init__(self, handler):
         self.handler = handler
 
@@ -56,14 +69,22 @@ class WebQQPollEvent(WebQQEvent):
 
 
 class WebQQMessageEvent(WebQQEvent):
-    def __init__(self, msg, handler):
+    """ `timing` 为 (收到第一个字节, 收完, 解析完) 的时间, 用于追踪 """
+    __slots__ = ("message", "timing")
+    def __init__(self, msg, handler, timing = None):
         self.handler = handler
         self.message = msg
+        self.timing = timing
 
     def __unicode__(self):
-        return u"WebQQ Got msg: {0}".format(self.message)
+        # 只在DEBUG时格式化, 消息内容可能很长, 截断
+        message = unicode(self.message)
+        if len(message) > 200:
+            message = message[:200] + u"..."
+        return u"WebQQ Got msg: {0}".format(message)
 
 class RetryEvent(WebQQEvent):
+    __slots__ = ("cls", "req", "args", "kwargs", "err")
     def __init__(self, cls, req, handler, err = None, *args, **kwargs):
         self.cls = cls
         self.req = req
@@ -75,16 +96,10 @@ class RetryEvent(WebQQEvent):
     def __unicode__(self):
         return u"{0} Retry with Error {1}".format(self.cls.__name__, self.err)
 
-class RemoveEvent(WebQQEvent):
-    def __init__(self, handler):
-        self.handler = handler
-
-    def __unicode__(self):
-        return u"Remove Handler {0}".format(self.handler.__class__.__name__)
-
 
 
 class GroupListEvent(WebQQEvent):
+    __slots__ = ("data",)
     def __init__(self, handler, data):
         self.handler = handler
         self.data = data
@@ -93,6 +108,7 @@ class GroupListEvent(WebQQEvent):
         return u"WebQQ Update Group List"
 
 class WebQQRosterUpdatedEvent(WebQQEvent):
+    __slots__ = ()
     def __init__(self, handler):
         self.handler = handler
 
@@ -101,6 +117,7 @@ class WebQQRosterUpdatedEvent(WebQQEvent):
 
 
 class GroupMembersEvent(WebQQEvent):
+    __slots__ = ("data", "gcode")
     def __init__(self, handler, data, gcode):
         self.handler = handler
         self.data = data
@@ -111,6 +128,7 @@ class GroupMembersEvent(WebQQEvent):
 
 
 class ReconnectEvent(WebQQEvent):
+    __slots__ = ()
     def __init__(self, handler):
         self.handler = handler
 